@@ -0,0 +1,20 @@
+import itertools
+
+##############################################################################
+#
+# Row batches
+#
+# Rows go to SQLite and to the SQL dump in lists of at most BATCH_SIZE,
+# so generators of any length are loaded with bounded memory.
+#
+##############################################################################
+
+BATCH_SIZE = 10000
+
+def batched(iterable, n):
+    it = iter(iterable)
+    while True:
+        batch = list(itertools.islice(it, n))
+        if not batch:
+            return
+        yield batch
@@ -0,0 +1,191 @@
+import argparse
+import gc
+import json
+import math
+from pathlib import Path
+import platform
+import sqlite3
+import subprocess
+import tempfile
+import time
+
+from sql_gen import (parse_freq_csv, parse_conv_csv, parse_syls_txt, dedupe_frequencies,
+    dedupe_conversions, dedupe_syllables, find_common_inputs, get_input_sequences,
+    load_main_tables, write_sql_dump)
+from sql_writer import SqlDumpWriter
+from synth_data import generate
+
+##############################################################################
+#
+# Build pipeline benchmark
+#
+# Runs each stage of sql_gen.py on its own over synthetic data at
+# several scales, and reports the time per stage together with how it
+# grows with the input size. Results are written as JSON so that runs
+# from different commits can be compared with --compare.
+#
+##############################################################################
+
+STAGES = [
+    'parse_freq_csv',
+    'parse_conv_csv',
+    'parse_syls_txt',
+    'dedupe',
+    'find_common_inputs',
+    'get_input_sequences',
+    'write_sql_dump',
+    'load_main_tables',
+    'vacuum',
+]
+
+class Timer:
+    def __init__(self):
+        self.seconds = {}
+
+    def run(self, stage, fn, *args):
+        gc.collect()
+        start = time.perf_counter()
+        ret = fn(*args)
+        self.seconds[stage] = time.perf_counter() - start
+        return ret
+
+def vacuum(con):
+    con.execute('VACUUM;')
+
+def write_sql_file(sql_file, freq, conv, inputs, syls):
+    with SqlDumpWriter(sql_file) as sql_writer:
+        write_sql_dump(sql_writer, freq, conv, inputs, syls)
+
+def run_pipeline(paths, work_dir):
+    """Time every stage once; returns (seconds, row counts)"""
+    t = Timer()
+    freq = t.run('parse_freq_csv', parse_freq_csv, paths['frequencies'])
+    conv = t.run('parse_conv_csv', parse_conv_csv, paths['conversions'], False)
+    syls = t.run('parse_syls_txt', parse_syls_txt, paths['syllables'])
+    rows = {'frequency_csv': len(freq), 'conversions_csv': len(conv)}
+
+    def dedupe():
+        return dedupe_frequencies(freq), dedupe_conversions(conv), dedupe_syllables(syls)
+    freq, conv, syls = t.run('dedupe', dedupe)
+    freq, conv = t.run('find_common_inputs', find_common_inputs, freq, conv)
+    inputs = t.run('get_input_sequences', get_input_sequences, freq)
+    rows.update({'frequency': len(freq), 'conversions': len(conv), 'inputs': len(inputs), 'syllables': len(syls)})
+
+    t.run('write_sql_dump', write_sql_file, work_dir / 'bench.sql', freq, conv, inputs, syls)
+
+    db_file = work_dir / 'bench.db'
+    db_file.unlink(missing_ok=True)
+    con = sqlite3.connect(db_file)
+    t.run('load_main_tables', load_main_tables, con, freq, conv, inputs, syls)
+    t.run('vacuum', vacuum, con)
+    con.close()
+    rows['db_bytes'] = db_file.stat().st_size
+    return t.seconds, rows
+
+def run_scale(scale, data_dir, work_dir, seed, repeat):
+    paths, _ = generate(data_dir / f'x{scale:g}', scale, seed)
+    best = None
+    for _ in range(repeat):
+        seconds, rows = run_pipeline(paths, work_dir)
+        best = seconds if best is None else {k: min(v, best[k]) for k, v in seconds.items()}
+    return {
+        'scale': scale,
+        'rows': rows,
+        'seconds': best,
+        'total_seconds': sum(best.values()),
+    }
+
+def growth_exponents(results):
+    """Slope of log(time) against log(rows) between the smallest and
+    largest scale: ~1 is linear, ~2 is quadratic"""
+    if len(results) < 2:
+        return {}
+    lo = results[0]
+    hi = results[-1]
+    size = math.log(hi['rows']['conversions_csv'] / lo['rows']['conversions_csv'])
+    ret = {}
+    for stage in STAGES + ['total']:
+        a = lo['total_seconds'] if stage == 'total' else lo['seconds'][stage]
+        b = hi['total_seconds'] if stage == 'total' else hi['seconds'][stage]
+        ret[stage] = round(math.log(b / a) / size, 2) if a > 0 and b > 0 and size > 0 else None
+    return ret
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, cwd=Path(__file__).resolve().parent).stdout.strip() or None
+    except OSError:
+        return None
+
+def print_results(report):
+    for result in report['results']:
+        print(f"\nScale {result['scale']:g} ({result['rows']['conversions_csv']} conversion rows):")
+        for stage in STAGES:
+            print(f" - {stage:<20} {result['seconds'][stage]:9.3f}s")
+        print(f" - {'total':<20} {result['total_seconds']:9.3f}s")
+    if report['growth']:
+        print('\nGrowth exponent (1 = linear, 2 = quadratic):')
+        for stage, exp in report['growth'].items():
+            print(f" - {stage:<20} {exp}")
+
+def print_comparison(report, baseline):
+    old = {x['scale']: x for x in baseline['results']}
+    print(f"\nCompared to {baseline.get('revision')} (new / old):")
+    for result in report['results']:
+        prev = old.get(result['scale'])
+        if prev is None:
+            continue
+        print(f"Scale {result['scale']:g}:")
+        for stage in STAGES:
+            if stage in prev['seconds'] and prev['seconds'][stage] > 0:
+                print(f" - {stage:<20} {result['seconds'][stage] / prev['seconds'][stage]:6.2f}x")
+        print(f" - {'total':<20} {result['total_seconds'] / prev['total_seconds']:6.2f}x")
+
+##############################################################################
+#
+# __main__
+#
+##############################################################################
+
+parser = argparse.ArgumentParser(
+    description="""Benchmark the stages of the sql_gen.py build pipeline
+
+Synthetic source files are generated at each scale (a multiple of the
+size of data/conversions_all.csv), and each stage is timed separately.
+The fastest of --repeat runs is reported.""",
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+
+parser.add_argument('-n', '--scales', metavar='N', type=float, nargs='+', default=[1, 10], help='data sizes to run, e.g. 1 10 100 (default 1 10)')
+parser.add_argument('-r', '--repeat', type=int, default=1, help='runs per scale; the fastest is kept (default 1)')
+parser.add_argument('-o', '--output', metavar='FILE', help='write the results as JSON')
+parser.add_argument('--compare', metavar='FILE', help='a JSON file from an earlier run to compare against')
+parser.add_argument('--data-dir', metavar='DIR', help='keep the generated data in this directory (default: a temp dir)')
+parser.add_argument('--seed', type=int, default=0, help='random seed for the synthetic data (default 0)')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='khiin-bench-') as tmp:
+        data_dir = Path(args.data_dir or tmp)
+        work_dir = Path(tmp)
+        results = [run_scale(scale, data_dir, work_dir, args.seed, args.repeat) for scale in sorted(args.scales)]
+
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'results': results,
+        'growth': growth_exponents(results),
+    }
+    print_results(report)
+
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(report, json.load(f))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'\nResults written to {args.output}')
@@ -0,0 +1,263 @@
+import argparse
+import json
+import random
+import sqlite3
+import time
+
+from keyseq import lookup_numeric, lookup_prefix_sql, lookup_telex
+from lomaji import to_input_sequences
+
+##############################################################################
+#
+# Lookup latency benchmark
+#
+# Replays keystroke sessions against a built database the way the IME
+# queries it: every prefix of a key sequence as it is typed, the full
+# key sequence, a prefix range, and the inputs with the most candidates.
+# The sessions are sampled once from the first database, so that two
+# databases are measured on exactly the same queries.
+#
+# Prefix ranges run the SQL of keyseq.lookup_prefix, capped at
+# PREFIX_LIMIT inputs. A database without a prefix index runs it with
+# the range scan for every buffer, so both return the same rows.
+#
+##############################################################################
+
+SHAPES = ['exact', 'keystroke', 'prefix', 'multi_candidate']
+
+PREFIX_LIMIT = 100
+
+VIEW_SQL = 'SELECT * FROM {view} WHERE key_sequence = ?'
+
+COMPACT_SQL = 'SELECT * FROM lookup_compact WHERE {column}_skeleton = ?'
+
+def has_view(db_cur, name):
+    return db_cur.execute('SELECT 1 FROM sqlite_master WHERE type = ? AND name = ?', ['view', name]).fetchone() is not None
+
+def is_compact(db_cur, mode):
+    return not has_view(db_cur, f'lookup_{mode}') and has_view(db_cur, 'lookup_compact')
+
+def has_prefix_index(db_cur, mode):
+    return db_cur.execute('SELECT 1 FROM sqlite_master WHERE type = ? AND name = ?', ['table', f'prefix_{mode}']).fetchone() is not None
+
+##############################################################################
+#
+# Session sampling
+#
+##############################################################################
+
+def key_sequences(word, mode):
+    col = 0 if mode == 'numeric' else 1
+    return [x[col] for x in to_input_sequences(word)]
+
+def sample_sessions(db_cur, mode, n_sessions, n_multi, seed):
+    """Key sequences to replay, by query shape
+
+    Words are drawn in proportion to their frequency, and each one is
+    typed as one of its key sequences (toned or toneless) at random.
+    """
+    rng = random.Random(seed)
+    rows = db_cur.execute('SELECT input, freq FROM frequency').fetchall()
+    words = rng.choices([x[0] for x in rows], [x[1] + 1 for x in rows], k=n_sessions)
+    typed = [rng.choice(key_sequences(w, mode)) for w in words]
+
+    multi = db_cur.execute("""SELECT f.input FROM conversions AS c
+        JOIN frequency AS f ON f.id = c.input_id
+        GROUP BY c.input_id ORDER BY count(*) DESC, f.input LIMIT ?""", [n_multi]).fetchall()
+
+    return {
+        'exact': typed,
+        'keystroke': [seq[:i] for seq in typed for i in range(1, len(seq) + 1)],
+        'prefix': [seq[:rng.randint(1, len(seq))] for seq in typed],
+        'multi_candidate': [key_sequences(x[0], mode)[0] for x in multi],
+    }
+
+##############################################################################
+#
+# Measurement
+#
+##############################################################################
+
+class Target:
+    """A database and the query functions for one input mode"""
+
+    def __init__(self, db_file, mode):
+        self.db_file = db_file
+        self.mode = mode
+        self.con = sqlite3.connect(f'file:{db_file}?mode=ro', uri=True)
+        self.cur = self.con.cursor()
+        self.compact = is_compact(self.cur, mode)
+        self.prefix_index = has_prefix_index(self.cur, mode)
+
+    def prefix_sql(self, seq):
+        sql, params = lookup_prefix_sql(self.mode, seq, self.prefix_index)
+        return sql, params + [PREFIX_LIMIT]
+
+    def query(self, shape, seqs):
+        """(function of one key sequence returning rows, the distinct SQL
+        statements it runs on `seqs`, for EXPLAIN)"""
+        if self.compact:
+            if shape == 'prefix':
+                return None, None
+            fn = lookup_numeric if self.mode == 'numeric' else lookup_telex
+            return (lambda seq: fn(self.cur, seq)), [COMPACT_SQL.format(column=self.mode)]
+        if shape == 'prefix':
+            sqls = list(dict.fromkeys(self.prefix_sql(seq)[0] for seq in seqs))
+            return (lambda seq: self.cur.execute(*self.prefix_sql(seq)).fetchall()), sqls
+        sql = VIEW_SQL.format(view=f'lookup_{self.mode}')
+        return (lambda seq: self.cur.execute(sql, [seq]).fetchall()), [sql]
+
+    def explain(self, sqls):
+        plan = []
+        for sql in sqls:
+            params = [''] * sql.count('?')
+            plan.extend(x[-1] for x in self.cur.execute('EXPLAIN QUERY PLAN ' + sql, params))
+        return plan
+
+    def vm_steps(self, fn, seqs):
+        """Mean SQLite VM instructions per query, a proxy for rows scanned"""
+        steps = [0]
+        def count():
+            steps[0] += 1
+            return 0
+        self.con.set_progress_handler(count, 1)
+        for seq in seqs:
+            fn(seq)
+        self.con.set_progress_handler(None, 0)
+        return steps[0] / max(len(seqs), 1)
+
+    def close(self):
+        self.con.close()
+
+def is_full_scan(plan):
+    """True if the plan scans a table; scanning a materialized subquery
+    reads only the rows it has already found"""
+    subqueries = {line.split()[1] for line in plan if line.startswith('MATERIALIZE ')}
+    return any(line.startswith('SCAN') and line.split()[1] not in subqueries for line in plan)
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    i = min(len(sorted_values) - 1, max(0, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[i]
+
+def measure(target, shape, seqs, repeat):
+    fn, sqls = target.query(shape, seqs)
+    if fn is None:
+        return None
+    for seq in seqs:
+        fn(seq)
+    latencies = []
+    rows = 0
+    for _ in range(repeat):
+        for seq in seqs:
+            start = time.perf_counter_ns()
+            res = fn(seq)
+            latencies.append(time.perf_counter_ns() - start)
+            rows += len(res)
+    latencies.sort()
+    plan = target.explain(sqls)
+    us = lambda ns: round(ns / 1000, 1) if ns is not None else None
+    return {
+        'queries': len(latencies),
+        'p50_us': us(percentile(latencies, 50)),
+        'p95_us': us(percentile(latencies, 95)),
+        'p99_us': us(percentile(latencies, 99)),
+        'max_us': us(latencies[-1]) if latencies else None,
+        'rows_per_query': round(rows / max(len(latencies), 1), 1),
+        'vm_steps_per_query': round(target.vm_steps(fn, seqs), 1),
+        'sql': sqls,
+        'plan': plan,
+        'full_scan': is_full_scan(plan),
+    }
+
+def run_benchmark(db_file, sessions, mode, repeat):
+    target = Target(db_file, mode)
+    results = {shape: measure(target, shape, sessions[shape], repeat) for shape in SHAPES}
+    target.close()
+    return {'db': db_file, 'compact': target.compact, 'shapes': results}
+
+##############################################################################
+#
+# Report
+#
+##############################################################################
+
+def print_report(report):
+    for run in report['runs']:
+        print(f"\n{run['db']}{' (compact)' if run['compact'] else ''}:")
+        for shape in SHAPES:
+            res = run['shapes'][shape]
+            if res is None:
+                print(f' - {shape:<16} n/a')
+                continue
+            print(f" - {shape:<16} p50 {res['p50_us']:>8}us  p95 {res['p95_us']:>8}us  p99 {res['p99_us']:>8}us"
+                f"  {res['rows_per_query']:>7} rows  {res['vm_steps_per_query']:>9} steps")
+            for line in res['plan']:
+                print(f'     {line}')
+            if res['full_scan']:
+                print('     warning: full scan')
+
+def print_comparison(report):
+    a, b = report['runs']
+    print(f"\n{b['db']} / {a['db']}:")
+    for shape in SHAPES:
+        x = a['shapes'][shape]
+        y = b['shapes'][shape]
+        if x is None or y is None:
+            print(f' - {shape:<16} n/a')
+            continue
+        ratios = '  '.join(f"{p} {y[p + '_us'] / x[p + '_us']:5.2f}x" if x[p + '_us'] else f'{p} n/a'
+            for p in ('p50', 'p95', 'p99'))
+        print(f" - {shape:<16} {ratios}")
+        if x['plan'] != y['plan']:
+            print('     query plan differs')
+
+##############################################################################
+#
+# __main__
+#
+##############################################################################
+
+parser = argparse.ArgumentParser(
+    description="""Measure lookup latency of a khiin.db
+
+Keystroke sessions are sampled from the "frequency" table of the first
+database and replayed against the lookup_numeric or lookup_telex view
+(or lookup_compact, for --compact-inputs builds). Pass two databases to
+compare them on the same queries.""",
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+
+parser.add_argument('db', nargs='+', metavar='DB', help='one or two database files')
+parser.add_argument('-m', '--mode', choices=['numeric', 'telex'], default='numeric', help='input mode to query (default numeric)')
+parser.add_argument('-n', '--sessions', type=int, default=2000, help='number of typed words (default 2000)')
+parser.add_argument('--multi', type=int, default=200, help='number of inputs with the most candidates (default 200)')
+parser.add_argument('-r', '--repeat', type=int, default=3, help='times to replay each query (default 3)')
+parser.add_argument('--seed', type=int, default=0, help='random seed for the sessions (default 0)')
+parser.add_argument('-o', '--output', metavar='FILE', help='write the results as JSON')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if len(args.db) > 2:
+        parser.error('at most two databases can be compared')
+
+    con = sqlite3.connect(f'file:{args.db[0]}?mode=ro', uri=True)
+    sessions = sample_sessions(con.cursor(), args.mode, args.sessions, args.multi, args.seed)
+    con.close()
+
+    report = {
+        'mode': args.mode,
+        'sessions': args.sessions,
+        'repeat': args.repeat,
+        'seed': args.seed,
+        'sqlite': sqlite3.sqlite_version,
+        'runs': [run_benchmark(db, sessions, args.mode, args.repeat) for db in args.db],
+    }
+    print_report(report)
+    if len(report['runs']) == 2:
+        print_comparison(report)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f'\nResults written to {args.output}')
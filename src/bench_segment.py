@@ -0,0 +1,130 @@
+import argparse
+import json
+import random
+import sqlite3
+import time
+
+from bench_lookup import percentile
+from lomaji import SYLLABLE_SPLIT, to_input_sequences
+from segment import load_syllable_trie
+
+##############################################################################
+#
+# Segmentation benchmark
+#
+# Types sampled words without spaces, one key at a time, and times the
+# segmentation lattice of the buffer after every keystroke (the last
+# syllable may be incomplete), and all full segmentations of the final
+# buffer. For comparison, the same lattice is built the naive way, with
+# one SQL query per substring of up to the longest key length. The
+# words' own syllable splits are checked to be among the segmentations.
+#
+##############################################################################
+
+def sample_buffers(db_cur, mode, n, seed):
+    """(buffer, keys of each syllable) of words drawn by frequency"""
+    rng = random.Random(seed)
+    col = 0 if mode == 'numeric' else 1
+    rows = db_cur.execute('SELECT input, freq FROM frequency').fetchall()
+    words = rng.choices([x[0] for x in rows], [x[1] + 1 for x in rows], k=n)
+    ret = []
+    for word in words:
+        keys = [rng.choice(to_input_sequences(syl))[col] for syl in SYLLABLE_SPLIT.split(word)]
+        if all(k.isascii() and k.isalnum() for k in keys):
+            ret.append((''.join(keys), keys))
+    return ret
+
+def sql_lattice(db_cur, mode, buffer, max_len):
+    sql = f'SELECT "syllable" FROM "syllable_keys" WHERE "{mode}" = ?'
+    edges = []
+    for i in range(len(buffer)):
+        found = []
+        for j in range(i + 1, min(len(buffer), i + max_len) + 1):
+            syls = db_cur.execute(sql, [buffer[i:j]]).fetchall()
+            if syls:
+                found.append((j, tuple(x[0] for x in syls)))
+        edges.append(found)
+    return edges
+
+def timed(fn, items):
+    latencies = []
+    for x in items:
+        start = time.perf_counter_ns()
+        fn(x)
+        latencies.append(time.perf_counter_ns() - start)
+    latencies.sort()
+    us = lambda ns: round(ns / 1000, 2)
+    return {
+        'calls': len(latencies),
+        'p50_us': us(percentile(latencies, 50)),
+        'p95_us': us(percentile(latencies, 95)),
+        'p99_us': us(percentile(latencies, 99)),
+        'max_us': us(latencies[-1]),
+    }
+
+def run_benchmark(db_file, mode, n, seed):
+    con = sqlite3.connect(f'file:{db_file}?mode=ro', uri=True)
+    cur = con.cursor()
+
+    start = time.perf_counter()
+    trie = load_syllable_trie(cur, mode)
+    load_seconds = time.perf_counter() - start
+
+    samples = sample_buffers(cur, mode, n, seed)
+    buffers = [x[0] for x in samples]
+    keystrokes = [b[:i] for b in buffers for i in range(1, len(b) + 1)]
+    max_len = cur.execute(f'SELECT max(length("{mode}")) FROM "syllable_keys"').fetchone()[0]
+
+    found = sum(keys in trie.segmentations(buffer) for buffer, keys in samples)
+    counts = [len(trie.segmentations(b)) for b in buffers]
+    report = {
+        'db': db_file,
+        'mode': mode,
+        'keys': len(trie),
+        'load_seconds': round(load_seconds, 4),
+        'buffers': len(buffers),
+        'mean_buffer_length': round(sum(map(len, buffers)) / max(len(buffers), 1), 1),
+        'mean_segmentations': round(sum(counts) / max(len(counts), 1), 2),
+        'own_split_found': round(found / max(len(samples), 1), 4),
+        'keystroke_lattice': timed(lambda b: trie.lattice(b, partial=True), keystrokes),
+        'segmentations': timed(trie.segmentations, buffers),
+        'keystroke_lattice_sql': timed(lambda b: sql_lattice(cur, mode, b, max_len), keystrokes),
+    }
+    con.close()
+    return report
+
+def print_report(report):
+    print(f"\n{report['db']} ({report['mode']}, {report['keys']} keys, trie loaded in {report['load_seconds']}s):")
+    print(f" - {report['buffers']} words, {report['mean_buffer_length']} keys and "
+        f"{report['mean_segmentations']} segmentations on average")
+    print(f" - own syllable split found for {report['own_split_found']:.2%}")
+    for name in ['keystroke_lattice', 'segmentations', 'keystroke_lattice_sql']:
+        res = report[name]
+        print(f" - {name:<22} p50 {res['p50_us']:>8}us  p95 {res['p95_us']:>8}us  p99 {res['p99_us']:>8}us")
+
+##############################################################################
+#
+# __main__
+#
+##############################################################################
+
+parser = argparse.ArgumentParser(
+    description="""Measure syllable segmentation of unspaced key input
+
+Needs a database built with --syllable-index.""",
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+
+parser.add_argument('db', metavar='DB', help='the database file')
+parser.add_argument('-m', '--mode', choices=['numeric', 'telex'], default='numeric', help='input mode (default numeric)')
+parser.add_argument('-n', '--words', type=int, default=2000, help='number of typed words (default 2000)')
+parser.add_argument('--seed', type=int, default=0, help='random seed for the words (default 0)')
+parser.add_argument('-o', '--output', metavar='FILE', help='write the results as JSON')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    report = run_benchmark(args.db, args.mode, args.words, args.seed)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f'\nResults written to {args.output}')
@@ -0,0 +1,145 @@
+import argparse
+import asyncio
+import json
+import random
+import sqlite3
+import time
+
+from bench_lookup import key_sequences, percentile
+from lookup_service import LookupService, add_service_arguments, fetch_candidates
+
+##############################################################################
+#
+# Lookup service load generator
+#
+# Simulated typists each type their own words drawn by frequency, one
+# key at a time, and look up the buffer after every keystroke, with an
+# optional random think time in between. Every combination of cache size
+# and number of typists is run against a fresh LookupService, and the
+# same keystrokes are also replayed one request at a time on a single
+# connection, the way the database is queried today.
+#
+##############################################################################
+
+def sample_typists(db_cur, mode, n_typists, n_words, seed):
+    """Per typist, the buffers looked up after each keystroke"""
+    rng = random.Random(seed)
+    rows = db_cur.execute('SELECT input, freq FROM frequency').fetchall()
+    inputs = [x[0] for x in rows]
+    weights = [x[1] + 1 for x in rows]
+    typists = []
+    for _ in range(n_typists):
+        words = rng.choices(inputs, weights, k=n_words)
+        typed = [rng.choice(key_sequences(w, mode)) for w in words]
+        typists.append([seq[:i] for seq in typed for i in range(1, len(seq) + 1)])
+    return typists
+
+def summarize(latencies, seconds):
+    latencies.sort()
+    ms = lambda s: round(s * 1000, 3) if s is not None else None
+    return {
+        'requests': len(latencies),
+        'seconds': round(seconds, 3),
+        'throughput_rps': round(len(latencies) / seconds, 1) if seconds > 0 else None,
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p95_ms': ms(percentile(latencies, 95)),
+        'p99_ms': ms(percentile(latencies, 99)),
+        'max_ms': ms(latencies[-1] if latencies else None),
+    }
+
+def run_sequential(db_file, mode, typists):
+    con = sqlite3.connect(f'file:{db_file}?mode=ro', uri=True)
+    cur = con.cursor()
+    latencies = []
+    start = time.perf_counter()
+    for buffers in typists:
+        for buf in buffers:
+            t = time.perf_counter()
+            fetch_candidates(cur, mode, [buf])
+            latencies.append(time.perf_counter() - t)
+    seconds = time.perf_counter() - start
+    con.close()
+    return summarize(latencies, seconds)
+
+async def typist(service, buffers, think_time, rng, latencies):
+    for buf in buffers:
+        t = time.perf_counter()
+        await service.lookup(buf)
+        latencies.append(time.perf_counter() - t)
+        if think_time > 0:
+            await asyncio.sleep(rng.expovariate(1 / think_time))
+
+async def run_load(db_file, typists, cache_size, think_time, seed, args):
+    latencies = []
+    rng = random.Random(seed)
+    async with LookupService(db_file, args.mode, args.workers, cache_size, args.eviction,
+            args.batch_size, args.batch_window) as service:
+        start = time.perf_counter()
+        await asyncio.gather(*(typist(service, b, think_time, rng, latencies) for b in typists))
+        seconds = time.perf_counter() - start
+        stats = service.stats()
+    return dict(summarize(latencies, seconds), **stats)
+
+def print_result(name, res):
+    extra = ''
+    if 'cache_hit_rate' in res:
+        extra = f"  hits {res['cache_hit_rate']:6.1%}  batch {res['mean_batch_size']:5.1f}"
+    print(f" - {name:<24} {res['throughput_rps']:>9} req/s  p50 {res['p50_ms']:>7}ms  p95 {res['p95_ms']:>7}ms"
+        f"  p99 {res['p99_ms']:>7}ms{extra}")
+
+##############################################################################
+#
+# __main__
+#
+##############################################################################
+
+parser = argparse.ArgumentParser(
+    description="""Drive the lookup service with concurrent simulated typists
+
+Reports throughput and latency percentiles for each number of typists
+and cache size, next to one-request-at-a-time queries on a single
+connection.""",
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+
+parser.add_argument('db', metavar='DB', help='the database file')
+parser.add_argument('-c', '--typists', type=int, nargs='+', default=[1, 16, 128], help='numbers of concurrent typists (default 1 16 128)')
+parser.add_argument('-n', '--words', type=int, default=20, help='words typed by each typist (default 20)')
+parser.add_argument('--cache-size', type=int, nargs='+', default=[0, 10000], help='cache sizes to compare (default 0 10000)')
+parser.add_argument('--think-time', metavar='SECONDS', type=float, default=0, help='mean pause between keystrokes (default 0: as fast as possible)')
+parser.add_argument('--seed', type=int, default=0, help='random seed (default 0)')
+parser.add_argument('-o', '--output', metavar='FILE', help='write the results as JSON')
+add_service_arguments(parser)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    con = sqlite3.connect(f'file:{args.db}?mode=ro', uri=True)
+    all_typists = sample_typists(con.cursor(), args.mode, max(args.typists), args.words, args.seed)
+    con.close()
+
+    report = {
+        'db': args.db,
+        'mode': args.mode,
+        'workers': args.workers,
+        'eviction': args.eviction,
+        'batch_size': args.batch_size,
+        'batch_window': args.batch_window,
+        'think_time': args.think_time,
+        'words': args.words,
+        'runs': [],
+    }
+    print(f"\n{args.db} ({args.mode}, {args.workers} workers):")
+    for n in args.typists:
+        typists = all_typists[:n]
+        res = dict(run_sequential(args.db, args.mode, typists), typists=n, cache_size=None, sequential=True)
+        report['runs'].append(res)
+        print_result(f'{n} typists, sequential', res)
+        for cache_size in args.cache_size:
+            res = asyncio.run(run_load(args.db, typists, cache_size, args.think_time, args.seed, args))
+            res.update(typists=n, cache_size=cache_size, sequential=False)
+            report['runs'].append(res)
+            print_result(f'{n} typists, cache {cache_size}', res)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'\nResults written to {args.output}')
@@ -0,0 +1,70 @@
+from functools import lru_cache
+import unicodedata
+
+##############################################################################
+#
+# Locale-independent Lomaji collation
+#
+# Inputs are compared first by their base letters, then by tone, then by
+# code point, which gives the same order on every machine regardless of
+# LC_ALL. Within the base letters:
+#
+#   - a space (syllable boundary) sorts before any letter
+#   - o͘ sorts directly after o, ⁿ directly after n, and ṳ directly after u
+#   - tone marks do not affect the primary order
+#
+# Tones are ranked by their POJ tone number: unmarked (1/4), á (2),
+# à (3), â (5), ā (7), a̍ (8), ă (9).
+#
+##############################################################################
+
+TONE_RANK = {
+    '\u0301': 2,
+    '\u0300': 3,
+    '\u0302': 5,
+    '\u0304': 7,
+    '\u030D': 8,
+    '\u0306': 9,
+}
+
+# Marks that turn the preceding letter into a distinct letter (o͘, ṳ)
+LETTER_MARKS = {'\u0358', '\u0324'}
+
+SPACE_WEIGHT = 1
+
+KEY_CACHE_SIZE = 1 << 16
+
+def _letter_weight(c):
+    if c == ' ':
+        return SPACE_WEIGHT
+    if c == '\u207F':
+        return ord('n') * 2 + 1
+    # Astral characters share the top weight; the input itself is the
+    # final tie-breaker in sort_key, so the order stays total
+    return min(ord(c) * 2, 0x10FFFF)
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def sort_key(input):
+    """Collation key for a normalized Lomaji input
+
+    Returns a (primary, tones, input) tuple. `primary` packs one weight
+    per base letter into a string so the common comparison is a single
+    string compare.
+    """
+    primary = []
+    tones = []
+    tone = 0
+    for c in unicodedata.normalize('NFD', input):
+        if c in TONE_RANK:
+            tone = TONE_RANK[c]
+        elif c in LETTER_MARKS and primary:
+            primary[-1] += 1
+        elif unicodedata.combining(c):
+            continue
+        else:
+            if c == ' ':
+                tones.append(tone)
+                tone = 0
+            primary.append(_letter_weight(c))
+    tones.append(tone)
+    return (''.join(map(chr, primary)), tuple(tones), input)
@@ -0,0 +1,93 @@
+import sys
+
+##############################################################################
+#
+# Compact row records
+#
+##############################################################################
+
+class FreqRow:
+    __slots__ = ('input', 'freq', 'chhan_id')
+
+    def __init__(self, input, freq, chhan_id):
+        self.input = sys.intern(input)
+        self.freq = freq
+        self.chhan_id = chhan_id
+
+    def __repr__(self):
+        return f'FreqRow({self.input!r}, {self.freq}, {self.chhan_id})'
+
+class ConvRow:
+    __slots__ = ('input', 'output', 'weight')
+
+    def __init__(self, input, output, weight):
+        self.input = sys.intern(input)
+        self.output = output
+        self.weight = weight
+
+    def __repr__(self):
+        return f'ConvRow({self.input!r}, {self.output!r}, {self.weight})'
+
+class InputRow:
+    __slots__ = ('input', 'numeric', 'telex')
+
+    def __init__(self, input, numeric, telex):
+        self.input = input
+        self.numeric = numeric
+        self.telex = telex
+
+    def __repr__(self):
+        return f'InputRow({self.input!r}, {self.numeric!r}, {self.telex!r})'
+
+class KeyRow:
+    __slots__ = ('input', 'numeric', 'telex', 'toneless')
+
+    def __init__(self, input, numeric, telex, toneless):
+        self.input = input
+        self.numeric = numeric
+        self.telex = telex
+        self.toneless = toneless
+
+    def __repr__(self):
+        return f'KeyRow({self.input!r}, {self.numeric!r}, {self.telex!r}, {self.toneless!r})'
+
+##############################################################################
+#
+# Hash-indexed operations
+#
+##############################################################################
+
+def dedupe_best(rows, key, rank):
+    """Keep one row per key, preferring the highest rank
+
+    Ties keep the earliest row. The result is ordered by the position
+    of each winning row in the input, which matches a stable sort by
+    rank followed by a keep-first pass.
+    """
+    best = {}
+    for row in rows:
+        k = key(row)
+        prev = best.get(k)
+        if prev is None:
+            best[k] = row
+        elif rank(row) > rank(prev):
+            del best[k]
+            best[k] = row
+    return list(best.values())
+
+def input_set(rows):
+    return {row.input for row in rows}
+
+def semi_join(rows, inputs):
+    """Rows whose input is in the set `inputs`"""
+    return [row for row in rows if row.input in inputs]
+
+def extend_unique(rows, extra, key):
+    """Append the rows of `extra` whose key is not already present"""
+    seen = {key(row) for row in rows}
+    for row in extra:
+        k = key(row)
+        if k not in seen:
+            seen.add(k)
+            rows.append(row)
+    return rows
@@ -0,0 +1,95 @@
+import os
+from pathlib import Path
+import pickle
+import tempfile
+
+from dataset import FreqRow, ConvRow, InputRow, KeyRow
+from incremental import fingerprint
+
+##############################################################################
+#
+# Parsed dataset cache
+#
+# Stores the datasets that sql_gen.py builds from the source files
+# (normalized, deduped, sorted, with their key sequences) under a key
+# made of the files' contents and the flags that change them. Rows are
+# pickled column by column, so each distinct string is written once and
+# loading is a few list comprehensions. The sources of the pipeline
+# modules are part of the key, so editing the parsing or normalization
+# code never reuses stale data.
+#
+##############################################################################
+
+CACHE_VERSION = 1
+MAGIC = b'KHIINDS1'
+MAX_ENTRIES = 8
+
+SRC_DIR = Path(__file__).resolve().parent
+PIPELINE_SOURCES = ['sql_gen.py', 'dataset.py', 'collation.py', 'keyseq.py', 'lomaji.py']
+
+def cache_key(files, flags):
+    """Fingerprint of the source files, the flags and the pipeline code"""
+    files = dict(files)
+    for name in PIPELINE_SOURCES:
+        files[f'src/{name}'] = SRC_DIR / name
+    return fingerprint(files, dict(flags, cache_version=CACHE_VERSION)).split(':', 1)[1]
+
+def cache_path(cache_dir, key):
+    return Path(cache_dir) / f'{key}.datasets'
+
+def pack_datasets(freq, conv, inputs, syls):
+    compact = bool(inputs) and isinstance(inputs[0], KeyRow)
+    columns = {
+        'freq': ([x.input for x in freq], [x.freq for x in freq], [x.chhan_id for x in freq]),
+        'conv': ([x.input for x in conv], [x.output for x in conv], [x.weight for x in conv]),
+        'inputs': ([x.input for x in inputs], [x.numeric for x in inputs], [x.telex for x in inputs]),
+        'syls': syls,
+        'compact': compact,
+    }
+    if compact:
+        columns['inputs'] += ([x.toneless for x in inputs],)
+    return columns
+
+def unpack_datasets(columns):
+    freq = [FreqRow(*x) for x in zip(*columns['freq'])]
+    conv = [ConvRow(*x) for x in zip(*columns['conv'])]
+    row = KeyRow if columns['compact'] else InputRow
+    inputs = [row(*x) for x in zip(*columns['inputs'])]
+    return freq, conv, inputs, columns['syls']
+
+def load_datasets(cache_dir, key):
+    """(freq, conv, inputs, syls), or None on a miss or unreadable entry"""
+    path = cache_path(cache_dir, key)
+    try:
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('bad magic')
+            columns = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f'Ignoring unreadable cache entry {path}: {e}')
+        path.unlink(missing_ok=True)
+        return None
+    os.utime(path)
+    return unpack_datasets(columns)
+
+def save_datasets(cache_dir, key, freq, conv, inputs, syls):
+    """Write an entry atomically and drop the least recently used ones"""
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix='khiin-cache-', dir=cache_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MAGIC)
+            pickle.dump(pack_datasets(freq, conv, inputs, syls), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cache_path(cache_dir, key))
+    except BaseException:
+        os.remove(tmp)
+        raise
+    prune(cache_dir)
+
+def prune(cache_dir, max_entries=MAX_ENTRIES):
+    entries = sorted(Path(cache_dir).glob('*.datasets'), key=lambda p: p.stat().st_mtime, reverse=True)
+    for path in entries[max_entries:]:
+        path.unlink(missing_ok=True)
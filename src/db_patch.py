@@ -0,0 +1,337 @@
+import argparse
+import gzip
+import hashlib
+from pathlib import Path
+import shutil
+import sqlite3
+import tempfile
+
+from sql_writer import ROWS_PER_INSERT, quote_identifier, quote_value
+
+##############################################################################
+#
+# Row-level delta patches
+#
+# Compares two built databases table by table with a merge scan: both
+# sides are read in key order with ORDER BY, so neither is loaded into
+# memory. Each table is keyed by its primary key, or else its first
+# UNIQUE constraint, or else all of its columns. The patch is a SQL
+# script of multi-row DELETE statements for every table, followed by
+# multi-row REPLACE INTO statements for the added and changed rows.
+# Deleting first means a REPLACE can only conflict with the old version
+# of a row that is itself being replaced.
+#
+# The patch ends with content digests of the source and the target, so
+# that it is only applied to the database it was made from, and the
+# result is checked before the transaction is committed. Digests cover
+# the rows of every table in key order, but not rowids (except INTEGER
+# PRIMARY KEY columns) or ANALYZE statistics.
+#
+##############################################################################
+
+PATCH_HEADER = '-- khiin-patch 1'
+FROM_PREFIX = '-- from: '
+TO_PREFIX = '-- to: '
+
+class SchemaMismatch(Exception):
+    pass
+
+def connect(db_file, read_only=True):
+    if read_only:
+        return sqlite3.connect(f'file:{db_file}?mode=ro', uri=True)
+    return sqlite3.connect(db_file, isolation_level=None)
+
+def schema(con):
+    return con.execute("""SELECT type, name, tbl_name, sql FROM sqlite_master
+        WHERE name NOT LIKE 'sqlite_%' ORDER BY type, name""").fetchall()
+
+def virtual_tables(con):
+    return [x[0] for x in con.execute("""SELECT name FROM sqlite_master
+        WHERE type = 'table' AND sql LIKE 'CREATE VIRTUAL%' ORDER BY rowid""")]
+
+def data_tables(con):
+    """Ordinary tables, in the order they were created
+
+    The shadow tables of virtual tables (FTS5 indexes) are left out;
+    patches rebuild those indexes from their content tables instead.
+    """
+    shadow = tuple(name + '_' for name in virtual_tables(con))
+    return [x[0] for x in con.execute("""SELECT name FROM sqlite_master
+        WHERE type = 'table' AND name NOT LIKE 'sqlite_%' AND sql NOT LIKE 'CREATE VIRTUAL%'
+        ORDER BY rowid""") if not x[0].startswith(shadow)]
+
+def has_stats(con):
+    return con.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone() is not None
+
+def table_key(con, table):
+    """(columns, key columns)"""
+    info = con.execute(f'PRAGMA table_info({quote_identifier(table)})').fetchall()
+    columns = [x[1] for x in info]
+    pk = [x[1] for x in sorted(info, key=lambda x: x[5]) if x[5] > 0]
+    if pk:
+        return columns, pk
+    for index in con.execute(f'PRAGMA index_list({quote_identifier(table)})').fetchall():
+        if index[2] and not index[4]:
+            return columns, [x[2] for x in con.execute(f'PRAGMA index_info({quote_identifier(index[1])})')]
+    return columns, columns
+
+def sort_value(value):
+    """Python equivalent of SQLite's BINARY ordering across storage classes"""
+    if value is None:
+        return (0, 0)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    return (3, value)
+
+def scan(con, table, columns, key):
+    """Rows of `table` in key order"""
+    sql = (f'SELECT {", ".join(map(quote_identifier, columns))} FROM {quote_identifier(table)} '
+        f'ORDER BY {", ".join(map(quote_identifier, key))}')
+    return con.execute(sql)
+
+def table_digest(con, table):
+    columns, key = table_key(con, table)
+    h = hashlib.sha256()
+    for row in scan(con, table, columns, key):
+        h.update(repr(row).encode())
+    return h.hexdigest()
+
+def db_digest(con):
+    h = hashlib.sha256()
+    for table in data_tables(con):
+        h.update(f'{table}={table_digest(con, table)}\n'.encode())
+    return 'sha256:' + h.hexdigest()
+
+##############################################################################
+#
+# Diff
+#
+##############################################################################
+
+class TableDiff:
+    __slots__ = ('table', 'columns', 'key', 'deleted', 'replaced')
+
+    def __init__(self, table, columns, key):
+        self.table = table
+        self.columns = columns
+        self.key = key
+        self.deleted = []
+        self.replaced = []
+
+def diff_table(old_con, new_con, table, old_hash, new_hash):
+    """Merge scan of one table; also feeds both sides to the digests"""
+    columns, key = table_key(new_con, table)
+    ki = [columns.index(x) for x in key]
+    sort_key = lambda row: tuple(sort_value(row[i]) for i in ki)
+    key_of = lambda row: tuple(row[i] for i in ki)
+    diff = TableDiff(table, columns, key)
+
+    old_rows = scan(old_con, table, columns, key)
+    new_rows = scan(new_con, table, columns, key)
+    old = next(old_rows, None)
+    new = next(new_rows, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and sort_key(old) < sort_key(new)):
+            old_hash.update(repr(old).encode())
+            diff.deleted.append(key_of(old))
+            old = next(old_rows, None)
+        elif old is None or sort_key(new) < sort_key(old):
+            new_hash.update(repr(new).encode())
+            diff.replaced.append(new)
+            new = next(new_rows, None)
+        else:
+            old_hash.update(repr(old).encode())
+            new_hash.update(repr(new).encode())
+            if old != new:
+                if None in key_of(new):
+                    # NULLs never conflict, so REPLACE would not remove the old row
+                    diff.deleted.append(key_of(old))
+                diff.replaced.append(new)
+            old = next(old_rows, None)
+            new = next(new_rows, None)
+    return diff
+
+def diff_databases(old_file, new_file):
+    """(list of TableDiff, source digest, target digest, has ANALYZE stats,
+    FTS5 tables)"""
+    old_con = connect(old_file)
+    new_con = connect(new_file)
+    if schema(old_con) != schema(new_con):
+        raise SchemaMismatch(f'{old_file} and {new_file} have different schemas; ship the full database')
+    old_digest = hashlib.sha256()
+    new_digest = hashlib.sha256()
+    diffs = []
+    for table in data_tables(new_con):
+        old_hash = hashlib.sha256()
+        new_hash = hashlib.sha256()
+        diffs.append(diff_table(old_con, new_con, table, old_hash, new_hash))
+        old_digest.update(f'{table}={old_hash.hexdigest()}\n'.encode())
+        new_digest.update(f'{table}={new_hash.hexdigest()}\n'.encode())
+    stats = has_stats(new_con)
+    fts = [x[0] for x in new_con.execute("""SELECT name FROM sqlite_master
+        WHERE type = 'table' AND sql LIKE 'CREATE VIRTUAL TABLE%USING fts5%' ORDER BY rowid""")]
+    old_con.close()
+    new_con.close()
+    return diffs, 'sha256:' + old_digest.hexdigest(), 'sha256:' + new_digest.hexdigest(), stats, fts
+
+##############################################################################
+#
+# Patch files
+#
+##############################################################################
+
+def open_patch(patch_file, mode):
+    if str(patch_file).endswith('.gz'):
+        return gzip.open(patch_file, mode + 't', encoding='utf-8')
+    return open(patch_file, mode, encoding='utf-8')
+
+def delete_sql(diff, keys):
+    table = quote_identifier(diff.table)
+    null_keys = [k for k in keys if None in k]
+    keys = [k for k in keys if None not in k]
+    for k in null_keys:
+        cond = ' AND '.join(f'{quote_identifier(c)} IS {quote_value(v)}' for c, v in zip(diff.key, k))
+        yield f'DELETE FROM {table} WHERE {cond};\n'
+    for i in range(0, len(keys), ROWS_PER_INSERT):
+        chunk = keys[i:i + ROWS_PER_INSERT]
+        if len(diff.key) == 1:
+            values = ', '.join(quote_value(k[0]) for k in chunk)
+            yield f'DELETE FROM {table} WHERE {quote_identifier(diff.key[0])} IN ({values});\n'
+        else:
+            cols = ', '.join(map(quote_identifier, diff.key))
+            values = ', '.join('(' + ', '.join(map(quote_value, k)) + ')' for k in chunk)
+            yield f'DELETE FROM {table} WHERE ({cols}) IN (VALUES {values});\n'
+
+def replace_sql(diff, rows):
+    head = f'REPLACE INTO {quote_identifier(diff.table)} ({", ".join(map(quote_identifier, diff.columns))}) VALUES\n'
+    for i in range(0, len(rows), ROWS_PER_INSERT):
+        values = ',\n'.join('(' + ', '.join(map(quote_value, row)) + ')' for row in rows[i:i + ROWS_PER_INSERT])
+        yield head + values + ';\n'
+
+def write_patch(patch_file, diffs, old_digest, new_digest, stats=False, fts=()):
+    with open_patch(patch_file, 'w') as f:
+        f.write(PATCH_HEADER + '\n')
+        for diff in reversed(diffs):
+            f.writelines(delete_sql(diff, diff.deleted))
+        for diff in diffs:
+            f.writelines(replace_sql(diff, diff.replaced))
+        if any(x.deleted or x.replaced for x in diffs):
+            for table in fts:
+                f.write(f"INSERT INTO {quote_identifier(table)} ({quote_identifier(table)}) VALUES ('rebuild');\n")
+        if stats and any(x.deleted or x.replaced for x in diffs):
+            f.write('ANALYZE;\n')
+        f.write(FROM_PREFIX + old_digest + '\n')
+        f.write(TO_PREFIX + new_digest + '\n')
+
+def make_patch(old_file, new_file, patch_file):
+    """Write the patch from `old_file` to `new_file`; returns the diffs"""
+    diffs, old_digest, new_digest, stats, fts = diff_databases(old_file, new_file)
+    write_patch(patch_file, diffs, old_digest, new_digest, stats, fts)
+    return diffs
+
+def read_patch(patch_file):
+    """(list of SQL statements, source digest, target digest)"""
+    statements = []
+    digests = {}
+    buf = ''
+    with open_patch(patch_file, 'r') as f:
+        first = f.readline().rstrip('\n')
+        if first != PATCH_HEADER:
+            raise ValueError(f'{patch_file} is not a khiin patch')
+        for line in f:
+            if not buf and line.startswith('-- '):
+                for prefix in (FROM_PREFIX, TO_PREFIX):
+                    if line.startswith(prefix):
+                        digests[prefix] = line[len(prefix):].strip()
+                continue
+            buf += line
+            if sqlite3.complete_statement(buf):
+                statements.append(buf)
+                buf = ''
+    if buf.strip() or len(digests) != 2:
+        raise ValueError(f'{patch_file} is truncated')
+    return statements, digests[FROM_PREFIX], digests[TO_PREFIX]
+
+def apply_patch(db_file, patch_file, check_source=True):
+    """Apply a patch in one transaction, which is rolled back unless the
+    result matches the target digest"""
+    statements, old_digest, new_digest = read_patch(patch_file)
+    con = connect(db_file, read_only=False)
+    try:
+        if check_source and db_digest(con) != old_digest:
+            raise ValueError(f'{patch_file} was not made from {db_file}')
+        con.execute('BEGIN IMMEDIATE')
+        try:
+            for sql in statements:
+                con.execute(sql)
+            if db_digest(con) != new_digest:
+                raise ValueError(f'{db_file} does not match the target of {patch_file} after patching')
+            con.execute('COMMIT')
+        except BaseException:
+            con.execute('ROLLBACK')
+            raise
+    finally:
+        con.close()
+    return len(statements)
+
+def verify_patch(old_file, new_file, patch_file):
+    """Apply the patch to a copy of `old_file` and compare it with `new_file`"""
+    with tempfile.TemporaryDirectory(prefix='khiin-patch-') as tmp:
+        copy = Path(tmp) / 'patched.db'
+        shutil.copyfile(old_file, copy)
+        apply_patch(copy, patch_file)
+        patched = connect(copy)
+        target = connect(new_file)
+        bad = [t for t in data_tables(target) if table_digest(patched, t) != table_digest(target, t)]
+        patched.close()
+        target.close()
+    return bad
+
+##############################################################################
+#
+# __main__
+#
+##############################################################################
+
+parser = argparse.ArgumentParser(
+    description="""Make or apply a row-level patch between two khiin.db builds
+
+With --old and --new, writes the patch that turns the old database into
+the new one (gzipped if FILE ends in .gz). With --apply, applies a patch
+to a database in place. Both databases must have the same schema.""",
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+
+parser.add_argument('-a', '--old', metavar='DB', help='the database clients have')
+parser.add_argument('-b', '--new', metavar='DB', help='the database to update them to')
+parser.add_argument('-o', '--output', metavar='FILE', help='the patch file to write')
+parser.add_argument('--verify', action='store_true', help='apply the new patch to a copy of --old and check it matches --new')
+parser.add_argument('--apply', metavar='FILE', help='a patch file to apply to --old in place')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.apply:
+        if not args.old:
+            parser.error('--apply needs --old, the database to patch')
+        try:
+            n = apply_patch(args.old, args.apply)
+        except ValueError as e:
+            parser.exit(1, f'{e}\n')
+        print(f'Applied {n} statements from {args.apply} to {args.old}')
+    else:
+        if not (args.old and args.new and args.output):
+            parser.error('--old, --new and --output are required to make a patch')
+        try:
+            diffs = make_patch(args.old, args.new, args.output)
+        except SchemaMismatch as e:
+            parser.exit(1, f'{e}\n')
+        print(f'Patch written to {args.output} ({Path(args.output).stat().st_size} bytes):')
+        for diff in diffs:
+            if diff.deleted or diff.replaced:
+                print(f' - {diff.table}: -{len(diff.deleted)} ~{len(diff.replaced)}')
+        if args.verify:
+            bad = verify_patch(args.old, args.new, args.output)
+            if bad:
+                parser.exit(1, f'Patched tables differ from {args.new}: {", ".join(bad)}\n')
+            print(f'Verified: patching {args.old} gives {args.new}')
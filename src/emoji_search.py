@@ -0,0 +1,67 @@
+import re
+
+##############################################################################
+#
+# Emoji search
+#
+# The "emoji_fts" table is an FTS5 index of "emoji"."short_name" with
+# prefix indexes for the first 1-3 characters of every word, so type-
+# ahead search is an index lookup: every word typed so far must start a
+# word of the name, and the last one may be incomplete. Databases built
+# with an SQLite that lacks FTS5 fall back to LIKE.
+#
+##############################################################################
+
+WORD = re.compile(r'\w+')
+
+EMOJI_COLUMNS = 'e.id, e.emoji, e.short_name, e.category, e.code'
+
+def match_expression(text):
+    """FTS5 query for `text` as typed, or None if it has no words"""
+    words = WORD.findall(text.lower())
+    if not words:
+        return None
+    terms = [f'"{w}"' for w in words]
+    if not text[-1].isspace():
+        terms[-1] += '*'
+    return ' '.join(terms)
+
+def has_fts(db_cur):
+    return db_cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'emoji_fts'").fetchone() is not None
+
+def search_emoji(db_cur, text, limit=20, category=None):
+    """(id, emoji, short_name, category, code) rows matching `text`, in
+    Unicode order
+
+    FTS5 returns matches in rowid order, so the LIMIT stops the scan
+    early; ranking by bm25 would score every match of a short prefix.
+    """
+    expr = match_expression(text)
+    if expr is None:
+        return []
+    where = ' AND e.category = ?' if category is not None else ''
+    params = [category] if category is not None else []
+    if has_fts(db_cur):
+        return db_cur.execute(f"""SELECT {EMOJI_COLUMNS}
+        FROM emoji_fts JOIN emoji AS e ON e.id = emoji_fts.rowid
+        WHERE emoji_fts MATCH ?{where}
+        ORDER BY emoji_fts.rowid
+        LIMIT ?""", [expr] + params + [limit]).fetchall()
+    likes = ' AND '.join("(' ' || e.short_name) LIKE ?" for _ in WORD.findall(text))
+    patterns = [f'% {w}%' for w in WORD.findall(text.lower())]
+    return db_cur.execute(f"""SELECT {EMOJI_COLUMNS}
+    FROM emoji AS e
+    WHERE {likes}{where}
+    ORDER BY e.id
+    LIMIT ?""", patterns + params + [limit]).fetchall()
+
+def emoji_in_category(db_cur, category):
+    """Emoji of one category in Unicode order (a range of emoji_category_index)"""
+    return db_cur.execute(f"""SELECT {EMOJI_COLUMNS} FROM emoji AS e
+    WHERE e.category = ? ORDER BY e.id""", [category]).fetchall()
+
+def recent_emoji(db_cur):
+    """Emoji marked recent in emoji.csv (new in the latest Unicode version)"""
+    return db_cur.execute(f"""SELECT {EMOJI_COLUMNS}
+    FROM emoji_recent AS r JOIN emoji AS e ON e.id = r.id
+    ORDER BY e.id""").fetchall()
@@ -0,0 +1,105 @@
+import heapq
+import itertools
+import os
+import pickle
+import tempfile
+import weakref
+
+##############################################################################
+#
+# Bounded-memory external merge sort
+#
+##############################################################################
+
+RUN_SIZE = 200000
+MAX_FAN_IN = 64
+PICKLE_BATCH = 1000
+
+class SpilledRun:
+    """A sorted run written to a temp file, deleted on close()"""
+
+    def __init__(self, items, tmp_dir=None):
+        fd, self.path = tempfile.mkstemp(prefix='khiin-run-', dir=tmp_dir)
+        self._finalizer = weakref.finalize(self, _remove, self.path)
+        self.count = 0
+        it = iter(items)
+        with os.fdopen(fd, 'wb') as f:
+            while True:
+                batch = list(itertools.islice(it, PICKLE_BATCH))
+                if not batch:
+                    break
+                pickle.dump(batch, f, pickle.HIGHEST_PROTOCOL)
+                self.count += len(batch)
+
+    def __iter__(self):
+        with open(self.path, 'rb') as f:
+            while True:
+                try:
+                    batch = pickle.load(f)
+                except EOFError:
+                    return
+                yield from batch
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self._finalizer()
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+class SortedRuns:
+    """Re-iterable result of external_sort
+
+    Iterating performs a k-way merge over the spilled runs, so the
+    sorted data can be consumed several times without ever holding it
+    in memory.
+    """
+
+    def __init__(self, runs, key):
+        self.runs = runs
+        self.key = key
+
+    def __iter__(self):
+        if len(self.runs) == 1:
+            return iter(self.runs[0])
+        return heapq.merge(*self.runs, key=self.key)
+
+    def __len__(self):
+        return sum(len(run) for run in self.runs)
+
+    def close(self):
+        for run in self.runs:
+            run.close()
+
+def _reduce_runs(runs, key, tmp_dir):
+    while len(runs) > MAX_FAN_IN:
+        merged = []
+        for i in range(0, len(runs), MAX_FAN_IN):
+            group = runs[i:i + MAX_FAN_IN]
+            merged.append(SpilledRun(heapq.merge(*group, key=key), tmp_dir))
+            for run in group:
+                run.close()
+        runs = merged
+    return runs
+
+def external_sort(items, key, run_size=RUN_SIZE, tmp_dir=None):
+    """Sort any iterable with at most `run_size` items in memory
+
+    The sort is stable: runs are cut in input order and heapq.merge
+    prefers earlier runs on ties.
+    """
+    runs = []
+    it = iter(items)
+    while True:
+        buf = list(itertools.islice(it, run_size))
+        if not buf:
+            break
+        buf.sort(key=key)
+        runs.append(SpilledRun(buf, tmp_dir))
+        del buf
+    return SortedRuns(_reduce_runs(runs, key, tmp_dir), key)
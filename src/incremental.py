@@ -0,0 +1,83 @@
+import hashlib
+import sqlite3
+
+##############################################################################
+#
+# Build fingerprints
+#
+##############################################################################
+
+# Bump when a change to the pipeline alters the output for the same
+# source files, so that existing databases are not treated as up to date
+PIPELINE_VERSION = 1
+
+FINGERPRINT_KEY = 'source_fingerprint'
+
+def file_digest(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+def fingerprint(files, flags):
+    """Digest of the source files' contents and the build flags
+
+    `files` and `flags` are dicts; missing files are recorded as absent
+    rather than skipped, so adding or removing a source changes the
+    fingerprint.
+    """
+    h = hashlib.sha256()
+    h.update(f'pipeline={PIPELINE_VERSION}\n'.encode())
+    for name in sorted(files):
+        path = files[name]
+        digest = file_digest(path) if path else '-'
+        h.update(f'{name}={digest}\n'.encode())
+    for name in sorted(flags):
+        h.update(f'{name}={flags[name]}\n'.encode())
+    # Prefixed so SQLite never coerces the value to a number
+    return 'sha256:' + h.hexdigest()
+
+def read_fingerprint(db_cur):
+    try:
+        row = db_cur.execute('SELECT "value" FROM "metadata" WHERE "key" = ?', [FINGERPRINT_KEY]).fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return row[0] if row else None
+
+def write_fingerprint(db_cur, value):
+    db_cur.execute('DELETE FROM "metadata" WHERE "key" = ?', [FINGERPRINT_KEY])
+    db_cur.execute('INSERT INTO "metadata" ("key", "value") VALUES (?, ?)', [FINGERPRINT_KEY, value])
+
+##############################################################################
+#
+# Row-level diffs
+#
+##############################################################################
+
+class Diff:
+    __slots__ = ('added', 'removed', 'changed')
+
+    def __init__(self, added, removed, changed):
+        self.added = added
+        self.removed = removed
+        self.changed = changed
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    def __repr__(self):
+        return f'+{len(self.added)} -{len(self.removed)} ~{len(self.changed)}'
+
+def diff_dict(old, new):
+    """Keyed diff; `added` and `changed` map keys to their new values"""
+    added = {k: v for k, v in new.items() if k not in old}
+    removed = [k for k in old if k not in new]
+    changed = {k: v for k, v in new.items() if k in old and old[k] != v}
+    return Diff(added, removed, changed)
+
+def diff_set(old, new):
+    return Diff(new - old, old - new, {})
@@ -0,0 +1,193 @@
+from contextlib import contextmanager
+import cProfile
+from datetime import datetime
+import json
+import platform
+import sqlite3
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+##############################################################################
+#
+# Build instrumentation
+#
+# Stages are opened with `stage(name)` anywhere in the pipeline and
+# recorded by the module-level `recorder`: wall time, CPU time, the peak
+# RSS of the process and the rows that went in and out. Row counts come
+# from `count_rows()`, which the batched loaders call once per batch, so
+# recording costs nothing per row. Progress is printed from the same row
+# counts at most every PROGRESS_INTERVAL seconds, and only once a script
+# has called `start()`. cProfile and tracemalloc are off unless asked for.
+#
+##############################################################################
+
+PROGRESS_INTERVAL = 2.0
+
+def max_rss_kb(who='self'):
+    """High-water mark of the resident set size, in KiB"""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN)
+    return usage.ru_maxrss // 1024 if sys.platform == 'darwin' else usage.ru_maxrss
+
+class Stage:
+    __slots__ = ('name', 'depth', 'rows_in', 'rows_out', 'wall', 'cpu', 'max_rss_kb', 'py_peak_kb',
+        '_wall_start', '_cpu_start', '_py_peak')
+
+    def __init__(self, name, depth, rows_in=None):
+        self.name = name
+        self.depth = depth
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.wall = None
+        self.cpu = None
+        self.max_rss_kb = None
+        self.py_peak_kb = None
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.process_time()
+        self._py_peak = 0
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'depth': self.depth,
+            'wall_seconds': round(self.wall, 4),
+            'cpu_seconds': round(self.cpu, 4),
+            'max_rss_kb': self.max_rss_kb,
+            'py_peak_kb': self.py_peak_kb,
+            'rows_in': self.rows_in,
+            'rows_out': self.rows_out,
+        }
+
+class Progress:
+    """Row counts per table, printed at most every `interval` seconds"""
+
+    def __init__(self, interval=PROGRESS_INTERVAL, stream=sys.stdout):
+        self.interval = interval
+        self.stream = stream
+        self.label = None
+        self.rows = 0
+        self.start = self.last = time.perf_counter()
+
+    def update(self, label, n):
+        if label != self.label:
+            self.label = label
+            self.rows = 0
+        self.rows += n
+        now = time.perf_counter()
+        if now - self.last >= self.interval:
+            self.last = now
+            self.stream.write(f'   {label}: {self.rows} rows ({now - self.start:.0f}s)\n')
+            self.stream.flush()
+
+class Recorder:
+    def __init__(self):
+        self.stages = []
+        self.stack = []
+        self.progress = None
+        self.profiler = None
+        self.trace_memory = False
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        if self.trace_memory:
+            if self.stack:
+                parent = self.stack[-1]
+                parent._py_peak = max(parent._py_peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        st = Stage(name, len(self.stack), rows_in)
+        self.stages.append(st)
+        self.stack.append(st)
+        try:
+            yield st
+        finally:
+            self.stack.pop()
+            st.wall = time.perf_counter() - st._wall_start
+            st.cpu = time.process_time() - st._cpu_start
+            st.max_rss_kb = max_rss_kb()
+            if self.trace_memory:
+                peak = max(st._py_peak, tracemalloc.get_traced_memory()[1])
+                st.py_peak_kb = peak // 1024
+                if self.stack:
+                    self.stack[-1]._py_peak = max(self.stack[-1]._py_peak, peak)
+
+    def count_rows(self, label, n):
+        for st in self.stack:
+            st.rows_out = (st.rows_out or 0) + n
+        if self.progress is not None:
+            self.progress.update(label, n)
+
+    def report(self):
+        return {
+            'script': sys.argv[0],
+            'argv': sys.argv[1:],
+            'started': datetime.now().astimezone().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'wall_seconds': round(time.perf_counter() - self.wall_start, 4),
+            'cpu_seconds': round(time.process_time() - self.cpu_start, 4),
+            'max_rss_kb': max_rss_kb(),
+            'children_max_rss_kb': max_rss_kb('children'),
+            'tracemalloc': self.trace_memory,
+            'stages': [x.to_dict() for x in self.stages if x.wall is not None],
+        }
+
+recorder = Recorder()
+
+def stage(name, rows_in=None):
+    """Context manager recording one stage; yields its Stage record"""
+    return recorder.stage(name, rows_in)
+
+def count_rows(label, n):
+    recorder.count_rows(label, n)
+
+##############################################################################
+#
+# Command line
+#
+##############################################################################
+
+def add_arguments(parser):
+    group = parser.add_argument_group('instrumentation')
+    group.add_argument('--report', metavar='FILE', help='write per-stage time, memory and row counts as JSON')
+    group.add_argument('--cprofile', metavar='FILE', help='run under cProfile and write the stats to FILE (for pstats/snakeviz)')
+    group.add_argument('--tracemalloc', action='store_true', help='record the peak Python allocation of each stage (slow)')
+
+def start(args, progress=True):
+    recorder.progress = Progress() if progress else None
+    if args.tracemalloc:
+        tracemalloc.start()
+        recorder.trace_memory = True
+    if args.cprofile:
+        recorder.profiler = cProfile.Profile()
+        recorder.profiler.enable()
+
+def print_stages(stages):
+    for x in stages:
+        indent = '  ' * x['depth']
+        rows = f"  {x['rows_out']} rows" if x['rows_out'] is not None else ''
+        rss = f"  {x['max_rss_kb'] // 1024} MiB" if x['max_rss_kb'] is not None else ''
+        print(f" - {indent + x['name']:<28} {x['wall_seconds']:8.2f}s wall {x['cpu_seconds']:8.2f}s cpu{rss}{rows}")
+
+def finish(args):
+    if recorder.profiler is not None:
+        recorder.profiler.disable()
+        recorder.profiler.dump_stats(args.cprofile)
+        print(f'Profile written to {args.cprofile}')
+    report = recorder.report()
+    if recorder.trace_memory:
+        tracemalloc.stop()
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f'Stage report written to {args.report}:')
+        print_stages(report['stages'])
+    return report
@@ -0,0 +1,206 @@
+from functools import lru_cache
+import re
+
+from lomaji import SYLLABLE_SPLIT, poj_to_khiin
+
+##############################################################################
+#
+# Compact key sequences
+#
+# Instead of storing the full product of toned and toneless variants of
+# every syllable, each word is stored once with its toned numeric, toned
+# telex and toneless keys (space-separated, one entry per syllable).
+#
+# Lookups seek on a "skeleton": the key sequence with every character
+# that can be a tone mark removed (digits for numeric input, s/f/l/j/w
+# for telex). Each valid key sequence of a word has the same skeleton as
+# the word itself, so the skeleton index returns a small superset of the
+# matches, which is then checked syllable by syllable.
+#
+##############################################################################
+
+NUMERIC_TONES = re.compile(r'\d')
+TELEX_TONES = re.compile(r'[sfljw]')
+
+PATTERN_CACHE_SIZE = 4096
+
+def numeric_skeleton(key_sequence):
+    return NUMERIC_TONES.sub('', key_sequence)
+
+def telex_skeleton(key_sequence):
+    return TELEX_TONES.sub('', key_sequence)
+
+def word_keys(word):
+    """Toned numeric, toned telex and toneless keys of each syllable"""
+    numeric = []
+    telex = []
+    toneless = []
+    for syl in SYLLABLE_SPLIT.split(word):
+        syl_numeric, syl_telex = poj_to_khiin(syl, True)
+        numeric.append(syl_numeric[0])
+        telex.append(syl_telex[0])
+        toneless.append(syl_numeric[-1])
+    return (' '.join(numeric), ' '.join(telex), ' '.join(toneless))
+
+@lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def key_pattern(toned, toneless):
+    alternatives = []
+    for a, b in zip(toned.split(' '), toneless.split(' ')):
+        if a == b:
+            alternatives.append(re.escape(a))
+        else:
+            alternatives.append(f'(?:{re.escape(a)}|{re.escape(b)})')
+    return re.compile(''.join(alternatives))
+
+def matches(key_sequence, toned, toneless):
+    """True if each syllable of `key_sequence` is either toned or toneless"""
+    return key_pattern(toned, toneless).fullmatch(key_sequence) is not None
+
+##############################################################################
+#
+# Lookup
+#
+##############################################################################
+
+def _lookup(db_cur, key_sequence, keys_column, skeleton_column, skeleton):
+    res = db_cur.execute(f"""SELECT
+        {keys_column},
+        toneless,
+        input,
+        input_id,
+        output,
+        weight,
+        category,
+        annotation
+    FROM lookup_compact
+    WHERE {skeleton_column} = ?""", [skeleton])
+    ret = []
+    for row in res:
+        if matches(key_sequence, row[0], row[1]):
+            ret.append((key_sequence,) + tuple(row[2:]))
+    return ret
+
+def lookup_numeric(db_cur, key_sequence):
+    """Same rows as `SELECT * FROM lookup_numeric WHERE key_sequence = ?`"""
+    return _lookup(db_cur, key_sequence, 'numeric', 'numeric_skeleton', numeric_skeleton(key_sequence))
+
+def lookup_telex(db_cur, key_sequence):
+    """Same rows as `SELECT * FROM lookup_telex WHERE key_sequence = ?`"""
+    return _lookup(db_cur, key_sequence, 'telex', 'telex_skeleton', telex_skeleton(key_sequence))
+
+##############################################################################
+#
+# Prefix lookup
+#
+# The "prefix_numeric" and "prefix_telex" tables hold every prefix of up
+# to PREFIX_LENGTH characters of each input's key sequences, once per
+# input, clustered on (prefix, freq DESC, chhan_id, input_id), so the
+# first rows for a prefix are the most frequent inputs. The rank is
+# stored rather than read from the frequency ids, which are only in
+# frequency order after a full build: --incremental gives new inputs the
+# next free ids. Longer buffers match few enough inputs that a range
+# scan over the key sequence index is just as fast.
+#
+##############################################################################
+
+PREFIX_LENGTH = 4
+
+def key_prefixes(key_sequences):
+    """Distinct prefixes of up to PREFIX_LENGTH characters"""
+    ret = set()
+    for seq in key_sequences:
+        for i in range(1, min(len(seq), PREFIX_LENGTH) + 1):
+            ret.add(seq[:i])
+    return sorted(ret)
+
+def prefix_bounds(prefix):
+    """Half-open range of the key sequences that start with `prefix`"""
+    return (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1))
+
+# The order of the candidates of one buffer: most frequent input first,
+# like the frequency ids of a full build
+PREFIX_ORDER = 'f.freq DESC, f.chhan_id, f.id, c.weight DESC'
+
+def prefix_input_ids_sql(mode, buffer, prefix_index=True):
+    """(SQL, parameters) of the ids of the first inputs matching `buffer`;
+    the SQL takes the number of inputs as its last parameter"""
+    if prefix_index and len(buffer) <= PREFIX_LENGTH:
+        return (f"""SELECT input_id FROM prefix_{mode}
+        WHERE prefix = ? ORDER BY freq DESC, chhan_id, input_id LIMIT ?""", [buffer])
+    return (f"""SELECT f.id AS input_id FROM frequency AS f
+        WHERE f.id IN (SELECT input_id FROM input_{mode} WHERE key_sequence >= ? AND key_sequence < ?)
+        ORDER BY f.freq DESC, f.chhan_id, f.id LIMIT ?""", list(prefix_bounds(buffer)))
+
+def lookup_prefix_sql(mode, buffer, prefix_index=True):
+    """(SQL, parameters) of `lookup_prefix`; the SQL takes the number of
+    inputs as its last parameter. Without `prefix_index` every buffer
+    takes the range scan, which any database can run."""
+    ids_sql, params = prefix_input_ids_sql(mode, buffer, prefix_index)
+    return (f"""SELECT
+        f.input,
+        f.id,
+        c.output,
+        c.weight,
+        c.category,
+        c.annotation
+    FROM ({ids_sql}) AS p
+    JOIN frequency AS f ON f.id = p.input_id
+    JOIN conversions AS c ON c.input_id = p.input_id
+    ORDER BY {PREFIX_ORDER}""", params)
+
+def lookup_prefix(db_cur, buffer, mode='numeric', limit=None):
+    """Candidates of every input with a key sequence starting with `buffer`
+
+    Returns (input, input_id, output, weight, category, annotation) rows
+    of at most `limit` inputs, most frequent input first. Needs a
+    database built with --prefix-index.
+    """
+    if not buffer:
+        return []
+    sql, params = lookup_prefix_sql(mode, buffer)
+    return db_cur.execute(sql, params + [-1 if limit is None else limit]).fetchall()
+
+##############################################################################
+#
+# Ranked candidates
+#
+# With --top-candidates N, "top_numeric" and "top_telex" hold the first
+# N candidates of every key sequence in RANK_ORDER, clustered on
+# (key_sequence, rank), so that the common lookup is a single index
+# range with no join or sort. Each row also records the total number of
+# candidates of its key sequence, so a lookup can tell whether the
+# table has all of them or has to fall back to the lookup view.
+#
+##############################################################################
+
+# Column names are unique across frequency, conversions and the views
+RANK_ORDER = '"freq" DESC, "chhan_id", "weight" DESC, "category", "output"'
+
+def lookup_ranked(db_cur, key_sequence, mode='numeric', limit=None):
+    """The first `limit` (or all) candidates of `key_sequence` in RANK_ORDER
+
+    Rows have the columns of the lookup_numeric and lookup_telex views.
+    Needs a database built with --top-candidates.
+    """
+    res = db_cur.execute(f"""SELECT
+        key_sequence,
+        input,
+        input_id,
+        output,
+        weight,
+        category,
+        annotation,
+        candidates
+    FROM top_{mode}
+    WHERE key_sequence = ?
+    ORDER BY rank
+    LIMIT ?""", [key_sequence, -1 if limit is None else limit]).fetchall()
+    if not res or len(res) == res[0][-1] or len(res) == limit:
+        return [x[:-1] for x in res]
+    res = db_cur.execute(f"""SELECT v.*
+    FROM lookup_{mode} AS v
+    JOIN frequency AS f ON f.id = v.input_id
+    WHERE v.key_sequence = ?
+    ORDER BY {RANK_ORDER}
+    LIMIT ?""", [key_sequence, -1 if limit is None else limit])
+    return res.fetchall()
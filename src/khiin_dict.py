@@ -0,0 +1,366 @@
+import argparse
+import mmap
+import sqlite3
+import struct
+
+from keyseq import lookup_numeric, lookup_telex
+from lomaji import to_input_sequences
+
+##############################################################################
+#
+# Binary dictionary format (version 1)
+#
+# A read-only export of the lookup views, laid out so that it can be
+# mmap'ed and queried in place. All integers are little-endian and every
+# section starts on a 4-byte boundary.
+#
+#   header      MAGIC, version, then the section offsets (HEADER)
+#   strings     n + 1 u32 offsets into the UTF-8 string data, then the
+#               data; strings are deduplicated and referenced by index
+#   inputs      n + 1 records of (input_id, input string, first
+#               conversion); the conversions of input i are
+#               [first(i), first(i + 1))
+#   conversions (output string, weight, category, annotation string)
+#   tries       one per input mode (numeric, telex), see below
+#
+# Each trie is a header (node count, posting count) followed by its
+# nodes, one label byte per node and the postings. Node 0 is the root.
+# The children of a node are contiguous and sorted by label, so a child
+# is found with one bounded search of the label bytes. A node's postings
+# are the indexes into the inputs section of every input with that key
+# sequence, in "frequency" id order.
+#
+##############################################################################
+
+MAGIC = b'KHIINDCT'
+VERSION = 1
+
+HEADER = struct.Struct('<8sHH9I')
+STRING_OFFSET = struct.Struct('<I')
+INPUT = struct.Struct('<III')
+CONVERSION = struct.Struct('<IiiI')
+TRIE_HEADER = struct.Struct('<II')
+NODE = struct.Struct('<IIHH')
+POSTING = struct.Struct('<I')
+
+NONE_STRING = 0xFFFFFFFF
+NONE_INT = -0x80000000
+
+MODES = ['numeric', 'telex']
+
+def align(buf):
+    buf.extend(b'\0' * (-len(buf) % 4))
+    return len(buf)
+
+##############################################################################
+#
+# Writer
+#
+##############################################################################
+
+class StringPool:
+    def __init__(self):
+        self.index = {}
+        self.strings = []
+
+    def add(self, value):
+        if value is None:
+            return NONE_STRING
+        i = self.index.get(value)
+        if i is None:
+            i = self.index[value] = len(self.strings)
+            self.strings.append(value.encode('utf-8'))
+        return i
+
+    def pack(self, buf):
+        start = align(buf)
+        pos = 0
+        for s in self.strings:
+            buf.extend(STRING_OFFSET.pack(pos))
+            pos += len(s)
+        buf.extend(STRING_OFFSET.pack(pos))
+        for s in self.strings:
+            buf.extend(s)
+        return start
+
+def pack_trie(buf, keys):
+    """`keys` maps key sequence bytes to a list of input indexes"""
+    root = {}
+    for key, postings in keys.items():
+        node = root
+        for b in key:
+            node = node.setdefault(b, {})
+        node[None] = postings
+
+    # Breadth-first, so the children of each node are contiguous
+    order = [(0, root)]
+    children = []
+    i = 0
+    while i < len(order):
+        label, node = order[i]
+        first = len(order)
+        for b in sorted(x for x in node if x is not None):
+            order.append((b, node[b]))
+        children.append((first, len(order) - first))
+        i += 1
+
+    start = align(buf)
+    n_postings = sum(len(x) for x in keys.values())
+    buf.extend(TRIE_HEADER.pack(len(order), n_postings))
+    postings = []
+    for (label, node), (first, count) in zip(order, children):
+        values = node.get(None, [])
+        buf.extend(NODE.pack(first, len(postings), count, len(values)))
+        postings.extend(values)
+    buf.extend(bytes(label for label, node in order))
+    align(buf)
+    for p in postings:
+        buf.extend(POSTING.pack(p))
+    return start
+
+def has_table(db_cur, name):
+    return db_cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", [name]).fetchone() is not None
+
+def iter_key_sequences(db_cur, mode, inputs):
+    """(input_id, key_sequence) rows, also for --compact-inputs builds"""
+    if has_table(db_cur, f'input_{mode}'):
+        yield from db_cur.execute(f'SELECT input_id, key_sequence FROM input_{mode}')
+        return
+    col = MODES.index(mode)
+    for id, input in inputs:
+        for seqs in to_input_sequences(input):
+            yield (id, seqs[col])
+
+def export_dictionary(db_file, out_file):
+    con = sqlite3.connect(db_file)
+    cur = con.cursor()
+    strings = StringPool()
+
+    inputs = cur.execute('SELECT id, input FROM frequency ORDER BY id').fetchall()
+    input_index = {id: i for i, (id, input) in enumerate(inputs)}
+
+    conv = []
+    first = []
+    res = cur.execute("""SELECT f.id, c.output, c.weight, c.category, c.annotation
+        FROM frequency AS f
+        JOIN conversions AS c ON c.input_id = f.id
+        ORDER BY f.id, c.output""")
+    rows = iter(res)
+    row = next(rows, None)
+    for id, input in inputs:
+        first.append(len(conv))
+        while row is not None and row[0] == id:
+            weight = NONE_INT if row[2] is None else row[2]
+            category = NONE_INT if row[3] is None else row[3]
+            conv.append((strings.add(row[1]), weight, category, strings.add(row[4])))
+            row = next(rows, None)
+    first.append(len(conv))
+
+    tries = []
+    for mode in MODES:
+        keys = {}
+        for id, key_sequence in iter_key_sequences(cur, mode, inputs):
+            keys.setdefault(key_sequence.encode('utf-8'), set()).add(input_index[id])
+        tries.append({k: sorted(v) for k, v in keys.items()})
+    con.close()
+
+    input_strings = [strings.add(input) for id, input in inputs]
+
+    buf = bytearray(HEADER.size)
+    strings_off = strings.pack(buf)
+    inputs_off = align(buf)
+    for (id, input), s, f in zip(inputs + [(0, None)], input_strings + [NONE_STRING], first):
+        buf.extend(INPUT.pack(id, s, f))
+    conv_off = align(buf)
+    for c in conv:
+        buf.extend(CONVERSION.pack(*c))
+    trie_offs = [pack_trie(buf, keys) for keys in tries]
+
+    HEADER.pack_into(buf, 0, MAGIC, VERSION, 0,
+        len(strings.strings), strings_off,
+        len(inputs), inputs_off,
+        len(conv), conv_off,
+        *trie_offs, len(buf))
+
+    with open(out_file, 'wb') as f:
+        f.write(buf)
+    return len(inputs), len(conv), [len(x) for x in tries]
+
+##############################################################################
+#
+# Reader
+#
+##############################################################################
+
+class Trie:
+    def __init__(self, buf, offset):
+        self.buf = buf
+        self.n_nodes, n_postings = TRIE_HEADER.unpack_from(buf, offset)
+        self.nodes = offset + TRIE_HEADER.size
+        self.labels = self.nodes + self.n_nodes * NODE.size
+        self.postings = self.labels + self.n_nodes + (-self.n_nodes % 4)
+
+    def node(self, i):
+        return NODE.unpack_from(self.buf, self.nodes + i * NODE.size)
+
+    def find(self, key):
+        """Node index of the key sequence `key` (bytes), or None"""
+        i = 0
+        for b in key:
+            first, _, count, _ = self.node(i)
+            pos = self.buf.find(bytes([b]), self.labels + first, self.labels + first + count)
+            if pos < 0:
+                return None
+            i = pos - self.labels
+        return i
+
+    def postings_of(self, i):
+        _, start, _, count = self.node(i)
+        offset = self.postings + start * POSTING.size
+        return [x[0] for x in POSTING.iter_unpack(self.buf[offset:offset + count * POSTING.size])]
+
+    def walk(self, i, key):
+        """(key, node) of every node under `i` with postings, in key order"""
+        first, _, count, n_postings = self.node(i)
+        if n_postings:
+            yield key, i
+        for child in range(first, first + count):
+            yield from self.walk(child, key + self.buf[self.labels + child:self.labels + child + 1])
+
+class Dictionary:
+    """Read-only, mmap'ed view of a dictionary written by export_dictionary
+
+    Rows have the columns of the lookup_numeric and lookup_telex views:
+    (key_sequence, input, input_id, output, weight, category, annotation).
+    """
+
+    def __init__(self, file):
+        self.file = open(file, 'rb')
+        self.buf = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, _,
+            self.n_strings, self.strings_off,
+            self.n_inputs, self.inputs_off,
+            self.n_conv, self.conv_off,
+            numeric_off, telex_off, size) = HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{file} is not a khiin dictionary')
+        if version != VERSION:
+            raise ValueError(f'{file} has format version {version}, expected {VERSION}')
+        if size != len(self.buf):
+            raise ValueError(f'{file} is truncated')
+        self.string_data = self.strings_off + (self.n_strings + 1) * STRING_OFFSET.size
+        self.tries = {'numeric': Trie(self.buf, numeric_off), 'telex': Trie(self.buf, telex_off)}
+
+    def string(self, i):
+        if i == NONE_STRING:
+            return None
+        start, end = struct.unpack_from('<II', self.buf, self.strings_off + i * STRING_OFFSET.size)
+        return str(self.buf[self.string_data + start:self.string_data + end], 'utf-8')
+
+    def rows(self, key_sequence, index):
+        id, input, first = INPUT.unpack_from(self.buf, self.inputs_off + index * INPUT.size)
+        end = INPUT.unpack_from(self.buf, self.inputs_off + (index + 1) * INPUT.size)[2]
+        input = self.string(input)
+        for i in range(first, end):
+            output, weight, category, annotation = CONVERSION.unpack_from(self.buf, self.conv_off + i * CONVERSION.size)
+            yield (key_sequence, input, id, self.string(output),
+                None if weight == NONE_INT else weight,
+                None if category == NONE_INT else category,
+                self.string(annotation))
+
+    def lookup(self, key_sequence, mode='numeric'):
+        """Same rows as `SELECT * FROM lookup_{mode} WHERE key_sequence = ?`"""
+        trie = self.tries[mode]
+        node = trie.find(key_sequence.encode('utf-8'))
+        if node is None:
+            return []
+        ret = []
+        for index in trie.postings_of(node):
+            ret.extend(self.rows(key_sequence, index))
+        return ret
+
+    def key_sequences(self, prefix, mode='numeric'):
+        """Every key sequence starting with `prefix`, in sorted order"""
+        trie = self.tries[mode]
+        key = prefix.encode('utf-8')
+        node = trie.find(key)
+        if node is None:
+            return []
+        return [k.decode('utf-8') for k, _ in trie.walk(node, key)]
+
+    def close(self):
+        self.buf.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+##############################################################################
+#
+# Verification
+#
+##############################################################################
+
+def verify_dictionary(db_file, dict_file):
+    """Compare every lookup against the SQLite views; returns mismatches"""
+    con = sqlite3.connect(db_file)
+    cur = con.cursor()
+    errors = 0
+    with Dictionary(dict_file) as d:
+        for mode in MODES:
+            if has_table(cur, f'input_{mode}'):
+                keys = [x[0] for x in cur.execute(f'SELECT DISTINCT key_sequence FROM input_{mode} ORDER BY key_sequence')]
+                def expected(key):
+                    return cur.execute(f'SELECT * FROM lookup_{mode} WHERE key_sequence = ?', [key]).fetchall()
+            else:
+                fn = lookup_numeric if mode == 'numeric' else lookup_telex
+                keys = d.key_sequences('', mode)
+                def expected(key):
+                    return fn(cur, key)
+            for key in keys:
+                if sorted(d.lookup(key, mode), key=repr) != sorted(expected(key), key=repr):
+                    print(f' - {mode} {key!r}: rows differ')
+                    errors += 1
+            if d.key_sequences('', mode) != keys:
+                print(f' - {mode}: key sequences differ')
+                errors += 1
+            for key in ['', 'q', 'zzzz', keys[-1] + 'z' if keys else 'a']:
+                if d.lookup(key, mode) != expected(key):
+                    print(f' - {mode} {key!r}: missing key lookup differs')
+                    errors += 1
+    con.close()
+    return errors
+
+##############################################################################
+#
+# __main__
+#
+##############################################################################
+
+parser = argparse.ArgumentParser(
+    description="""Export a khiin.db to the binary dictionary format
+
+The dictionary holds the rows of the lookup_numeric and lookup_telex
+views in a form that can be mmap'ed and queried in place; see the
+Dictionary class for the reader.""",
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+
+parser.add_argument('-i', "--input", metavar='FILE', required=True, help='the khiin database file (khiin.db)')
+parser.add_argument('-o', "--output", metavar='FILE', required=True, help='the dictionary output file (khiin.dict)')
+parser.add_argument("--verify", action='store_true', help='check every lookup in the dictionary against the database views')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    n_inputs, n_conv, n_keys = export_dictionary(args.input, args.output)
+    print(f"""Dictionary written to {args.output}:
+ - {n_inputs} inputs
+ - {n_conv} conversions
+ - {n_keys[0]} numeric and {n_keys[1]} telex key sequences""")
+    if args.verify:
+        errors = verify_dictionary(args.input, args.output)
+        print('Verified: all lookups match' if not errors else f'Verification failed: {errors} mismatches')
+        if errors:
+            raise SystemExit(1)
@@ -1,10 +1,14 @@
 import argparse
 from datetime import datetime
+import itertools
 import re
 import sqlite3
 import time
 import unicodedata
 
+from batching import BATCH_SIZE, batched
+import instrument
+from instrument import count_rows, stage
 from lomaji import *
 
 def get_cursor(file):
@@ -13,37 +17,32 @@ def get_cursor(file):
     cur = con.cursor()
     return cur
 
-def get_freq_data(cur):
-    res = cur.execute("select * from frequency")
-    freq = res.fetchall()
-    return freq
-
-def get_conv_data(cur, id):
-    res = cur.execute("select * from conversions where input_id = ?", [id])
-    conv = res.fetchall()
-    return conv
-
 def has_non_hanji(text):
     text = unicodedata.normalize('NFD', text)
     return re.search(r'[A-Za-z]', text) is not None
 
-def get_wordlist(db_cur):
-    word_list = []
-    freq = get_freq_data(db_cur)
-    for freq_row in freq:
-        input = freq_row['input']
-        conv = get_conv_data(db_cur, freq_row['id'])
-        for conv_row in conv:
-            output = conv_row['output']
+def iter_wordlist(db_cur):
+    """(reading, qstring, value) of every conversion, in one pass
+
+    Rows come out in "frequency" id order, and by output within each
+    input, which is the order of the conversions covering index.
+    """
+    res = db_cur.execute("""SELECT f.input, c.output
+        FROM frequency AS f
+        JOIN conversions AS c ON c.input_id = f.id
+        ORDER BY f.id, c.output""")
+    for input, rows in itertools.groupby(res, key=lambda x: x[0]):
+        reading = poj_to_fhl_reading(input)
+        qstring = poj_to_fhl_qstring(input)
+        for row in rows:
+            output = row[1]
 
             # if has_non_hanji(output):
             #     continue
 
-            word_list.append({ 'reading': poj_to_fhl_reading(input),'qstring': poj_to_fhl_qstring(input), 'value': output, })
+            yield (reading, qstring, output)
 
-    return word_list
-
-def build_db(file, word_list):
+def init_db(file):
     now = datetime.now()
     con = sqlite3.connect(file)
     con.executescript(f'''
@@ -57,24 +56,15 @@ def build_db(file, word_list):
             ('version_timestamp', '{now.strftime("%Y%m%d")}'),
             ('cooked_timestamp_utc', '{round(time.time(), 1)}'),
             ('cooked_datetime_utc', '{now.strftime("%Y-%m-%d %H:%M UTC")}');
+    ''')
+    return con
 
+def index_db(con):
+    con.executescript('''
         CREATE INDEX words_index_key ON words (reading);
         CREATE INDEX qstring_word_mappings_index_qstring ON qstring_word_mappings (qstring);
     ''')
 
-    words_table = []
-    qstrings_table = []
-
-    for i, row in enumerate(word_list):
-        id = i + 1
-        words_table.append((id, row['reading'], row['value'], 1))
-        qstrings_table.append((row['qstring'], id))
-
-    c = con.cursor()
-    c.executemany('INSERT INTO words VALUES (?, ?, ?, ?)', words_table)
-    c.executemany('INSERT INTO qstring_word_mappings VALUES (?, ?)', qstrings_table)
-    con.commit()
-
 cin_top = """%ename chailaiji:en;
 %ename 台語
 %selkey 123456789
@@ -120,19 +110,54 @@ z z
 
 cin_bottom = "%chardef end"
 
-def build_txt(file, word_list):
-    seen = []
-    with open(file, 'w', encoding='utf8') as out:
-        out.write(cin_top)
-        for row in word_list:
-            qstr = row['qstring']
-            val = row['value']
-            if val.find(' ') > -1:
-                val = val.replace(' ', '-')
-            if (qstr, val) not in seen:
-                out.write(qstr + ' ' + val + "\n")
-                seen.append((qstr, val))
-        out.write(cin_bottom)
+class CinWriter:
+    """Writes each distinct (qstring, value) line of the .cin file once"""
+
+    def __init__(self, file):
+        self.file = open(file, 'w', encoding='utf8')
+        self.seen = set()
+        self.file.write(cin_top)
+
+    def write(self, qstr, val):
+        if val.find(' ') > -1:
+            val = val.replace(' ', '-')
+        if (qstr, val) not in self.seen:
+            self.file.write(qstr + ' ' + val + "\n")
+            self.seen.add((qstr, val))
+
+    def close(self):
+        self.file.write(cin_bottom)
+        self.file.close()
+
+def export(db_cur, db_file, cin_file=None):
+    """Stream the word list into `db_file` and, optionally, `cin_file`
+
+    All rows are inserted in batches inside one transaction, and the
+    indexes are built after the load.
+    """
+    con = init_db(db_file)
+    cur = con.cursor()
+    cin = CinWriter(cin_file) if cin_file else None
+    words = enumerate(iter_wordlist(db_cur), start=1)
+    n = 0
+    with stage('export_words'):
+        for batch in batched(words, BATCH_SIZE):
+            cur.executemany('INSERT INTO words VALUES (?, ?, ?, 1)',
+                ((id, reading, value) for id, (reading, qstring, value) in batch))
+            cur.executemany('INSERT INTO qstring_word_mappings VALUES (?, ?)',
+                ((qstring, id) for id, (reading, qstring, value) in batch))
+            if cin is not None:
+                for id, (reading, qstring, value) in batch:
+                    cin.write(qstring, value)
+            n += len(batch)
+            count_rows('words', len(batch))
+        con.commit()
+    with stage('create_indexes'):
+        index_db(con)
+    con.close()
+    if cin is not None:
+        cin.close()
+    return n
 
 ##############################################################################
 #
@@ -147,14 +172,14 @@ parser = argparse.ArgumentParser(
 parser.add_argument('-i', "--input", metavar='FILE', required=True, help='the khiin database file (khiin.db)')
 parser.add_argument('-o', "--output", metavar='FILE', required=False, help='the output database file (TalmageOverride.db)')
 parser.add_argument('-c', "--cin", metavar="FILE", required=False, help="The .cin output file (chailaiji.cin)")
+instrument.add_arguments(parser)
 
 if __name__ == '__main__':
     args = parser.parse_args()
     input_file = args.input
     output_file = args.output if args.output else 'out/TalmageOverride.db'
     cur = get_cursor(input_file)
-    word_list = get_wordlist(cur)
-    build_db(output_file, word_list)
-
-    if args.cin:
-        build_txt(args.cin, word_list)
+    instrument.start(args)
+    with stage('export'):
+        export(cur, output_file, args.cin)
+    instrument.finish(args)
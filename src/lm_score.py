@@ -0,0 +1,232 @@
+import argparse
+from collections import Counter, defaultdict
+import heapq
+import math
+from operator import itemgetter
+import sqlite3
+
+##############################################################################
+#
+# Language model scores
+#
+# The unigram and bigram counts are turned into a backoff bigram model
+# with absolute discounting. log10 probabilities and backoff weights are
+# stored as fixed-point integers in "lm_score", keyed by a packed gram
+# id: the "frequency"."id" of a unigram, or (left id << 32) | right id
+# of a bigram. The key is the rowid of the table, so one IN (...) query
+# fetches every score a lattice of candidates needs, and scoring a path
+# is integer additions.
+#
+#   logprob(w | u) = bigram logprob          if the bigram (u, w) was seen
+#                  = backoff(u) + logprob(w) otherwise
+#
+# Gram 0 holds the logprob of an input that is not in the counts.
+#
+##############################################################################
+
+# Fixed-point scale of log10 values: 1000 is a precision of 0.001, and
+# every score fits in a 2-byte SQLite integer
+LOGPROB_SCALE = 1000
+
+UNKNOWN = 0
+
+ID_BITS = 32
+
+def bigram_key(left, right):
+    return (left << ID_BITS) | right
+
+def quantize(log10):
+    return round(log10 * LOGPROB_SCALE)
+
+def lm_table_sql():
+    return """DROP TABLE IF EXISTS "lm_score";
+CREATE TABLE "lm_score" (
+    "gram"      INTEGER PRIMARY KEY,
+    "logprob"   INTEGER NOT NULL,
+    "backoff"   INTEGER NOT NULL
+);
+"""
+
+##############################################################################
+#
+# Model estimation
+#
+##############################################################################
+
+def discount(bigrams):
+    """Absolute discount D = n1 / (n1 + 2 * n2) from the counts of counts"""
+    counts = Counter(n for n in bigrams.values() if n <= 2)
+    n1, n2 = counts[1], counts[2]
+    if n1 == 0 or n2 == 0:
+        return 0.5
+    return n1 / (n1 + 2 * n2)
+
+def estimate(unigrams, bigrams):
+    """lm_score rows for {id: count} unigrams and {(left, right): count}
+    bigrams, sorted by gram"""
+    total = sum(unigrams.values())
+    if total == 0:
+        return []
+    p_uni = {w: n / total for w, n in unigrams.items()}
+    # Half a count for inputs that never occur in the corpus
+    p_unknown = 0.5 / total
+    d = discount(bigrams)
+
+    followers = defaultdict(list)
+    for (u, w), n in bigrams.items():
+        followers[u].append((w, n))
+
+    rows = [(UNKNOWN, quantize(math.log10(p_unknown)), 0)]
+    backoff = {}
+    for u, seen in followers.items():
+        context = sum(n for _, n in seen)
+        left = d * len(seen) / context
+        # The unigram mass of the unseen followers, which the left over
+        # probability is spread over
+        rest = 1 - sum(p_uni.get(w, p_unknown) for w, _ in seen)
+        backoff[u] = quantize(math.log10(left / max(rest, p_unknown)))
+        for w, n in seen:
+            rows.append((bigram_key(u, w), quantize(math.log10((n - d) / context)), 0))
+    # Contexts can outlive their unigram when the counts were pruned
+    for w in p_uni.keys() | backoff.keys():
+        rows.append((w, quantize(math.log10(p_uni.get(w, p_unknown))), backoff.get(w, 0)))
+    rows.sort()
+    return rows
+
+##############################################################################
+#
+# SQLite loader
+#
+##############################################################################
+
+def read_counts(db_cur):
+    """Unigram and bigram counts by "frequency"."id"; grams that are not
+    inputs of the database are left out"""
+    unigrams = dict(db_cur.execute("""SELECT f.id, u.n
+    FROM unigram_freq AS u
+    JOIN frequency AS f ON f.input = u.gram"""))
+    bigrams = {(l, r): n for l, r, n in db_cur.execute("""SELECT fl.id, fr.id, b.n
+    FROM bigram_freq AS b
+    JOIN frequency AS fl ON fl.input = b.lgram
+    JOIN frequency AS fr ON fr.input = b.rgram""")}
+    return unigrams, bigrams
+
+def load_lm_scores(con, rows):
+    cur = con.cursor()
+    cur.executescript(lm_table_sql())
+    cur.executemany('INSERT INTO "lm_score" ("gram", "logprob", "backoff") VALUES (?, ?, ?);', rows)
+    con.commit()
+    if cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone():
+        cur.execute('ANALYZE "lm_score";')
+        con.commit()
+
+def build_lm_table(db_file):
+    """Build "lm_score" from the n-gram counts of `db_file`; returns the
+    numbers of unigram and bigram rows"""
+    con = sqlite3.connect(db_file)
+    unigrams, bigrams = read_counts(con.cursor())
+    load_lm_scores(con, estimate(unigrams, bigrams))
+    con.close()
+    return len(unigrams), len(bigrams)
+
+##############################################################################
+#
+# Scoring
+#
+# A lattice has one entry per position of the typed buffer, each a list
+# of (end, input_id) edges, like SyllableTrie.lattice with input ids in
+# place of syllables. Scores are sums of quantized log10 probabilities,
+# so higher is better.
+#
+##############################################################################
+
+def fetch_scores(db_cur, grams):
+    """{gram: (logprob, backoff)} of the grams found in "lm_score" """
+    grams = list(grams)
+    params = ', '.join('?' for _ in grams)
+    rows = db_cur.execute(f'SELECT "gram", "logprob", "backoff" FROM "lm_score" WHERE "gram" IN ({params})', grams)
+    return {gram: (logprob, backoff) for gram, logprob, backoff in rows}
+
+def lattice_grams(lattice, context=None):
+    """Every unigram and bigram key that scoring `lattice` can look up"""
+    grams = {UNKNOWN}
+    previous = [[] for _ in range(len(lattice) + 1)]
+    if context is not None:
+        grams.add(context)
+        previous[0].append(context)
+    for i, edges in enumerate(lattice):
+        for end, word in edges:
+            grams.add(word)
+            grams.update(bigram_key(u, word) for u in previous[i])
+            previous[end].append(word)
+    return grams
+
+def logprob(scores, left, word):
+    """Quantized log10 P(word | left); `left` is None at the start"""
+    if left is not None:
+        found = scores.get(bigram_key(left, word))
+        if found is not None:
+            return found[0]
+    backoff = scores[left][1] if left in scores else 0
+    return backoff + scores.get(word, scores.get(UNKNOWN, (0, 0)))[0]
+
+def score_path(scores, words, context=None):
+    total = 0
+    for word in words:
+        total += logprob(scores, context, word)
+        context = word
+    return total
+
+def rank_candidates(db_cur, candidates, context=None):
+    """(score, input_id) of each candidate following `context`, best first"""
+    scores = fetch_scores(db_cur, lattice_grams([[(1, x) for x in candidates]], context))
+    return sorted(((logprob(scores, context, x), x) for x in candidates), key=lambda x: -x[0])
+
+def unroll(path):
+    words = []
+    while path is not None:
+        word, path = path
+        words.append(word)
+    return words[::-1]
+
+def rank_lattice(db_cur, lattice, context=None, limit=10):
+    """The `limit` best paths through `lattice` as (score, [input ids]),
+    best first, after fetching all their scores in one query
+
+    Paths are extended position by position, keeping the `limit` best
+    for each last word (the state of a bigram model). A path is held as
+    (last word, rest of the path) until it is returned.
+    """
+    scores = fetch_scores(db_cur, lattice_grams(lattice, context))
+    n = len(lattice)
+    states = [{} for _ in range(n + 1)]
+    states[0][context] = [(0, None)]
+    for i in range(n):
+        for left, paths in states[i].items():
+            if len(paths) > limit:
+                paths = heapq.nlargest(limit, paths, key=itemgetter(0))
+            for end, word in lattice[i]:
+                cost = logprob(scores, left, word)
+                states[end].setdefault(word, []).extend((score + cost, (word, path)) for score, path in paths)
+    found = heapq.nlargest(limit, (x for paths in states[n].values() for x in paths), key=itemgetter(0))
+    return [(score, unroll(path)) for score, path in found]
+
+##############################################################################
+#
+# __main__
+#
+##############################################################################
+
+parser = argparse.ArgumentParser(
+    description="""Build the "lm_score" table from the n-gram counts of a khiin.db
+
+Run after src/ngram_count.py; the table replaces any earlier one.""",
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+
+parser.add_argument('-i', "--input", metavar='FILE', required=True, help='the khiin database file (khiin.db)')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    n_uni, n_bi = build_lm_table(args.input)
+    print(f"""Language model scores written to {args.input}:
+ - {n_uni} unigrams and {n_bi} bigrams ("lm_score" table)""")
@@ -1,3 +1,4 @@
+from functools import lru_cache
 import itertools
 import re
 import unicodedata
@@ -32,57 +33,115 @@ KIP_SUBS = [
     (r'ek', 'ik'),
 ]
 
-def poj_to_ascii(text):
-    text = unicodedata.normalize('NFD', text)
-    for sub in ASCII_SUBS:
-        text = re.sub(sub[0], sub[1], text)
-    text = re.sub(r'([A-Za-z]+)(\d)([A-Za-z]+)', r'\1\3\2', text).lower()
-    return text
+##############################################################################
+#
+# Compiled substitution tables
+#
+# Every ASCII_SUBS pattern is a single code point, so the whole chain is
+# one str.translate call. The remaining regexes are compiled once.
+# Conversions are applied one space-separated syllable at a time and
+# memoized: none of the patterns can match across a space, so this gives
+# the same result as converting the whole text, and the syllable
+# inventory is small enough that nearly every call is a cache hit.
+#
+##############################################################################
 
-def poj_to_fhl_qstring(text):
-    text = poj_to_ascii(text)
-    if re.search(r' ', text) is not None:
-        text = re.sub(r'\d| +', '', text)
-    return text
+ASCII_TABLE = str.maketrans({chr(int(pat[2:], 16)): sub for pat, sub in ASCII_SUBS})
+KIP_PATTERNS = [(re.compile(pat), sub) for pat, sub in KIP_SUBS]
+TONE_MOVE = re.compile(r'([A-Za-z]+)(\d)([A-Za-z]+)')
+FINAL_TONE = re.compile(r'\d$')
+QSTRING_STRIP = re.compile(r'\d| +')
+SYLLABLE_SPLIT = re.compile('[ -]')
 
-def poj_to_fhl_reading(text):
-    text = poj_to_ascii(text)
-    for sub in KIP_SUBS:
-        text = re.sub(sub[0], sub[1], text)
-    text = re.sub(r' ', '-', text)
-    return text
+SYLLABLE_CACHE_SIZE = 8192
+
+@lru_cache(maxsize=SYLLABLE_CACHE_SIZE)
+def syllable_to_ascii(syl):
+    syl = unicodedata.normalize('NFD', syl).translate(ASCII_TABLE)
+    return TONE_MOVE.sub(r'\1\3\2', syl).lower()
 
+@lru_cache(maxsize=SYLLABLE_CACHE_SIZE)
+def syllable_to_reading(syl):
+    syl = syllable_to_ascii(syl)
+    for pat, sub in KIP_PATTERNS:
+        syl = pat.sub(sub, syl)
+    return syl
+
+@lru_cache(maxsize=SYLLABLE_CACHE_SIZE)
 def poj_to_khiin(syllable, strip_tones):
-    decomposed = unicodedata.normalize('NFD', syllable)
-    for sub in ASCII_SUBS:
-        decomposed = re.sub(sub[0], sub[1], decomposed)
-    numeric = re.sub(r'([A-Za-z]+)(\d)([A-Za-z]+)', r'\1\3\2', decomposed).lower()
+    numeric = syllable_to_ascii(syllable)
     toneless = numeric
     telex = numeric
 
-    match = re.search(r'\d$', numeric)
-    if match is not None:
+    if FINAL_TONE.search(numeric) is not None:
         toneless = numeric[:-1]
         telex = toneless + TELEX_MAP[numeric[-1]]
-    
+
     if numeric == toneless:
-        return [[toneless], [toneless]]
-    
+        return ((toneless,), (toneless,))
+
     if strip_tones:
-        return [[numeric, toneless], [telex, toneless]]
+        return ((numeric, toneless), (telex, toneless))
+
+    return ((numeric,), (telex,))
 
-    return [[numeric], [telex]]
+def poj_to_ascii(text):
+    return ' '.join(map(syllable_to_ascii, text.split(' ')))
+
+def poj_to_fhl_qstring(text):
+    text = poj_to_ascii(text)
+    if ' ' in text:
+        text = QSTRING_STRIP.sub('', text)
+    return text
+
+def poj_to_fhl_reading(text):
+    return '-'.join(map(syllable_to_reading, text.split(' ')))
 
 def always_same(n, val):
     for i in range(n):
         yield val
 
-def to_input_sequences(word: str) -> list[str]:
-    syls = re.compile('[ -]').split(word)
+##############################################################################
+#
+# Batch API
+#
+# A column of inputs is converted at once: each distinct syllable of the
+# column is looked up once, and each distinct input is expanded once.
+# The per-column tables do not depend on the size of the lru_caches, so
+# a column with more syllables than SYLLABLE_CACHE_SIZE is still
+# converted in one pass.
+#
+##############################################################################
+
+def convert_column(fn, texts):
+    """Apply `fn` to a column of inputs, converting each distinct value once"""
+    seen = {}
+    ret = []
+    for text in texts:
+        value = seen.get(text)
+        if value is None:
+            value = seen[text] = fn(text)
+        ret.append(value)
+    return ret
+
+def to_input_sequences_column(words):
+    """to_input_sequences of each word of a column"""
     strip_tones = True # len(syls) > 1
-    syls = list(map(poj_to_khiin, syls, always_same(len(syls), strip_tones)))
-    numeric_syls = [x[0] for x in syls]
-    telex_syls = [x[1] for x in syls]
-    numeric = [''.join(ea) for ea in list(itertools.product(*numeric_syls))]
-    telex = [''.join(ea) for ea in list(itertools.product(*telex_syls))]
-    return list(zip(numeric, telex))
+    syl_keys = {}
+
+    def expand(word):
+        syls = SYLLABLE_SPLIT.split(word)
+        for syl in syls:
+            if syl not in syl_keys:
+                syl_keys[syl] = poj_to_khiin(syl, strip_tones)
+        syls = [syl_keys[x] for x in syls]
+        numeric_syls = [x[0] for x in syls]
+        telex_syls = [x[1] for x in syls]
+        numeric = [''.join(ea) for ea in itertools.product(*numeric_syls)]
+        telex = [''.join(ea) for ea in itertools.product(*telex_syls)]
+        return list(zip(numeric, telex))
+
+    return convert_column(expand, words)
+
+def to_input_sequences(word: str) -> list[str]:
+    return to_input_sequences_column([word])[0]
@@ -0,0 +1,280 @@
+import argparse
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import json
+import sqlite3
+import threading
+
+from keyseq import RANK_ORDER
+
+##############################################################################
+#
+# Asyncio lookup service
+#
+# Answers "key sequence -> ranked candidates" requests from many
+# concurrent clients. Requests that miss the cache are queued, and a
+# batcher task sends each batch of distinct key sequences to a thread
+# pool as one `key_sequence IN (...)` query. Concurrent requests for the
+# same key sequence wait on the same future. Every worker thread has its
+# own read-only connection; sqlite3 releases the GIL while a query runs,
+# so the workers overlap. Candidates are cached by key sequence.
+#
+##############################################################################
+
+EVICTION = ['lru', 'fifo']
+
+DEFAULT_WORKERS = 4
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_BATCH_SIZE = 32
+DEFAULT_BATCH_WINDOW = 0.0
+
+class CandidateCache:
+    """Key sequence -> candidates, holding at most `max_entries`
+
+    With 'lru' eviction a hit makes the entry the most recent; with
+    'fifo' entries are evicted in the order they were added. A size of
+    0 disables the cache.
+    """
+
+    def __init__(self, max_entries=DEFAULT_CACHE_SIZE, eviction='lru'):
+        if eviction not in EVICTION:
+            raise ValueError(f'eviction must be one of {EVICTION}')
+        self.max_entries = max_entries
+        self.eviction = eviction
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if self.eviction == 'lru':
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+def fetch_candidates(db_cur, mode, keys):
+    """{key sequence: tuple of lookup view rows in RANK_ORDER} for `keys`"""
+    params = ', '.join('?' for _ in keys)
+    rows = db_cur.execute(f"""SELECT v.*
+    FROM lookup_{mode} AS v
+    JOIN frequency AS f ON f.id = v.input_id
+    WHERE v.key_sequence IN ({params})
+    ORDER BY v.key_sequence, {RANK_ORDER}""", keys)
+    ret = {}
+    for row in rows:
+        ret.setdefault(row[0], []).append(row)
+    return {k: tuple(v) for k, v in ret.items()}
+
+class ConnectionPool:
+    """A thread pool whose every thread has its own read-only connection"""
+
+    def __init__(self, db_file, size=DEFAULT_WORKERS):
+        self.db_file = db_file
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+        self.executor = ThreadPoolExecutor(size, thread_name_prefix='khiin-lookup', initializer=self._connect)
+
+    def _connect(self):
+        con = sqlite3.connect(f'file:{self.db_file}?mode=ro', uri=True, check_same_thread=False)
+        self.local.con = con
+        with self.lock:
+            self.connections.append(con)
+
+    def _call(self, fn, args):
+        return fn(self.local.con.cursor(), *args)
+
+    def run(self, fn, *args):
+        """Awaitable result of fn(db_cur, *args) on a worker thread"""
+        return asyncio.get_running_loop().run_in_executor(self.executor, self._call, fn, args)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        for con in self.connections:
+            con.close()
+        self.connections = []
+
+class LookupService:
+    def __init__(self, db_file, mode='numeric', workers=DEFAULT_WORKERS, cache_size=DEFAULT_CACHE_SIZE,
+            eviction='lru', batch_size=DEFAULT_BATCH_SIZE, batch_window=DEFAULT_BATCH_WINDOW):
+        con = sqlite3.connect(f'file:{db_file}?mode=ro', uri=True)
+        found = con.execute("SELECT 1 FROM sqlite_master WHERE type = 'view' AND name = ?", [f'lookup_{mode}']).fetchone()
+        con.close()
+        if found is None:
+            raise ValueError(f'{db_file} has no lookup_{mode} view (built with --compact-inputs?)')
+        self.db_file = db_file
+        self.mode = mode
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.cache = CandidateCache(cache_size, eviction)
+        self.pending = {}
+        self.requests = 0
+        self.coalesced = 0
+        self.batches = 0
+        self.batched_keys = 0
+
+    async def start(self):
+        self.pool = ConnectionPool(self.db_file, self.workers)
+        self.queue = asyncio.Queue()
+        self.slots = asyncio.Semaphore(self.workers)
+        self.tasks = set()
+        self.batcher = asyncio.create_task(self._batcher())
+        return self
+
+    async def close(self):
+        self.batcher.cancel()
+        try:
+            await self.batcher
+        except asyncio.CancelledError:
+            pass
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.pool.close()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def lookup(self, key_sequence):
+        """Candidates of `key_sequence`: a tuple of lookup view rows"""
+        self.requests += 1
+        value = self.cache.get(key_sequence)
+        if value is not None:
+            return value
+        future = self.pending.get(key_sequence)
+        if future is None:
+            future = self.pending[key_sequence] = asyncio.get_running_loop().create_future()
+            self.queue.put_nowait(key_sequence)
+        else:
+            self.coalesced += 1
+        # Shielded, so that a cancelled caller does not cancel the others
+        return await asyncio.shield(future)
+
+    async def _batcher(self):
+        while True:
+            batch = [await self.queue.get()]
+            # While every worker is busy, requests keep queueing and the
+            # next batch gets bigger
+            await self.slots.acquire()
+            if self.batch_window > 0:
+                await asyncio.sleep(self.batch_window)
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            task = asyncio.create_task(self._run_batch(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _run_batch(self, batch):
+        try:
+            results = await self.pool.run(fetch_candidates, self.mode, batch)
+        except Exception as e:
+            for key in batch:
+                future = self.pending.pop(key)
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self.slots.release()
+        self.batches += 1
+        self.batched_keys += len(batch)
+        for key in batch:
+            value = results.get(key, ())
+            self.cache.put(key, value)
+            future = self.pending.pop(key)
+            if not future.done():
+                future.set_result(value)
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'cache_hits': self.cache.hits,
+            'cache_hit_rate': round(self.cache.hits / max(self.requests, 1), 4),
+            'cache_entries': len(self.cache),
+            'cache_evictions': self.cache.evictions,
+            'coalesced': self.coalesced,
+            'batches': self.batches,
+            'mean_batch_size': round(self.batched_keys / max(self.batches, 1), 2),
+        }
+
+##############################################################################
+#
+# Line protocol
+#
+# One key sequence per line in, one JSON array of candidates per line
+# out, each candidate being [input, output, weight, category, annotation].
+#
+##############################################################################
+
+async def handle_client(service, reader, writer):
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            rows = await service.lookup(line.decode('utf-8').strip())
+            reply = [[row[1], row[3], row[4], row[5], row[6]] for row in rows]
+            writer.write(json.dumps(reply, ensure_ascii=False).encode('utf-8') + b'\n')
+            await writer.drain()
+    finally:
+        writer.close()
+
+async def serve(service, host, port):
+    async with service:
+        server = await asyncio.start_server(lambda r, w: handle_client(service, r, w), host, port)
+        print(f'Serving lookup_{service.mode} of {service.db_file} on {host}:{port}')
+        async with server:
+            await server.serve_forever()
+
+##############################################################################
+#
+# __main__
+#
+##############################################################################
+
+parser = argparse.ArgumentParser(
+    description="""Serve candidate lookups from a khiin.db over a local socket
+
+Send one key sequence per line; each reply is a JSON array of
+[input, output, weight, category, annotation] in ranked order.""",
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+
+def add_service_arguments(parser):
+    parser.add_argument('-m', '--mode', choices=['numeric', 'telex'], default='numeric', help='input mode (default numeric)')
+    parser.add_argument('-w', '--workers', type=int, default=DEFAULT_WORKERS, help=f'worker threads and connections (default {DEFAULT_WORKERS})')
+    parser.add_argument('--eviction', choices=EVICTION, default='lru', help='cache eviction order (default lru)')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help=f'most key sequences per query (default {DEFAULT_BATCH_SIZE})')
+    parser.add_argument('--batch-window', metavar='SECONDS', type=float, default=DEFAULT_BATCH_WINDOW, help='time to wait for more requests before sending a batch (default 0: only what is already queued)')
+
+parser.add_argument('db', metavar='DB', help='the database file')
+parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default 127.0.0.1)')
+parser.add_argument('-p', '--port', type=int, default=8765, help='port to listen on (default 8765)')
+parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE, help=f'cached key sequences; 0 disables the cache (default {DEFAULT_CACHE_SIZE})')
+add_service_arguments(parser)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    service = LookupService(args.db, args.mode, args.workers, args.cache_size, args.eviction, args.batch_size, args.batch_window)
+    try:
+        asyncio.run(serve(service, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
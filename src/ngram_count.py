@@ -0,0 +1,177 @@
+import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import os
+import re
+import sqlite3
+import unicodedata
+
+##############################################################################
+#
+# Corpus segmentation
+#
+##############################################################################
+
+# Runs of letters and combining marks; anything else (digits, spaces,
+# punctuation, hyphens) separates syllables
+SYLLABLE_RE = re.compile(r'(?:[^\W\d_]|[\u0300-\u036f])+')
+
+def iter_sentences(line):
+    """Lowercased NFC syllable lists, split at punctuation and digits"""
+    text = unicodedata.normalize('NFD', line).replace('·', '').lower()
+    sentence = []
+    pos = 0
+    for match in SYLLABLE_RE.finditer(text):
+        gap = text[pos:match.start()]
+        pos = match.end()
+        if gap.strip(' -') and sentence:
+            yield sentence
+            sentence = []
+        sentence.append(unicodedata.normalize('NFC', match.group()))
+    if sentence:
+        yield sentence
+
+def segment(syls, vocab, max_len):
+    """Greedy longest match of a syllable list against `vocab`
+
+    Unknown syllables yield None, which breaks the bigram chain.
+    """
+    i = 0
+    n = len(syls)
+    while i < n:
+        for size in range(min(max_len, n - i), 0, -1):
+            word = ' '.join(syls[i:i + size])
+            if word in vocab:
+                yield word
+                i += size
+                break
+        else:
+            yield None
+            i += 1
+
+##############################################################################
+#
+# Parallel counting
+#
+##############################################################################
+
+CHUNK_LINES = 20000
+
+_vocab = None
+_max_len = 0
+
+def _init_worker(vocab):
+    global _vocab, _max_len
+    _vocab = vocab
+    _max_len = max((x.count(' ') + 1 for x in vocab), default=0)
+
+def count_chunk(lines):
+    unigrams = Counter()
+    bigrams = Counter()
+    for line in lines:
+        for sentence in iter_sentences(line):
+            prev = None
+            for word in segment(sentence, _vocab, _max_len):
+                if word is not None:
+                    unigrams[word] += 1
+                    if prev is not None:
+                        bigrams[(prev, word)] += 1
+                prev = word
+    return unigrams, bigrams
+
+def iter_chunks(corpus_file, chunk_lines):
+    with open(corpus_file, encoding='utf-8') as f:
+        while True:
+            chunk = list(itertools.islice(f, chunk_lines))
+            if not chunk:
+                return
+            yield chunk
+
+def count_ngrams(corpus_file, vocab, workers=None, chunk_lines=CHUNK_LINES):
+    """Count unigrams and bigrams of `vocab` words across a process pool
+
+    At most two chunks per worker are in flight, so the corpus is never
+    held in memory.
+    """
+    workers = workers or os.cpu_count() or 1
+    unigrams = Counter()
+    bigrams = Counter()
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(vocab,)) as pool:
+        chunks = iter_chunks(corpus_file, chunk_lines)
+        pending = [pool.submit(count_chunk, c) for c in itertools.islice(chunks, workers * 2)]
+        while pending:
+            uni, bi = pending.pop(0).result()
+            unigrams.update(uni)
+            bigrams.update(bi)
+            for c in itertools.islice(chunks, 1):
+                pending.append(pool.submit(count_chunk, c))
+    return unigrams, bigrams
+
+def prune(counts, min_count):
+    if min_count <= 1:
+        return counts
+    return Counter({k: n for k, n in counts.items() if n >= min_count})
+
+##############################################################################
+#
+# SQLite loader
+#
+##############################################################################
+
+def get_vocab(db_cur):
+    return frozenset(row[0] for row in db_cur.execute('SELECT "input" FROM "frequency"'))
+
+def load_ngrams(con, unigrams, bigrams):
+    cur = con.cursor()
+    cur.execute('DELETE FROM "unigram_freq";')
+    cur.execute('DELETE FROM "bigram_freq";')
+    cur.executemany('INSERT INTO "unigram_freq" ("gram", "n") VALUES (?, ?);',
+        sorted(unigrams.items()))
+    cur.executemany('INSERT INTO "bigram_freq" ("lgram", "rgram", "n") VALUES (?, ?, ?);',
+        ((l, r, n) for (l, r), n in sorted(bigrams.items())))
+    con.commit()
+    # Refresh the planner statistics of read-optimized builds
+    if cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone():
+        cur.execute('ANALYZE "unigram_freq";')
+        cur.execute('ANALYZE "bigram_freq";')
+        con.commit()
+
+def build_ngram_tables(db_file, corpus_file, workers=None, chunk_lines=CHUNK_LINES, min_unigram=1, min_bigram=1):
+    con = sqlite3.connect(db_file)
+    vocab = get_vocab(con)
+    unigrams, bigrams = count_ngrams(corpus_file, vocab, workers, chunk_lines)
+    unigrams = prune(unigrams, min_unigram)
+    bigrams = prune(bigrams, min_bigram)
+    load_ngrams(con, unigrams, bigrams)
+    con.close()
+    return len(unigrams), len(bigrams)
+
+##############################################################################
+#
+# __main__
+#
+##############################################################################
+
+parser = argparse.ArgumentParser(
+    description="""Count unigrams and bigrams of a plain-text Lomaji corpus
+
+The corpus is segmented into the "frequency" inputs of an existing
+khiin.db by greedy longest match, and the counts replace the contents
+of the "unigram_freq" and "bigram_freq" tables.""",
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+
+parser.add_argument('-i', "--input", metavar='FILE', required=True, help='the khiin database file (khiin.db)')
+parser.add_argument('-c', "--corpus", metavar='FILE', required=True, help='the plain-text corpus, UTF-8')
+parser.add_argument('-w', "--workers", type=int, default=None, help='number of worker processes (default: CPU count)')
+parser.add_argument("--chunk-lines", type=int, default=CHUNK_LINES, help=f'lines per worker task (default {CHUNK_LINES})')
+parser.add_argument("--min-unigram", type=int, default=1, help='drop unigrams seen fewer times than this')
+parser.add_argument("--min-bigram", type=int, default=1, help='drop bigrams seen fewer times than this')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    n_uni, n_bi = build_ngram_tables(args.input, args.corpus, args.workers,
+        args.chunk_lines, args.min_unigram, args.min_bigram)
+    print(f"""N-gram counts written to {args.input}:
+ - {n_uni} unigrams ("unigram_freq" table)
+ - {n_bi} bigrams ("bigram_freq" table)""")
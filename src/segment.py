@@ -0,0 +1,163 @@
+import re
+
+from lomaji import to_input_sequences
+
+##############################################################################
+#
+# Syllable segmentation
+#
+# The IME receives key buffers without spaces ("goa2ai3", "goalibo"), so
+# before looking up words it has to split the buffer into syllables.
+# Every toned and toneless key of every syllable goes into a character
+# trie (nested dicts, with the syllables of a complete key stored under
+# END). Matching the keys that start at one position of the buffer is a
+# single walk down the trie, so the whole segmentation lattice of a
+# buffer of n characters costs at most n walks of one syllable length,
+# with no SQL queries.
+#
+##############################################################################
+
+END = ''
+SYLLABLE_KEY = re.compile('[a-z0-9]+')
+
+def syllable_key_rows(syllables):
+    """(syllable, numeric key, telex key) of each distinct syllable
+
+    Syllables whose keys are not plain ASCII letters and digits (Hanji
+    inputs, stray punctuation) are left out.
+    """
+    rows = {}
+    for syl in syllables:
+        if syl in rows:
+            continue
+        numeric, telex = to_input_sequences(syl)[0]
+        if SYLLABLE_KEY.fullmatch(numeric) and SYLLABLE_KEY.fullmatch(telex):
+            rows[syl] = (syl, numeric, telex)
+    return sorted(rows.values(), key=lambda x: (x[1], x[0]))
+
+class SyllableTrie:
+    """Character trie of syllable keys for one input mode"""
+
+    def __init__(self, keys):
+        """`keys` is an iterable of (key, syllable)"""
+        self.root = {}
+        self.size = 0
+        for key, syl in keys:
+            node = self.root
+            for c in key:
+                node = node.setdefault(c, {})
+            if END not in node:
+                node[END] = ()
+                self.size += 1
+            if syl not in node[END]:
+                node[END] += (syl,)
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, key):
+        node = self._find(key)
+        return node is not None and END in node
+
+    def _find(self, text):
+        node = self.root
+        for c in text:
+            node = node.get(c)
+            if node is None:
+                return None
+        return node
+
+    def syllables(self, key):
+        """The syllables typed as `key`, or ()"""
+        node = self._find(key)
+        return node.get(END, ()) if node is not None else ()
+
+    def is_prefix(self, text):
+        """True if `text` can be completed to a key"""
+        node = self._find(text)
+        return node is not None and len(node) > (END in node)
+
+    def _walk(self, buffer, start):
+        """(matches at `start`, True if the rest of the buffer is an
+        incomplete key)"""
+        ret = []
+        node = self.root
+        for i in range(start, len(buffer)):
+            node = node.get(buffer[i])
+            if node is None:
+                return ret, False
+            if END in node:
+                ret.append((i + 1, node[END]))
+        return ret, len(node) > (END in node)
+
+    def matches(self, buffer, start=0):
+        """(end, syllables) of every key that starts at `start`, shortest first"""
+        return self._walk(buffer, start)[0]
+
+    def longest_match(self, buffer, start=0):
+        """(end, syllables) of the longest key at `start`, or None"""
+        found = self.matches(buffer, start)
+        return found[-1] if found else None
+
+    def lattice(self, buffer, partial=False):
+        """Edges of every way to split `buffer` into keys
+
+        Returns a list with one entry per position of the buffer, each a
+        list of (end, syllables) edges that lie on a path from 0 to the
+        end of the buffer. With `partial`, the last syllable may still
+        be incomplete; such an edge has `None` for its syllables. A key
+        that is complete at the end of the buffer gets only its complete
+        edge, even if it can also be continued.
+        """
+        n = len(buffer)
+        edges = []
+        for i in range(n):
+            found, incomplete = self._walk(buffer, i)
+            if partial and incomplete and not (found and found[-1][0] == n):
+                found.append((n, None))
+            edges.append(found)
+        reach_end = [False] * n + [True]
+        for i in range(n - 1, -1, -1):
+            reach_end[i] = any(reach_end[end] for end, _ in edges[i])
+        lattice = [[] for _ in range(n)]
+        reach_start = [False] * (n + 1)
+        reach_start[0] = True
+        for i in range(n):
+            if reach_start[i] and reach_end[i]:
+                for end, syls in edges[i]:
+                    if reach_end[end]:
+                        lattice[i].append((end, syls))
+                        reach_start[end] = True
+        return lattice
+
+    def segmentations(self, buffer, partial=False, limit=None):
+        """Splits of `buffer` into keys, longest first syllable first
+
+        Each split is a list of key strings. With `partial`, each split is
+        a (keys, incomplete) pair instead, where `incomplete` is True if
+        the last key is only the start of a syllable. At most `limit` are
+        returned.
+        """
+        lattice = self.lattice(buffer, partial)
+        n = len(buffer)
+        ret = []
+        if n == 0:
+            return ret
+        stack = [(0, [], False)]
+        while stack and (limit is None or len(ret) < limit):
+            start, path, incomplete = stack.pop()
+            if start == n:
+                ret.append((path, incomplete) if partial else path)
+                continue
+            for end, syls in lattice[start]:
+                stack.append((end, path + [buffer[start:end]], syls is None))
+        return ret
+
+def syllable_trie(rows, mode='numeric'):
+    """Trie of the numeric or telex keys of (syllable, numeric, telex) rows"""
+    col = 1 if mode == 'numeric' else 2
+    return SyllableTrie((row[col], row[0]) for row in rows)
+
+def load_syllable_trie(db_cur, mode='numeric'):
+    """Trie of the "syllable_keys" table of a database built with --syllable-index"""
+    return syllable_trie(db_cur.execute('SELECT "syllable", "numeric", "telex" FROM "syllable_keys"'), mode)
@@ -0,0 +1,126 @@
+import os
+import sqlite3
+
+from sql_writer import SqlDumpWriter, quote_identifier
+
+##############################################################################
+#
+# Sharded database build
+#
+# The inputs are split into shards of contiguous, disjoint "frequency"
+# id ranges. A worker process derives every row of its shard, key
+# sequences included, and writes them to its own SQLite file, without
+# constraints or indexes, and to SQL dump fragments, one file per table.
+#
+# Each shard table has a "seq" rowid. Rows of tables that follow the
+# id order are numbered in the order the worker writes them, and the
+# shards are concatenated in order. A row whose place is set by the
+# whole table (conversions, which are sorted by input text) carries its
+# position in that table as "seq", and the shards are merged on it. The
+# final database is the same one a serial build writes.
+#
+##############################################################################
+
+# SQLite's default limit of attached databases
+MAX_SHARDS = 10
+
+def shard_ranges(n_ids, n_shards):
+    """(first id, end id) of each shard; ids start at 1"""
+    bounds = [1 + n_ids * i // n_shards for i in range(n_shards + 1)]
+    return list(zip(bounds, bounds[1:]))
+
+class ShardSink:
+    """Row sink writing one shard file
+
+    Tables are created on their first batch. Rows get the next "seq"
+    unless "seq" is one of the columns.
+    """
+
+    def __init__(self, shard_file, pragmas):
+        if os.path.exists(shard_file):
+            os.remove(shard_file)
+        self.con = sqlite3.connect(shard_file)
+        self.cur = self.con.cursor()
+        self.cur.executescript(pragmas)
+        self.tables = {}
+        self.rows = 0
+
+    def insert(self, table, columns, batch):
+        columns = tuple(columns)
+        if table not in self.tables:
+            names = ', '.join(quote_identifier(x) for x in columns if x != 'seq')
+            self.cur.execute(f'CREATE TABLE {quote_identifier(table)} ("seq" INTEGER PRIMARY KEY, {names})')
+            self.tables[table] = columns
+        names = ', '.join(map(quote_identifier, columns))
+        params = ', '.join('?' for _ in columns)
+        self.cur.executemany(f'INSERT INTO {quote_identifier(table)} ({names}) VALUES ({params})', batch)
+        self.rows += len(batch)
+
+    def close(self):
+        self.con.commit()
+        self.con.close()
+
+def shard_file(shard_dir, shard):
+    return os.path.join(shard_dir, f'shard{shard}.db')
+
+def fragment_file(shard_dir, shard, table):
+    return os.path.join(shard_dir, f'shard{shard}.{table}.sql')
+
+class DumpFragments:
+    """Row sink writing the INSERT statements of each table to its own file"""
+
+    def __init__(self, shard_dir, shard):
+        self.shard_dir = shard_dir
+        self.shard = shard
+        self.writers = {}
+
+    def insert(self, table, columns, batch):
+        writer = self.writers.get(table)
+        if writer is None:
+            writer = self.writers[table] = SqlDumpWriter(fragment_file(self.shard_dir, self.shard, table))
+        writer.insert(table, columns, batch)
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+def shard_layout(shard_tables):
+    """{table: (columns, shards that have it)} in the order the tables
+    were written, from the `tables` of every ShardSink"""
+    layout = {}
+    for shard, tables in enumerate(shard_tables):
+        for table, columns in tables.items():
+            layout.setdefault(table, (columns, []))[1].append(shard)
+    return layout
+
+def attach_shards(con, shard_files):
+    for i, shard_file in enumerate(shard_files):
+        con.execute(f'ATTACH DATABASE ? AS "shard{i}"', [shard_file])
+
+def detach_shards(con, shard_files):
+    for i in range(len(shard_files)):
+        con.execute(f'DETACH DATABASE "shard{i}"')
+
+def shard_selects(table, columns, shards):
+    """SELECT statements that read `table` from the attached shards in
+    load order: one per shard, or a single merge on "seq" if the rows
+    carry their position in the whole table"""
+    names = ', '.join(quote_identifier(x) for x in columns if x != 'seq')
+    if 'seq' not in columns:
+        return [f'SELECT {names} FROM "shard{i}".{quote_identifier(table)} ORDER BY "seq"' for i in shards]
+    # Every shard table is read in rowid order, so the ordered UNION ALL
+    # is a merge of the shards rather than a sort
+    union = ' UNION ALL '.join(f'SELECT "seq", {names} FROM "shard{i}".{quote_identifier(table)}' for i in shards)
+    return [f'SELECT {names} FROM ({union} ORDER BY "seq")']
+
+def merge_shards(con, layout):
+    """Fill the main tables of `con` from the attached shards"""
+    cur = con.cursor()
+    n_rows = 0
+    for table, (columns, shards) in layout.items():
+        names = ', '.join(quote_identifier(x) for x in columns if x != 'seq')
+        for select in shard_selects(table, columns, shards):
+            cur.execute(f'INSERT INTO main.{quote_identifier(table)} ({names}) {select}')
+            n_rows += cur.rowcount
+    con.commit()
+    return n_rows
@@ -1,17 +1,31 @@
 import argparse
+from concurrent.futures import Future, ProcessPoolExecutor
 import csv
-from functools import cmp_to_key
 import itertools
-import locale
-from operator import itemgetter
+import os
 from pathlib import Path
 import sqlite3
-import sys
 import re
+import tempfile
 import unicodedata
-locale.setlocale(locale.LC_ALL, '')
 
-from lomaji import to_input_sequences
+from batching import BATCH_SIZE, batched
+from collation import sort_key
+from dataset import FreqRow, ConvRow, InputRow, KeyRow, dedupe_best, extend_unique, input_set, semi_join
+from dataset_cache import cache_key, load_datasets, save_datasets
+from extsort import RUN_SIZE, SpilledRun, external_sort
+from sql_writer import SqlDumpWriter
+from incremental import diff_dict, diff_set, fingerprint, read_fingerprint, write_fingerprint
+import instrument
+from instrument import count_rows, stage
+from khiin_dict import export_dictionary
+from keyseq import PREFIX_LENGTH, RANK_ORDER, key_prefixes, numeric_skeleton, telex_skeleton, word_keys
+from lm_score import build_lm_table
+from lomaji import SYLLABLE_SPLIT, to_input_sequences_column
+from ngram_count import build_ngram_tables
+from segment import syllable_key_rows
+from shards import (MAX_SHARDS, DumpFragments, ShardSink, attach_shards, detach_shards, fragment_file, merge_shards,
+    shard_file, shard_layout, shard_ranges, shard_selects)
 
 ##############################################################################
 #
@@ -31,28 +45,13 @@ def normalize_loji(input, strip_tones=False):
 
     return unicodedata.normalize('NFC', input)
 
-spinner = itertools.cycle(['-', '/', '|', '\\'])
-def show_progress():
-    global spinner
-    sys.stdout.write(next(spinner))
-    sys.stdout.flush()
-    sys.stdout.write('\b')
-    return 0
+def freq_sort_key(row):
+    return (-row.freq, row.chhan_id)
 
-def compare(x, y):
-    return (x > y) - (x < y)
+def conv_sort_key(row):
+    return (sort_key(row.input), -row.weight)
 
-def freq_sort(left, right):
-    cmp = -compare(left['freq'], right['freq'])
-    return cmp if cmp != 0 else compare(left['chhan_id'], right['chhan_id'])
-
-def conv_sort(left, right):
-    cmp = compare(locale.strxfrm(left['input']), locale.strxfrm(right['input']))
-    return cmp if cmp != 0 else -compare(left['weight'], right['weight'])
-
-freq_sort_key = cmp_to_key(freq_sort)
-conv_sort_key = cmp_to_key(conv_sort)
-syls_sort_key = locale.strxfrm
+syls_sort_key = sort_key
 
 ##############################################################################
 #
@@ -60,33 +59,29 @@ syls_sort_key = locale.strxfrm
 #
 ##############################################################################
 
-def parse_freq_csv(csv_file, exclude_zeros=False):
-    data = []
+def iter_freq_csv(csv_file, exclude_zeros=False):
     with open(csv_file) as f:
         reader = csv.DictReader(f, skipinitialspace=True)
-        data = list(reader)
-    for x in data:
-        x['input'] = normalize_loji(x['input'])
-        x['freq'] = int(x['freq'])
-        x['chhan_id'] = int(x['chhan_id'])
-    if exclude_zeros is True:
-        data = [x for x in data if x['freq'] != 0]
-    return sorted(data, key=freq_sort_key)
+        for x in reader:
+            row = FreqRow(normalize_loji(x['input']), int(x['freq']), int(x['chhan_id']))
+            if exclude_zeros is True and row.freq == 0:
+                continue
+            yield row
 
-def parse_conv_csv(csv_file, sort_hanji_first):
-    data = []
+def iter_conv_csv(csv_file, sort_hanji_first):
     with open(csv_file) as f:
         reader = csv.DictReader(f, skipinitialspace=True)
-        data = list(reader)
-    for x in data:
-        x['input'] = normalize_loji(x['input'])
-        x['weight'] = int(x['weight'])
-        if sort_hanji_first is True:
-            if has_hanji(x['output']):
-                x['weight'] = 1000
-            else:
-                x['weight'] = 900
-    return sorted(data, key=conv_sort_key)
+        for x in reader:
+            weight = int(x['weight'])
+            if sort_hanji_first is True:
+                weight = 1000 if has_hanji(x['output']) else 900
+            yield ConvRow(normalize_loji(x['input']), x['output'], weight)
+
+def parse_freq_csv(csv_file, exclude_zeros=False):
+    return list(iter_freq_csv(csv_file, exclude_zeros))
+
+def parse_conv_csv(csv_file, sort_hanji_first):
+    return list(iter_conv_csv(csv_file, sort_hanji_first))
 
 def parse_syls_txt(txt_file):
     data = []
@@ -96,29 +91,33 @@ def parse_syls_txt(txt_file):
         data = [line.rstrip() for line in f]
     return sorted(data, key=syls_sort_key)
 
+def parse_symbols_tsv(symbol_tsv):
+    with open(symbol_tsv, 'r') as f:
+        rows = csv.DictReader(f, delimiter='\t')
+        return [(x['input'], x['output'], x['category']) for x in rows]
+
+def parse_emoji_csv(emoji_csv):
+    with open(emoji_csv, 'r') as f:
+        rows = csv.DictReader(f)
+        return [(x['id'], x['emoji'], x['short_name'], x['category'],  x['code'], x['recent'] == '1') for x in rows]
+
 ##############################################################################
 #
 # Data validation and collection
 #
 ##############################################################################
 
+def conv_key(row):
+    return (row.input, row.output)
+
+def freq_key(row):
+    return row.input
+
 def dedupe_conversions(conv_dat):
-    seen = set()
-    ret = []
-    for x in conv_dat:
-        if (x['input'], x['output']) not in seen:
-            seen.add((x['input'], x['output']))
-            ret.append(x)
-    return ret
+    return dedupe_best(conv_dat, conv_key, lambda x: x.weight)
 
 def dedupe_frequencies(freq_dat):
-    seen = set()
-    ret = []
-    for x in freq_dat:
-        if x['input'] not in seen:
-            seen.add(x['input'])
-            ret.append(x)
-    return ret
+    return dedupe_best(freq_dat, freq_key, lambda x: (x.freq, -x.chhan_id))
 
 def get_tone_position(syl):
     found = re.search(r"o[ae][a-z]", syl)
@@ -143,75 +142,256 @@ def add_all_tones(syl):
         ret.append(syl_tone)
     return ret
 
-def dedupe_syllables(syl_dat):
-    return sorted(list(set(syl_dat)), key=syls_sort_key)
-
-def get_unique(dataset, prop):
-    ret = set()
-    for each in dataset:
-        ret.add(each[prop])
-    return list(ret)
+def iter_toned_freq(syls):
+    for syl in syls:
+        for sylt in add_all_tones(syl):
+            yield FreqRow(sylt, 0, 99999)
 
-def find_common_inputs(freq, conv):
-    unique_freq_inputs = get_unique(freq, 'input')
-    unique_conv_inputs = get_unique(conv, 'input')
+def iter_toned_conv(syls):
+    for syl in syls:
+        for sylt in add_all_tones(syl):
+            yield ConvRow(sylt, sylt, 900)
 
-    freq_has_conv = []
-    conv_has_freq = []
+def add_toned_syllables(freq_dat, conv_dat, syls):
+    extend_unique(freq_dat, iter_toned_freq(syls), freq_key)
+    extend_unique(conv_dat, iter_toned_conv(syls), conv_key)
 
-    for word in freq:
-        if word['input'] in unique_conv_inputs:
-            freq_has_conv.append(word)
-    
-    for word in conv:
-        if word['input'] in unique_freq_inputs:
-            conv_has_freq.append(word)
+def dedupe_syllables(syl_dat):
+    return sorted(list(set(syl_dat)), key=syls_sort_key)
 
+def find_common_inputs(freq, conv):
+    freq_has_conv = semi_join(freq, input_set(conv))
+    conv_has_freq = semi_join(conv, input_set(freq))
     freq = sorted(freq_has_conv, key=freq_sort_key)
     conv = sorted(conv_has_freq, key=conv_sort_key)
     return [freq, conv]
 
+def iter_input_sequences(freq):
+    for rows in batched(freq, BATCH_SIZE):
+        words = [row.input for row in rows]
+        for word, seqs in zip(words, to_input_sequences_column(words)):
+            for numeric, telex in seqs:
+                yield InputRow(word, numeric, telex)
+
 def get_input_sequences(freq):
-    input_seqs = []
+    return list(iter_input_sequences(freq))
+
+def iter_syllable_keys(freq):
     for row in freq:
-        row_seqs = to_input_sequences(row['input'])
-        for pair in row_seqs:
-            input_seqs.append({
-                'input': row['input'],
-                'numeric': pair[0],
-                'telex': pair[1]
-            })
-    return input_seqs
+        numeric, telex, toneless = word_keys(row.input)
+        yield KeyRow(row.input, numeric, telex, toneless)
 
+def get_syllable_keys(freq):
+    return list(iter_syllable_keys(freq))
+
+def iter_index_syllables(syls, freq):
+    """Every syllable with its tones, and every syllable of an input
+    together with its toneless form"""
+    for syl in syls:
+        yield from add_all_tones(syl)
+    for row in freq:
+        for syl in SYLLABLE_SPLIT.split(row.input):
+            yield syl
+            yield normalize_loji(syl, True)
+
+def get_syllable_index(syls, freq):
+    return syllable_key_rows(iter_index_syllables(syls, freq))
 
 def get_extra_syllables(syls, freq, conv):
     ret = set(syls)
     for x in freq:
-        for syl in x["input"].split(' '):
+        for syl in x.input.split(' '):
             ret.add(normalize_loji(syl, True))
     for x in conv:
-        for syl in x["input"].split(' '):
+        for syl in x.input.split(' '):
             ret.add(normalize_loji(syl, True))
     return sorted(list(ret), key=syls_sort_key)
 
+##############################################################################
+#
+# Streaming pipeline
+#
+# Every stage is a generator over (priority, seq, row) tuples. `priority`
+# is 0 for rows read from a file and 1 for generated rows, so file rows
+# always win deduplication, and `seq` is the arrival order used to break
+# ties exactly like the in-memory path does. All sorting goes through
+# extsort.external_sort, which keeps at most `run_size` rows in memory.
+#
+##############################################################################
+
+class Replay:
+    """Re-iterable view that re-runs `fn(source)` on every pass"""
+
+    def __init__(self, fn, source):
+        self.fn = fn
+        self.source = source
+
+    def __iter__(self):
+        return iter(self.fn(self.source))
+
+class StreamedRows(Replay):
+    """Re-iterable rows of a sorted, tagged stream"""
+
+    def __init__(self, tagged):
+        super().__init__(untag, tagged)
+
+    def __len__(self):
+        return len(self.source)
+
+def tag(rows, priority, seq):
+    for row in rows:
+        yield (priority, next(seq), row)
+
+def untag(tagged):
+    for t in tagged:
+        yield t[2]
+
+def stream_dedupe(tagged, key, rank, run_size):
+    ordered = external_sort(tagged, lambda t: (key(t[2]), t[0], rank(t[2]), t[1]), run_size)
+    for _, group in itertools.groupby(ordered, lambda t: key(t[2])):
+        yield next(group)
+
+def stream_semi_join(tagged, inputs):
+    """Keep rows whose input occurs in `inputs`; both sorted by input"""
+    inputs = iter(inputs)
+    current = next(inputs, None)
+    for t in tagged:
+        input = t[2].input
+        while current is not None and current < input:
+            current = next(inputs, None)
+        if current == input:
+            yield t
+
+def stream_datasets(freq_file, conv_file, toned_syls, exclude_zeros, hanji_first, run_size=RUN_SIZE):
+    seq = itertools.count()
+    freq = itertools.chain(
+        tag(iter_freq_csv(freq_file, exclude_zeros), 0, seq),
+        tag(iter_toned_freq(toned_syls), 1, seq))
+    freq = SpilledRun(stream_dedupe(freq, freq_key, freq_sort_key, run_size))
+
+    seq = itertools.count()
+    conv = itertools.chain(
+        tag(iter_conv_csv(conv_file, hanji_first), 0, seq),
+        tag(iter_toned_conv(toned_syls), 1, seq))
+    conv = SpilledRun(stream_dedupe(conv, conv_key, lambda x: -x.weight, run_size))
+
+    freq_has_conv = stream_semi_join(freq, (t[2].input for t in conv))
+    conv_has_freq = stream_semi_join(conv, (t[2].input for t in freq))
+    freq_sorted = external_sort(freq_has_conv, lambda t: (freq_sort_key(t[2]), t[1]), run_size)
+    conv_sorted = external_sort(conv_has_freq, lambda t: (conv_sort_key(t[2]), t[1]), run_size)
+    freq.close()
+    conv.close()
+    return [StreamedRows(freq_sorted), StreamedRows(conv_sorted)]
+
+##############################################################################
+#
+# Concurrent ingestion
+#
+# The source files are independent until find_common_inputs, so each one
+# is parsed, normalized and deduplicated as its own task on a process
+# pool. The main process only waits on a dataset when it first needs it,
+# so symbols and emoji keep parsing while the main tables are joined and
+# written.
+#
+##############################################################################
+
+# Each returns the deduplicated rows and the number of rows read
+
+def ingest_frequencies(csv_file, exclude_zeros):
+    rows = parse_freq_csv(csv_file, exclude_zeros)
+    return dedupe_frequencies(rows), len(rows)
+
+def ingest_conversions(csv_file, sort_hanji_first):
+    rows = parse_conv_csv(csv_file, sort_hanji_first)
+    return dedupe_conversions(rows), len(rows)
+
+def ingest_syllables(txt_file):
+    rows = parse_syls_txt(txt_file)
+    return dedupe_syllables(rows), len(rows)
+
+class DeferredFuture(Future):
+    """Runs its task when the result is first asked for"""
+
+    def __init__(self, fn, args):
+        super().__init__()
+        self.task = (fn, args)
+
+    def result(self, timeout=None):
+        if self.task is not None:
+            fn, args = self.task
+            self.task = None
+            try:
+                self.set_result(fn(*args))
+            except Exception as e:
+                self.set_exception(e)
+        return super().result(timeout)
+
+class InlineExecutor:
+    """Runs each task in the main process when its result is collected,
+    so that the time goes to the stage collecting it; used when --jobs
+    is 1"""
+
+    def submit(self, fn, *args):
+        return DeferredFuture(fn, args)
+
+    def shutdown(self, wait=True):
+        pass
+
+def get_executor(jobs):
+    return ProcessPoolExecutor(jobs) if jobs > 1 else InlineExecutor()
+
+def ingest_sources(executor, args, datasets=True):
+    """Submit every source file, largest first; returns futures by name
+
+    With `datasets` False (a cache hit), only symbols and emoji are read.
+    """
+    tasks = {}
+    if datasets and not args.streaming:
+        tasks['conversions'] = (ingest_conversions, args.conversions, args.hanji_first)
+        tasks['frequencies'] = (ingest_frequencies, args.frequencies, args.exclude_zeros)
+    if datasets:
+        tasks['syllables'] = (ingest_syllables, args.syllables)
+    if args.emoji is not None:
+        tasks['emoji'] = (parse_emoji_csv, args.emoji)
+    if args.symbols is not None:
+        tasks['symbols'] = (parse_symbols_tsv, args.symbols)
+    return {name: executor.submit(*task) for name, task in tasks.items()}
+
+def collect(sources, name):
+    future = sources.get(name)
+    return future.result() if future is not None else None
+
 ##############################################################################
 #
 # SQL builder functions
 #
 ##############################################################################
 
-def init_db_sql():
+def drop_tables_sql():
     return """DROP TABLE IF EXISTS "metadata";
 DROP TABLE IF EXISTS "conversions";
 DROP TABLE IF EXISTS "frequency";
 DROP TABLE IF EXISTS "input_numeric";
 DROP TABLE IF EXISTS "input_telex";
+DROP VIEW IF EXISTS "lookup_compact";
+DROP TABLE IF EXISTS "input_syllables";
+DROP VIEW IF EXISTS "lookup_prefix_numeric";
+DROP VIEW IF EXISTS "lookup_prefix_telex";
+DROP TABLE IF EXISTS "prefix_numeric";
+DROP TABLE IF EXISTS "prefix_telex";
+DROP TABLE IF EXISTS "top_numeric";
+DROP TABLE IF EXISTS "top_telex";
 DROP TABLE IF EXISTS "syllables";
+DROP TABLE IF EXISTS "syllable_keys";
 DROP INDEX IF EXISTS "unigram_freq_gram_idx";
 DROP TABLE IF EXISTS "unigram_freq";
 DROP INDEX IF EXISTS "bigram_freq_gram_index";
 DROP TABLE IF EXISTS "bigram_freq";
+DROP TABLE IF EXISTS "lm_score";
+"""
 
+def init_tables_sql():
+    return drop_tables_sql() + """
 CREATE TABLE IF NOT EXISTS "metadata" (
     "key"	TEXT,
     "value"	INTEGER
@@ -264,8 +444,10 @@ CREATE TABLE IF NOT EXISTS "bigram_freq" (
     "n"	INTEGER NOT NULL,
     UNIQUE("lgram","rgram")
 );
+"""
 
-CREATE INDEX "conversions_input_id_covering_index" ON "conversions" (
+def init_indexes_sql():
+    return """CREATE INDEX "conversions_input_id_covering_index" ON "conversions" (
 	"input_id",
     "output",
     "weight",
@@ -292,7 +474,10 @@ CREATE INDEX "bigram_gram_index" ON "bigram_freq" (
     "lgram"
 );
 
-DROP VIEW IF EXISTS "lookup_numeric";
+""" + lookup_views_sql()
+
+def lookup_views_sql():
+    return """DROP VIEW IF EXISTS "lookup_numeric";
 CREATE VIEW "lookup_numeric" (
     key_sequence,
     input,
@@ -349,69 +534,328 @@ FROM unigram_freq AS u
 LEFT JOIN bigram_freq AS b ON u.gram = b.rgram;
 """
 
-def symbol_row_sql(row):
-    return f'("row[]"'
+def init_db_sql():
+    return init_tables_sql() + '\n' + init_indexes_sql()
+
+def compact_tables_sql():
+    return """CREATE TABLE IF NOT EXISTS "input_syllables" (
+    "input_id"          INTEGER PRIMARY KEY,
+    "numeric"           TEXT NOT NULL,
+    "telex"             TEXT NOT NULL,
+    "toneless"          TEXT NOT NULL,
+    "numeric_skeleton"  TEXT NOT NULL,
+    "telex_skeleton"    TEXT NOT NULL,
+    FOREIGN KEY("input_id") REFERENCES "frequency"("id")
+);
+"""
 
-def frequency_row_sql(row):
-    return f'("{row["input"]}", {row["freq"]}, {row["chhan_id"]})'
+def compact_indexes_sql():
+    return """DROP VIEW IF EXISTS "lookup_numeric";
+DROP VIEW IF EXISTS "lookup_telex";
+DROP TABLE IF EXISTS "input_numeric";
+DROP TABLE IF EXISTS "input_telex";
 
-def frequency_sql(data):
-    sql = 'INSERT INTO "frequency" ("input", "freq", "chhan_id") VALUES\n'
-    values = [frequency_row_sql(x) for x in data]
-    sql += ',\n'.join(values) + ';\n'
-    return sql
+CREATE INDEX "input_syllables_numeric_index" ON "input_syllables" (
+    "numeric_skeleton"
+);
+
+CREATE INDEX "input_syllables_telex_index" ON "input_syllables" (
+    "telex_skeleton"
+);
+
+DROP VIEW IF EXISTS "lookup_compact";
+CREATE VIEW "lookup_compact" (
+    numeric_skeleton,
+    telex_skeleton,
+    numeric,
+    telex,
+    toneless,
+    input,
+    input_id,
+    output,
+    weight,
+    category,
+    annotation
+) AS SELECT
+    s.numeric_skeleton,
+    s.telex_skeleton,
+    s.numeric,
+    s.telex,
+    s.toneless,
+    f.input,
+    s.input_id,
+    c.output,
+    c.weight,
+    c.category,
+    c.annotation
+FROM input_syllables AS s
+JOIN frequency AS f ON f.id = s.input_id
+JOIN conversions AS c ON f.id = c.input_id;
+"""
+
+def prefix_tables_sql():
+    return """CREATE TABLE IF NOT EXISTS "prefix_numeric" (
+    "prefix"    TEXT NOT NULL,
+    "freq"      INTEGER NOT NULL,
+    "chhan_id"  INTEGER NOT NULL,
+    "input_id"  INTEGER NOT NULL,
+    PRIMARY KEY("prefix","freq" DESC,"chhan_id","input_id"),
+    FOREIGN KEY("input_id") REFERENCES "frequency"("id")
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS "prefix_telex" (
+    "prefix"    TEXT NOT NULL,
+    "freq"      INTEGER NOT NULL,
+    "chhan_id"  INTEGER NOT NULL,
+    "input_id"  INTEGER NOT NULL,
+    PRIMARY KEY("prefix","freq" DESC,"chhan_id","input_id"),
+    FOREIGN KEY("input_id") REFERENCES "frequency"("id")
+) WITHOUT ROWID;
+"""
+
+def prefix_views_sql():
+    return """DROP VIEW IF EXISTS "lookup_prefix_numeric";
+CREATE VIEW "lookup_prefix_numeric" (
+    prefix,
+    input,
+    input_id,
+    output,
+    weight,
+    category,
+    annotation
+) AS SELECT
+    p.prefix,
+    f.input,
+    p.input_id,
+    c.output,
+    c.weight,
+    c.category,
+    c.annotation
+FROM prefix_numeric AS p
+JOIN frequency AS f ON f.id = p.input_id
+JOIN conversions AS c ON f.id = c.input_id;
+
+DROP VIEW IF EXISTS "lookup_prefix_telex";
+CREATE VIEW "lookup_prefix_telex" (
+    prefix,
+    input,
+    input_id,
+    output,
+    weight,
+    category,
+    annotation
+) AS SELECT
+    p.prefix,
+    f.input,
+    p.input_id,
+    c.output,
+    c.weight,
+    c.category,
+    c.annotation
+FROM prefix_telex AS p
+JOIN frequency AS f ON f.id = p.input_id
+JOIN conversions AS c ON f.id = c.input_id;
+"""
 
-def conversion_row_sql(row):
-    return f'INSERT INTO "conversions" ("input_id", "output", "weight") SELECT "id", "{row["output"]}", {row["weight"]} FROM "frequency" WHERE "input"="{row["input"]}";'
+def top_candidates_tables_sql():
+    return """CREATE TABLE IF NOT EXISTS "top_numeric" (
+    "key_sequence"  TEXT NOT NULL,
+    "rank"          INTEGER NOT NULL,
+    "input"         TEXT NOT NULL,
+    "input_id"      INTEGER NOT NULL,
+    "output"        TEXT NOT NULL,
+    "weight"        INTEGER,
+    "category"      INTEGER,
+    "annotation"    TEXT,
+    "candidates"    INTEGER NOT NULL,
+    PRIMARY KEY("key_sequence","rank")
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS "top_telex" (
+    "key_sequence"  TEXT NOT NULL,
+    "rank"          INTEGER NOT NULL,
+    "input"         TEXT NOT NULL,
+    "input_id"      INTEGER NOT NULL,
+    "output"        TEXT NOT NULL,
+    "weight"        INTEGER,
+    "category"      INTEGER,
+    "annotation"    TEXT,
+    "candidates"    INTEGER NOT NULL,
+    PRIMARY KEY("key_sequence","rank")
+) WITHOUT ROWID;
+"""
 
-def conversion_sql(data):
-    values = [conversion_row_sql(row) for row in data]
-    sql = '\n'.join(values) + '\n'
-    return sql
+def top_candidates_insert_sql(mode, top_n):
+    return f"""INSERT INTO "top_{mode}" SELECT * FROM (SELECT
+    n.key_sequence,
+    row_number() OVER (PARTITION BY n.key_sequence ORDER BY {RANK_ORDER}) AS rank,
+    f.input,
+    n.input_id,
+    c.output,
+    c.weight,
+    c.category,
+    c.annotation,
+    count(*) OVER (PARTITION BY n.key_sequence) AS candidates
+FROM input_{mode} AS n
+JOIN frequency AS f ON f.id = n.input_id
+JOIN conversions AS c ON f.id = c.input_id)
+WHERE rank <= {top_n};
+"""
 
-def telex_input_row_sql(row):
-    return f'INSERT INTO "input_telex" ("input_id", "key_sequence") SELECT "id", "{row["telex"]}" FROM "frequency" WHERE "input"="{row["input"]}";'
+def top_candidates_sql(top_n):
+    """Fill "top_numeric" and "top_telex" from the loaded tables"""
+    return top_candidates_insert_sql('numeric', top_n) + '\n' + top_candidates_insert_sql('telex', top_n) + '\n'
 
-def numeric_input_row_sql(row):
-    return f'INSERT INTO "input_numeric" ("input_id", "key_sequence") SELECT "id", "{row["numeric"]}" FROM "frequency" WHERE "input"="{row["input"]}";'
+def syllable_index_tables_sql():
+    return """CREATE TABLE IF NOT EXISTS "syllable_keys" (
+    "syllable"  TEXT NOT NULL PRIMARY KEY,
+    "numeric"   TEXT NOT NULL,
+    "telex"     TEXT NOT NULL
+) WITHOUT ROWID;
+"""
 
-def input_sql(data):
-    numeric = [numeric_input_row_sql(row) for row in data]
-    telex = [telex_input_row_sql(row) for row in data]
-    sql = '\n'.join(numeric) + '\n' + '\n'.join(telex) + '\n'
-    return sql
+def syllable_index_indexes_sql():
+    return """CREATE INDEX IF NOT EXISTS "syllable_keys_numeric_index" ON "syllable_keys" ("numeric");
+CREATE INDEX IF NOT EXISTS "syllable_keys_telex_index" ON "syllable_keys" ("telex");
+"""
 
-def syls_sql(data):
-    sql = 'INSERT INTO "syllables" ("input") VALUES\n'
-    values = ',\n'.join([f'("{x}")' for x in data])
-    sql += values + ';\n'
-    return sql
+def syllable_keys_values(row):
+    joined = row.toneless.replace(' ', '')
+    return (row.numeric, row.telex, row.toneless, numeric_skeleton(joined), telex_skeleton(joined))
 
-def build_sql(freq, conv, inputs, syls):
-    sql = """
-PRAGMA journal_mode = OFF;
+BULK_LOAD_PRAGMAS = """PRAGMA journal_mode = OFF;
 PRAGMA cache_size = 7500000;
 PRAGMA synchronous = OFF;
 PRAGMA temp_store = 2;
-BEGIN TRANSACTION;
-    """
-    sql += init_db_sql()
-    sql += frequency_sql(freq)
-    sql += conversion_sql(conv)
-    sql += input_sql(inputs)
-    sql += syls_sql(syls) if (len(syls) > 0) else ""
-    sql += """
-COMMIT;
-PRAGMA journal_mode = WAL;
+"""
+
+RUNTIME_PRAGMAS = """PRAGMA journal_mode = WAL;
 PRAGMA cache_size = -2000;
 PRAGMA synchronous = NORMAL;
 PRAGMA temp_store = 0;
-    """
-    return sql
+"""
 
-def write_sql(sql_file, sql):
-    with open(sql_file, 'w', encoding='utf-8') as f:
-        f.write(sql)
+
+##############################################################################
+#
+# Read-optimized profile
+#
+# For databases that are shipped with the IME and only read afterwards.
+# The lookup tables are WITHOUT ROWID tables clustered on the columns
+# the views search by, so the covering indexes of the default schema are
+# not needed. The file is written with a fixed page size, no auto_vacuum
+# and a rollback journal (no -wal/-shm files next to a read-only DB),
+# and ANALYZE statistics are included for the query planner.
+#
+##############################################################################
+
+PROFILES = ['default', 'read-optimized']
+
+READ_OPTIMIZED_PAGE_SIZE = 4096
+
+def read_optimized_tables_sql():
+    return drop_tables_sql() + """
+CREATE TABLE IF NOT EXISTS "metadata" (
+    "key"	TEXT,
+    "value"	INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS "frequency" (
+	"id"        INTEGER PRIMARY KEY,
+    "input"     TEXT NOT NULL,
+	"freq"      INTEGER,
+	"chhan_id"  INTEGER,
+	UNIQUE("input")
+);
+
+CREATE TABLE IF NOT EXISTS "conversions" (
+    "input_id"     INTEGER NOT NULL,
+    "output"       TEXT NOT NULL,
+    "weight"       INTEGER,
+    "category"     INTEGER,
+    "annotation"   TEXT,
+    PRIMARY KEY("input_id","output"),
+    FOREIGN KEY("input_id") REFERENCES "frequency"("id")
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS "input_numeric" (
+    "input_id"      INTEGER NOT NULL,
+    "key_sequence"  TEXT NOT NULL,
+    PRIMARY KEY("key_sequence","input_id"),
+    FOREIGN KEY("input_id") REFERENCES "frequency"("id")
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS "input_telex" (
+    "input_id"      INTEGER NOT NULL,
+    "key_sequence"  TEXT NOT NULL,
+    PRIMARY KEY("key_sequence","input_id"),
+    FOREIGN KEY("input_id") REFERENCES "frequency"("id")
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS "syllables" (
+    "input"   TEXT NOT NULL PRIMARY KEY
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS "unigram_freq" (
+    "gram"	TEXT NOT NULL PRIMARY KEY,
+    "n"	INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS "bigram_freq" (
+    "lgram"	TEXT NOT NULL,
+    "rgram"	TEXT NOT NULL,
+    "n"	INTEGER NOT NULL,
+    PRIMARY KEY("rgram","lgram")
+) WITHOUT ROWID;
+"""
+
+def read_optimized_indexes_sql():
+    return lookup_views_sql()
+
+READ_OPTIMIZED_PAGE_PRAGMAS = f"""PRAGMA page_size = {READ_OPTIMIZED_PAGE_SIZE};
+PRAGMA auto_vacuum = NONE;
+"""
+
+READ_OPTIMIZED_RUNTIME_PRAGMAS = """ANALYZE;
+PRAGMA journal_mode = DELETE;
+PRAGMA cache_size = -2000;
+PRAGMA synchronous = NORMAL;
+PRAGMA temp_store = 0;
+"""
+
+def is_read_optimized(db_cur):
+    res = db_cur.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'conversions'").fetchone()
+    return res is not None and 'WITHOUT ROWID' in res[0]
+
+def schema_tables_sql(compact=False, profile='default', prefix_index=False, top_n=0, syllable_index=False):
+    tables = read_optimized_tables_sql() if profile == 'read-optimized' else init_tables_sql()
+    if compact:
+        tables += compact_tables_sql()
+    if prefix_index:
+        tables += prefix_tables_sql()
+    if top_n:
+        tables += top_candidates_tables_sql()
+    if syllable_index:
+        tables += syllable_index_tables_sql()
+    return tables
+
+def schema_indexes_sql(compact=False, profile='default', prefix_index=False, top_n=0, syllable_index=False):
+    indexes = read_optimized_indexes_sql() if profile == 'read-optimized' else init_indexes_sql()
+    if compact:
+        indexes += compact_indexes_sql()
+    if prefix_index:
+        indexes += prefix_views_sql()
+    if top_n:
+        indexes += top_candidates_sql(top_n)
+    if syllable_index:
+        indexes += syllable_index_indexes_sql()
+    return indexes
+
+def bulk_load_pragmas(profile='default'):
+    return BULK_LOAD_PRAGMAS + (READ_OPTIMIZED_PAGE_PRAGMAS if profile == 'read-optimized' else '')
+
+def runtime_pragmas(profile='default'):
+    return READ_OPTIMIZED_RUNTIME_PRAGMAS if profile == 'read-optimized' else RUNTIME_PRAGMAS
 
 ##############################################################################
 #
@@ -419,7 +863,7 @@ def write_sql(sql_file, sql):
 #
 ##############################################################################
 
-def build_symbols_table(db_cur, symbol_tsv):
+def build_symbols_table(db_cur, symbols):
     db_cur.executescript("""
     DROP TABLE IF EXISTS "symbols";
     CREATE TABLE "symbols" (
@@ -430,14 +874,17 @@ def build_symbols_table(db_cur, symbol_tsv):
         "annotation"   TEXT
     );
     """)
-    dat = []
-    with open(symbol_tsv, 'r') as f:
-        rows = csv.DictReader(f, delimiter='\t')
-        dat = [(x['input'], x['output'], x['category']) for x in rows]
-    db_cur.executemany('INSERT INTO "symbols" ("input", "output", "category") VALUES (?, ?, ?);', dat)
+    db_cur.executemany('INSERT INTO "symbols" ("input", "output", "category") VALUES (?, ?, ?);', symbols)
 
-def build_emoji_table(db_cur, emoji_csv):
+def has_fts5(db_cur):
+    return ('ENABLE_FTS5',) in db_cur.execute('PRAGMA compile_options').fetchall()
+
+def build_emoji_table(db_cur, emoji):
+    """Emoji with a category index, the "recent" subset and, where SQLite
+    has FTS5, a prefix-searchable index of the short names"""
     db_cur.executescript("""
+    DROP TABLE IF EXISTS "emoji_fts";
+    DROP TABLE IF EXISTS "emoji_recent";
     DROP TABLE IF EXISTS "emoji";
     CREATE TABLE "emoji" (
         id INTEGER PRIMARY KEY,
@@ -446,32 +893,465 @@ def build_emoji_table(db_cur, emoji_csv):
         category INTEGER NOT NULL,
         code TEXT NOT NULL
     );
+    CREATE TABLE "emoji_recent" (
+        "id"    INTEGER PRIMARY KEY,
+        FOREIGN KEY("id") REFERENCES "emoji"("id")
+    );
+    """)
+    db_cur.executemany('INSERT INTO "emoji" ("id", "emoji", "short_name", "category", "code") VALUES (?, ?, ?, ?, ?);', (x[:5] for x in emoji))
+    db_cur.executemany('INSERT INTO "emoji_recent" ("id") VALUES (?);', ((x[0],) for x in emoji if x[5]))
+    # Emoji of a category in Unicode order is a range of this index
+    db_cur.execute('CREATE INDEX "emoji_category_index" ON "emoji" ("category", "id");')
+    if not has_fts5(db_cur):
+        print('SQLite was built without FTS5; skipping the "emoji_fts" index')
+        return
+    db_cur.executescript("""
+    CREATE VIRTUAL TABLE "emoji_fts" USING fts5(
+        short_name,
+        content='emoji',
+        content_rowid='id',
+        prefix='1 2 3'
+    );
+    INSERT INTO "emoji_fts" ("emoji_fts") VALUES ('rebuild');
     """)
-    dat = []
-    with open(emoji_csv, 'r') as f:
-        rows = csv.DictReader(f)
-        filter(lambda x: x['recent'] == 1, rows)
-        dat = [(x['id'], x['emoji'], x['short_name'], x['category'],  x['code']) for x in rows]
-    db_cur.executemany('INSERT INTO "emoji" ("id", "emoji", "short_name", "category", "code") VALUES (?, ?, ?, ?, ?);', dat)
 
-def build_sqlite_db(db_file, freq, conv, inputs, syls, symbol_file, emoji_file):
-    print("Building database, please wait...", end='')
+def executemany_batched(db_cur, sql, rows, batch_size=BATCH_SIZE):
+    for batch in batched(rows, batch_size):
+        db_cur.executemany(sql, batch)
+
+class DbSink:
+    """Row sink that inserts batches with bound parameters"""
+
+    def __init__(self, db_cur):
+        self.db_cur = db_cur
+
+    def insert(self, table, columns, batch):
+        names = ', '.join(f'"{x}"' for x in columns)
+        params = ', '.join('?' for x in columns)
+        self.db_cur.executemany(f'INSERT INTO "{table}" ({names}) VALUES ({params});', batch)
+
+def insert_batched(sinks, table, columns, rows, batch_size=BATCH_SIZE):
+    """Send each batch of rows to every sink (DbSink or SqlDumpWriter)"""
+    for batch in batched(rows, batch_size):
+        for sink in sinks:
+            sink.insert(table, columns, batch)
+        count_rows(table, len(batch))
+
+def assign_frequency_ids(freq):
+    return {row.input: id for id, row in enumerate(freq, start=1)}
+
+def load_frequency(sinks, freq, freq_ids):
+    rows = ((freq_ids[x.input], x.input, x.freq, x.chhan_id) for x in freq)
+    insert_batched(sinks, 'frequency', ('id', 'input', 'freq', 'chhan_id'), rows)
+
+def load_conversions(sinks, conv, freq_ids):
+    rows = ((freq_ids[x.input], x.output, x.weight) for x in conv if x.input in freq_ids)
+    insert_batched(sinks, 'conversions', ('input_id', 'output', 'weight'), rows)
+
+def load_inputs(sinks, inputs, freq_ids):
+    numeric = ((freq_ids[x.input], x.numeric) for x in inputs if x.input in freq_ids)
+    insert_batched(sinks, 'input_numeric', ('input_id', 'key_sequence'), numeric)
+    telex = ((freq_ids[x.input], x.telex) for x in inputs if x.input in freq_ids)
+    insert_batched(sinks, 'input_telex', ('input_id', 'key_sequence'), telex)
+
+def load_syllable_keys(sinks, keys, freq_ids):
+    rows = ((freq_ids[x.input],) + syllable_keys_values(x) for x in keys if x.input in freq_ids)
+    insert_batched(sinks, 'input_syllables', ('input_id', 'numeric', 'telex', 'toneless', 'numeric_skeleton', 'telex_skeleton'), rows)
+
+def load_syllables(sinks, syls):
+    rows = ((x,) for x in syls)
+    insert_batched(sinks, 'syllables', ('input',), rows)
+
+def prefix_ranks(freq, freq_ids):
+    """{input: (freq, chhan_id, input_id)}, the rank of an input in the
+    prefix tables"""
+    return {x.input: (x.freq, x.chhan_id, freq_ids[x.input]) for x in freq}
+
+def iter_prefix_rows(inputs, ranks, column):
+    """(prefix, freq, chhan_id, input_id) rows; `inputs` must be grouped
+    by input"""
+    for input, group in itertools.groupby(inputs, key=lambda x: x.input):
+        if input in ranks:
+            for prefix in key_prefixes(getattr(x, column) for x in group):
+                yield (prefix,) + ranks[input]
+
+PREFIX_COLUMNS = ('prefix', 'freq', 'chhan_id', 'input_id')
+
+def load_prefixes(sinks, inputs, ranks):
+    insert_batched(sinks, 'prefix_numeric', PREFIX_COLUMNS, iter_prefix_rows(inputs, ranks, 'numeric'))
+    insert_batched(sinks, 'prefix_telex', PREFIX_COLUMNS, iter_prefix_rows(inputs, ranks, 'telex'))
+
+def load_syllable_index(sinks, syls, freq):
+    rows = get_syllable_index(syls, freq)
+    insert_batched(sinks, 'syllable_keys', ('syllable', 'numeric', 'telex'), rows)
+
+def load_rows(sinks, freq, conv, inputs, syls, compact=False, prefix_index=False, syllable_index=False):
+    freq_ids = assign_frequency_ids(freq)
+    load_frequency(sinks, freq, freq_ids)
+    load_conversions(sinks, conv, freq_ids)
+    if compact:
+        load_syllable_keys(sinks, inputs, freq_ids)
+    else:
+        load_inputs(sinks, inputs, freq_ids)
+    if prefix_index:
+        load_prefixes(sinks, inputs, prefix_ranks(freq, freq_ids))
+    load_syllables(sinks, syls)
+    if syllable_index:
+        load_syllable_index(sinks, syls, freq)
+
+def begin_sql_dump(sql_writer, compact=False, profile='default', prefix_index=False, top_n=0, syllable_index=False):
+    sql_writer.write(bulk_load_pragmas(profile) + 'BEGIN TRANSACTION;\n' + schema_tables_sql(compact, profile, prefix_index, top_n, syllable_index))
+
+def end_sql_dump(sql_writer, compact=False, profile='default', prefix_index=False, top_n=0, syllable_index=False):
+    sql_writer.write(schema_indexes_sql(compact, profile, prefix_index, top_n, syllable_index) + 'COMMIT;\n' + runtime_pragmas(profile))
+
+def write_sql_dump(sql_writer, freq, conv, inputs, syls, compact=False, profile='default', prefix_index=False, top_n=0, syllable_index=False):
+    with stage('write_sql_dump'):
+        begin_sql_dump(sql_writer, compact, profile, prefix_index, top_n, syllable_index)
+        load_rows([sql_writer], freq, conv, inputs, syls, compact, prefix_index, syllable_index)
+        end_sql_dump(sql_writer, compact, profile, prefix_index, top_n, syllable_index)
+
+def load_main_tables(con, freq, conv, inputs, syls, compact=False, sql_writer=None, profile='default', prefix_index=False, top_n=0, syllable_index=False):
+    """Bulk-load the main tables, optionally teeing every row to a SQL dump"""
+    cur = con.cursor()
+    cur.executescript(bulk_load_pragmas(profile) + schema_tables_sql(compact, profile, prefix_index, top_n, syllable_index))
+    sinks = [DbSink(cur)]
+    if sql_writer is not None:
+        begin_sql_dump(sql_writer, compact, profile, prefix_index, top_n, syllable_index)
+        sinks.append(sql_writer)
+    with stage('load_rows'):
+        load_rows(sinks, freq, conv, inputs, syls, compact, prefix_index, syllable_index)
+        con.commit()
+    with stage('create_indexes'):
+        cur.executescript(schema_indexes_sql(compact, profile, prefix_index, top_n, syllable_index))
+    if sql_writer is not None:
+        end_sql_dump(sql_writer, compact, profile, prefix_index, top_n, syllable_index)
+
+def split_inputs(freq, conv, inputs, shards):
+    """(first id, inputs, (seq, conversion) pairs, key sequences or None)
+    of each shard of contiguous "frequency" ids"""
+    ranges = shard_ranges(len(freq), shards)
+    shard_of = {}
+    for shard, (first, end) in enumerate(ranges):
+        for row in freq[first - 1:end - 1]:
+            shard_of[row.input] = shard
+    conv_parts = [[] for _ in ranges]
+    for seq, row in enumerate(conv, start=1):
+        shard = shard_of.get(row.input)
+        if shard is not None:
+            conv_parts[shard].append((seq, row))
+    input_parts = [None] * shards
+    if inputs is not None:
+        input_parts = [[] for _ in ranges]
+        for row in inputs:
+            shard = shard_of.get(row.input)
+            if shard is not None:
+                input_parts[shard].append(row)
+    return [(first, freq[first - 1:end - 1], conv_parts[i], input_parts[i]) for i, (first, end) in enumerate(ranges)]
+
+def write_shard(shard_dir, shard, first_id, freq, conv, inputs, compact=False, prefix_index=False):
+    """Write one shard file and its dump fragments; run on a worker
+
+    `freq` are the inputs numbered from `first_id`, `conv` their
+    conversions as (position in the whole table, row) pairs, and
+    `inputs` their key sequences, or None to derive them here. Returns
+    the tables written and the number of rows.
+    """
+    if inputs is None:
+        inputs = get_syllable_keys(freq) if compact else get_input_sequences(freq)
+    freq_ids = {row.input: id for id, row in enumerate(freq, start=first_id)}
+    db_sink = ShardSink(shard_file(shard_dir, shard), BULK_LOAD_PRAGMAS)
+    sinks = [db_sink, DumpFragments(shard_dir, shard)]
+    load_frequency(sinks, freq, freq_ids)
+    # The dump of the conversions is read back in table order from all shards
+    rows = ((seq, freq_ids[x.input], x.output, x.weight) for seq, x in conv)
+    insert_batched([db_sink], 'conversions', ('seq', 'input_id', 'output', 'weight'), rows)
+    if compact:
+        load_syllable_keys(sinks, inputs, freq_ids)
+    else:
+        load_inputs(sinks, inputs, freq_ids)
+    if prefix_index:
+        load_prefixes(sinks, inputs, prefix_ranks(freq, freq_ids))
+    for sink in sinks:
+        sink.close()
+    return db_sink.tables, db_sink.rows
+
+def write_shard_dump(con, sql_writer, shard_dir, layout):
+    """Dump the shard tables in load order, from the fragments or, for
+    tables merged on "seq", from the attached shards"""
+    cur = con.cursor()
+    for table, (columns, shards) in layout.items():
+        if 'seq' not in columns:
+            for shard in shards:
+                sql_writer.append(fragment_file(shard_dir, shard, table))
+            continue
+        names = [x for x in columns if x != 'seq']
+        for select in shard_selects(table, columns, shards):
+            insert_batched([sql_writer], table, names, cur.execute(select))
+
+def load_sharded_tables(con, db_file, freq, conv, inputs, syls, shards, compact=False, sql_writer=None, profile='default', prefix_index=False, top_n=0, syllable_index=False):
+    """Bulk-load the main tables from `shards` worker processes, each
+    deriving and writing the rows of one range of "frequency" ids, and
+    assemble the SQL dump from their output"""
+    cur = con.cursor()
+    cur.executescript(bulk_load_pragmas(profile) + schema_tables_sql(compact, profile, prefix_index, top_n, syllable_index))
+    if sql_writer is not None:
+        begin_sql_dump(sql_writer, compact, profile, prefix_index, top_n, syllable_index)
+    with stage('split_inputs'):
+        tasks = split_inputs(freq, conv, inputs, shards)
+    # Next to the database, so that the shards are on the same disk
+    parent = os.path.dirname(os.path.abspath(db_file))
+    with tempfile.TemporaryDirectory(prefix='khiin-shards-', dir=parent) as shard_dir:
+        with ProcessPoolExecutor(shards) as pool:
+            futures = [pool.submit(write_shard, shard_dir, i, *task, compact, prefix_index) for i, task in enumerate(tasks)]
+            with stage('write_shards') as st:
+                results = [f.result() for f in futures]
+                st.rows_out = sum(n for _, n in results)
+        layout = shard_layout([tables for tables, _ in results])
+        shard_files = [shard_file(shard_dir, i) for i in range(shards)]
+        attach_shards(con, shard_files)
+        with stage('merge_shards') as st:
+            st.rows_out = merge_shards(con, layout)
+        if sql_writer is not None:
+            with stage('write_sql_dump'):
+                write_shard_dump(con, sql_writer, shard_dir, layout)
+        detach_shards(con, shard_files)
+    sinks = [DbSink(cur)] + ([sql_writer] if sql_writer is not None else [])
+    with stage('load_syllables'):
+        load_syllables(sinks, syls)
+        if syllable_index:
+            load_syllable_index(sinks, syls, freq)
+        con.commit()
+    with stage('create_indexes'):
+        cur.executescript(schema_indexes_sql(compact, profile, prefix_index, top_n, syllable_index))
+    if sql_writer is not None:
+        end_sql_dump(sql_writer, compact, profile, prefix_index, top_n, syllable_index)
+
+def build_sqlite_db(db_file, freq, conv, inputs, syls, symbols, emoji, compact=False, source_fingerprint=None, sql_writer=None, profile='default', prefix_index=False, top_n=0, syllable_index=False, shards=1):
+    print("Building database, please wait...")
+    con = sqlite3.connect(db_file)
+    if shards > 1:
+        load_sharded_tables(con, db_file, freq, conv, inputs, syls, shards, compact, sql_writer, profile, prefix_index, top_n, syllable_index)
+    else:
+        load_main_tables(con, freq, conv, inputs, syls, compact, sql_writer, profile, prefix_index, top_n, syllable_index)
+    cur = con.cursor()
+
+    if source_fingerprint is not None:
+        write_fingerprint(cur, source_fingerprint)
+        con.commit()
+
+    with stage('symbols_emoji') as st:
+        if symbols is not None:
+            build_symbols_table(cur, symbols)
+
+        if emoji is not None:
+            build_emoji_table(cur, emoji)
+        st.rows_out = len(symbols or []) + len(emoji or [])
+
+    con.commit()
+    with stage('vacuum'):
+        cur.executescript(runtime_pragmas(profile))
+        cur.executescript('VACUUM;')
+
+##############################################################################
+#
+# Incremental SQLite DB update
+#
+# Applies row-level differences between an existing database and the
+# new datasets in a single transaction. Existing inputs keep their
+# "frequency"."id"; new inputs get ids above the current maximum.
+#
+##############################################################################
+
+def get_source_fingerprint(args):
+    files = {
+        'frequencies': args.frequencies,
+        'conversions': args.conversions,
+        'syllables': args.syllables,
+        'symbols': args.symbols,
+        'emoji': args.emoji,
+    }
+    flags = {
+        'tones': args.tones,
+        'exclude_zeros': args.exclude_zeros,
+        'hanji_first': args.hanji_first,
+        'compact_inputs': args.compact_inputs,
+        'profile': args.profile,
+        'prefix_index': args.prefix_index,
+        'top_candidates': args.top_candidates,
+        'syllable_index': args.syllable_index,
+    }
+    return fingerprint(files, flags)
+
+def get_dataset_cache_key(args):
+    files = {
+        'frequencies': args.frequencies,
+        'conversions': args.conversions,
+        'syllables': args.syllables,
+    }
+    flags = {
+        'tones': args.tones,
+        'exclude_zeros': args.exclude_zeros,
+        'hanji_first': args.hanji_first,
+        'compact_inputs': args.compact_inputs,
+    }
+    return cache_key(files, flags)
+
+def has_table(db_cur, name):
+    res = db_cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", [name])
+    return res.fetchone() is not None
+
+def can_update_db(db_file, compact, profile='default', prefix_index=False, top_n=0, syllable_index=False):
+    # Read-optimized databases are meant to be shipped, not patched:
+    # their lookup tables have no index on "input_id" to delete by
+    if profile == 'read-optimized' or not Path(db_file).exists():
+        return False
+    con = sqlite3.connect(db_file)
+    try:
+        cur = con.cursor()
+        if read_fingerprint(cur) is None or is_read_optimized(cur):
+            return False
+        return (has_table(cur, 'input_syllables') == compact
+            and has_table(cur, 'prefix_numeric') == prefix_index
+            and has_table(cur, 'top_numeric') == bool(top_n)
+            and has_table(cur, 'syllable_keys') == syllable_index)
+    finally:
+        con.close()
+
+def delete_by_input_ids(db_cur, table, ids):
+    executemany_batched(db_cur, f'DELETE FROM "{table}" WHERE "input_id" = ?;', ((id,) for id in ids))
+
+def update_frequency(db_cur, freq, compact):
+    old = {}
+    for id, input, f, chhan_id in db_cur.execute('SELECT "id", "input", "freq", "chhan_id" FROM "frequency"'):
+        old[input] = (id, f, chhan_id)
+    new = {row.input: (row.freq, row.chhan_id) for row in freq}
+
+    removed_ids = sorted(old[x][0] for x in old if x not in new)
+    dependents = ['conversions', 'input_syllables'] if compact else ['conversions', 'input_numeric', 'input_telex']
+    for table in dependents:
+        delete_by_input_ids(db_cur, table, removed_ids)
+    executemany_batched(db_cur, 'DELETE FROM "frequency" WHERE "id" = ?;', ((id,) for id in removed_ids))
+
+    next_id = max((x[0] for x in old.values()), default=0) + 1
+    freq_ids = {}
+    added = []
+    changed = []
+    for row in freq:
+        if row.input in old:
+            id, f, chhan_id = old[row.input]
+            if (f, chhan_id) != (row.freq, row.chhan_id):
+                changed.append((row.freq, row.chhan_id, id))
+        else:
+            id = next_id
+            next_id += 1
+            added.append((id, row.input, row.freq, row.chhan_id))
+        freq_ids[row.input] = id
+
+    executemany_batched(db_cur, 'INSERT INTO "frequency" ("id", "input", "freq", "chhan_id") VALUES (?, ?, ?, ?);', added)
+    executemany_batched(db_cur, 'UPDATE "frequency" SET "freq" = ?, "chhan_id" = ? WHERE "id" = ?;', changed)
+    print(f' - frequency: +{len(added)} -{len(removed_ids)} ~{len(changed)}')
+    return freq_ids
+
+def update_conversions(db_cur, conv, freq_ids):
+    old = {}
+    for input_id, output, weight in db_cur.execute('SELECT "input_id", "output", "weight" FROM "conversions"'):
+        old[(input_id, output)] = weight
+    new = {(freq_ids[x.input], x.output): x.weight for x in conv if x.input in freq_ids}
+    diff = diff_dict(old, new)
+    executemany_batched(db_cur, 'DELETE FROM "conversions" WHERE "input_id" = ? AND "output" = ?;', diff.removed)
+    executemany_batched(db_cur, 'INSERT INTO "conversions" ("input_id", "output", "weight") VALUES (?, ?, ?);',
+        (k + (v,) for k, v in diff.added.items()))
+    executemany_batched(db_cur, 'UPDATE "conversions" SET "weight" = ? WHERE "input_id" = ? AND "output" = ?;',
+        ((v,) + k for k, v in diff.changed.items()))
+    print(f' - conversions: {diff}')
+
+def update_input_table(db_cur, table, new):
+    old = set(db_cur.execute(f'SELECT "input_id", "key_sequence" FROM "{table}"'))
+    diff = diff_set(old, new)
+    executemany_batched(db_cur, f'DELETE FROM "{table}" WHERE "input_id" = ? AND "key_sequence" = ?;', sorted(diff.removed))
+    executemany_batched(db_cur, f'INSERT INTO "{table}" ("input_id", "key_sequence") VALUES (?, ?);', sorted(diff.added))
+    print(f' - {table}: {diff}')
+
+def update_inputs(db_cur, inputs, freq_ids):
+    update_input_table(db_cur, 'input_numeric', {(freq_ids[x.input], x.numeric) for x in inputs if x.input in freq_ids})
+    update_input_table(db_cur, 'input_telex', {(freq_ids[x.input], x.telex) for x in inputs if x.input in freq_ids})
+
+def update_syllable_keys(db_cur, keys, freq_ids):
+    old = {}
+    for row in db_cur.execute('SELECT "input_id", "numeric", "telex", "toneless", "numeric_skeleton", "telex_skeleton" FROM "input_syllables"'):
+        old[row[0]] = tuple(row[1:])
+    new = {freq_ids[x.input]: syllable_keys_values(x) for x in keys if x.input in freq_ids}
+    diff = diff_dict(old, new)
+    delete_by_input_ids(db_cur, 'input_syllables', diff.removed)
+    executemany_batched(db_cur, 'INSERT OR REPLACE INTO "input_syllables" ("input_id", "numeric", "telex", "toneless", "numeric_skeleton", "telex_skeleton") VALUES (?, ?, ?, ?, ?, ?);',
+        ((k,) + v for k, v in itertools.chain(diff.added.items(), diff.changed.items())))
+    print(f' - input_syllables: {diff}')
+
+def update_prefix_table(db_cur, table, new):
+    # A changed frequency moves the rows of an input, so they are deleted
+    # and inserted again at their new rank
+    old = set(db_cur.execute(f'SELECT "prefix", "freq", "chhan_id", "input_id" FROM "{table}"'))
+    diff = diff_set(old, new)
+    executemany_batched(db_cur, f'DELETE FROM "{table}" WHERE "prefix" = ? AND "freq" = ? AND "chhan_id" = ? AND "input_id" = ?;', sorted(diff.removed))
+    executemany_batched(db_cur, f'INSERT INTO "{table}" ("prefix", "freq", "chhan_id", "input_id") VALUES (?, ?, ?, ?);', sorted(diff.added))
+    print(f' - {table}: {diff}')
+
+def update_prefixes(db_cur, inputs, freq, freq_ids):
+    ranks = prefix_ranks(freq, freq_ids)
+    update_prefix_table(db_cur, 'prefix_numeric', set(iter_prefix_rows(inputs, ranks, 'numeric')))
+    update_prefix_table(db_cur, 'prefix_telex', set(iter_prefix_rows(inputs, ranks, 'telex')))
+
+def update_top_candidates(db_cur, top_n):
+    for mode in ['numeric', 'telex']:
+        db_cur.execute(f'DELETE FROM "top_{mode}";')
+        db_cur.execute(top_candidates_insert_sql(mode, top_n))
+    print(f' - top_numeric, top_telex: refreshed (top {top_n})')
+
+def update_syllables(db_cur, syls):
+    old = {row[0] for row in db_cur.execute('SELECT "input" FROM "syllables"')}
+    diff = diff_set(old, set(syls))
+    executemany_batched(db_cur, 'DELETE FROM "syllables" WHERE "input" = ?;', ((x,) for x in sorted(diff.removed)))
+    executemany_batched(db_cur, 'INSERT INTO "syllables" ("input") VALUES (?);', ((x,) for x in sorted(diff.added, key=syls_sort_key)))
+    print(f' - syllables: {diff}')
+
+def update_syllable_index(db_cur, syls, freq):
+    old = set(db_cur.execute('SELECT "syllable", "numeric", "telex" FROM "syllable_keys"'))
+    diff = diff_set(old, set(get_syllable_index(syls, freq)))
+    executemany_batched(db_cur, 'DELETE FROM "syllable_keys" WHERE "syllable" = ?;', ((x[0],) for x in sorted(diff.removed)))
+    executemany_batched(db_cur, 'INSERT INTO "syllable_keys" ("syllable", "numeric", "telex") VALUES (?, ?, ?);', sorted(diff.added))
+    print(f' - syllable_keys: {diff}')
+
+def update_sqlite_db(db_file, freq, conv, inputs, syls, symbols, emoji, compact, source_fingerprint, prefix_index=False, top_n=0, syllable_index=False):
     con = sqlite3.connect(db_file)
-    con.set_progress_handler(show_progress, 30)
     cur = con.cursor()
-    cur.executescript(build_sql(freq, conv, inputs, syls))
-    # cur.executescript(init_db_sql())
-    # cur.executescript(frequency_sql(freq))
-    # cur.executescript(conversion_sql(conv))
-    # cur.executescript(syls_sql(syls))
+    if read_fingerprint(cur) == source_fingerprint:
+        print(f"{db_file} is up to date")
+        return
+    print(f"Updating {db_file}:")
+    freq_ids = update_frequency(cur, freq, compact)
+    update_conversions(cur, conv, freq_ids)
+    if compact:
+        update_syllable_keys(cur, inputs, freq_ids)
+    else:
+        update_inputs(cur, inputs, freq_ids)
+    if prefix_index:
+        update_prefixes(cur, inputs, freq, freq_ids)
+    if top_n:
+        update_top_candidates(cur, top_n)
+    update_syllables(cur, syls)
+    if syllable_index:
+        update_syllable_index(cur, syls, freq)
+    write_fingerprint(cur, source_fingerprint)
+    con.commit()
 
-    if symbol_file is not None:
-        build_symbols_table(cur, symbol_file)
+    if symbols is not None:
+        build_symbols_table(cur, symbols)
 
-    if emoji_file is not None:
-        build_emoji_table(cur, emoji_file)
+    if emoji is not None:
+        build_emoji_table(cur, emoji)
 
-    cur.executescript('VACUUM;')
+    con.commit()
 
 ##############################################################################
 #
@@ -502,44 +1382,150 @@ parser.add_argument('-j', "--hanji-first", action='store_true', help='Automatica
 parser.add_argument('-d', '--db', required=False, help='Build an SQlite database directly')
 parser.add_argument('-y', '--symbols', metavar='FILE', help='Include a tab-delimited symbols csv table')
 parser.add_argument('-e', '--emoji', metavar='FILE', help='Include the emoji csv file as a table')
+parser.add_argument('-g', '--corpus', metavar='FILE', help='Count unigrams and bigrams of a plain-text corpus into the database (requires --db)')
+parser.add_argument('--min-unigram', metavar='N', type=int, default=1, help='Drop unigrams of --corpus seen fewer than N times (default 1)')
+parser.add_argument('--min-bigram', metavar='N', type=int, default=1, help='Drop bigrams of --corpus seen fewer than N times (default 1)')
+parser.add_argument('--workers', metavar='N', type=int, default=None, help='Count the n-grams of --corpus on N processes (default: CPU count)')
+parser.add_argument('--lm-scores', action='store_true', help='Also build the "lm_score" table of quantized bigram log-probabilities with backoff from the n-gram counts (requires --corpus)')
+parser.add_argument('--dict', metavar='FILE', help='Also export the lookup data as an mmap-able binary dictionary (requires --db)')
+parser.add_argument('--compact-inputs', action='store_true', help='Store one row of per-syllable keys per input ("input_syllables") instead of every toned/toneless combination in "input_numeric" and "input_telex"')
+parser.add_argument('--incremental', action='store_true', help='Update an existing --db in place with only the changed rows, keeping the ids of unchanged inputs')
+parser.add_argument('-J', '--jobs', metavar='N', type=int, default=1, help='Parse the source files in parallel on N processes (default 1)')
+parser.add_argument('--profile', choices=PROFILES, default='default', help='Schema profile; "read-optimized" builds clustered WITHOUT ROWID lookup tables with ANALYZE statistics and no redundant indexes, for shipping with the IME')
+parser.add_argument('--prefix-index', action='store_true', help=f'Add "prefix_numeric" and "prefix_telex" tables of every key sequence prefix of up to {PREFIX_LENGTH} characters, for per-keystroke prefix lookup (not with --compact-inputs)')
+parser.add_argument('--top-candidates', metavar='N', type=int, default=0, help='Add "top_numeric" and "top_telex" tables with the first N ranked candidates of every key sequence (not with --compact-inputs)')
+parser.add_argument('--syllable-index', action='store_true', help='Add a "syllable_keys" table of the numeric and telex keys of every syllable, for splitting unspaced key input with src/segment.py')
+parser.add_argument('--shards', metavar='N', type=int, default=1, help=f'Load the main tables of a full --db build on N worker processes, each writing a shard of the "frequency" ids, then merge the shards (at most {MAX_SHARDS}; not with --streaming)')
+parser.add_argument('--streaming', action='store_true', help='Process the CSV files as generator stages with an on-disk merge sort, for inputs too large for memory')
+parser.add_argument('--cache-dir', metavar='DIR', help='Reuse the parsed, deduped and sorted datasets from DIR when the source files, -t/-x/-j and --compact-inputs are unchanged, and save them there otherwise (not with --streaming)')
+parser.add_argument('--sort-buffer', metavar='ROWS', type=int, default=RUN_SIZE, help=f'Rows to sort in memory before spilling to a temp file in --streaming mode (default {RUN_SIZE})')
+instrument.add_arguments(parser)
 
 if __name__ == "__main__":
     args = parser.parse_args()
+    if args.prefix_index and args.compact_inputs:
+        parser.error('--prefix-index needs the "input_numeric" and "input_telex" tables, which --compact-inputs replaces')
+    if args.top_candidates and args.compact_inputs:
+        parser.error('--top-candidates needs the "input_numeric" and "input_telex" tables, which --compact-inputs replaces')
+    if args.cache_dir and args.streaming:
+        parser.error('--cache-dir keeps the datasets in memory, which --streaming avoids')
+    if args.lm_scores and not args.corpus:
+        parser.error('--lm-scores needs the n-gram counts of --corpus')
+    if (args.min_unigram != 1 or args.min_bigram != 1 or args.workers is not None) and not args.corpus:
+        parser.error('--min-unigram, --min-bigram and --workers apply to the n-gram counts of --corpus')
+    if args.shards > MAX_SHARDS:
+        parser.error(f'--shards can be at most {MAX_SHARDS}, the number of databases SQLite can attach')
+    if args.shards > 1 and args.streaming:
+        parser.error('--shards holds the rows of every shard in memory, which --streaming avoids')
 
     freq_file = args.frequencies
     conv_file = args.conversions
-    syls_file = args.syllables
     sql_file = args.output
     exclude_zeros = args.exclude_zeros
     hanji_first = args.hanji_first
     db_file = args.db
-    symbol_file = args.symbols
-    emoji_file = args.emoji
-
-    freq_csv = parse_freq_csv(freq_file, exclude_zeros)
-    conv_csv = parse_conv_csv(conv_file, hanji_first)
-    syls_dat = dedupe_syllables(parse_syls_txt(syls_file))
-    
-    if args.tones:
-        for syl in syls_dat:
-            for sylt in add_all_tones(syl):
-                freq_csv.append({ 'input': sylt, 'freq': 0, 'chhan_id': 99999 })
-                conv_csv.append({ 'input': sylt, 'output': sylt, 'hint': '', 'weight': 900, 'color': '' })
-
-    freq_dat = dedupe_frequencies(freq_csv)
-    conv_dat = dedupe_conversions(conv_csv)
 
-    # syls_dat = get_extra_syllables(syls_dat, freq_dat, conv_dat)
-    [freq_dat, conv_dat] = find_common_inputs(freq_dat, conv_dat)
-    input_dat = get_input_sequences(freq_dat)
-
-    sql = build_sql(freq_dat, conv_dat, input_dat, syls_dat)
-    write_sql(sql_file, sql)
+    instrument.start(args)
+    dataset_key = get_dataset_cache_key(args) if args.cache_dir else None
+    cached = None
+    if dataset_key is not None:
+        with stage('load_cache') as st:
+            cached = load_datasets(args.cache_dir, dataset_key)
+            st.rows_out = sum(len(x) for x in cached) if cached is not None else 0
+
+    # A sharded full build derives the key sequences on its workers
+    shards_derive_inputs = db_file and args.shards > 1 and not args.incremental and dataset_key is None
+
+    executor = get_executor(args.jobs)
+    sources = ingest_sources(executor, args, cached is None)
+    if cached is None:
+        with stage('ingest_syllables') as st:
+            syls_dat, st.rows_in = collect(sources, 'syllables')
+            st.rows_out = len(syls_dat)
+
+    if cached is not None:
+        print(f"Using cached datasets from {args.cache_dir}")
+        [freq_dat, conv_dat, input_dat, syls_dat] = cached
+    elif args.streaming:
+        toned_syls = syls_dat if args.tones else []
+        [freq_dat, conv_dat] = stream_datasets(freq_file, conv_file, toned_syls, exclude_zeros, hanji_first, args.sort_buffer)
+        input_dat = Replay(iter_syllable_keys if args.compact_inputs else iter_input_sequences, freq_dat)
+    else:
+        with stage('ingest_csv') as st:
+            freq_dat, n_freq = collect(sources, 'frequencies')
+            conv_dat, n_conv = collect(sources, 'conversions')
+            st.rows_in = n_freq + n_conv
+            st.rows_out = len(freq_dat) + len(conv_dat)
+
+        if args.tones:
+            with stage('add_toned_syllables', len(freq_dat) + len(conv_dat)) as st:
+                add_toned_syllables(freq_dat, conv_dat, syls_dat)
+                st.rows_out = len(freq_dat) + len(conv_dat)
+
+        # syls_dat = get_extra_syllables(syls_dat, freq_dat, conv_dat)
+        with stage('find_common_inputs', len(freq_dat) + len(conv_dat)) as st:
+            [freq_dat, conv_dat] = find_common_inputs(freq_dat, conv_dat)
+            st.rows_out = len(freq_dat) + len(conv_dat)
+        if shards_derive_inputs:
+            input_dat = None
+        else:
+            with stage('input_sequences', len(freq_dat)) as st:
+                input_dat = get_syllable_keys(freq_dat) if args.compact_inputs else get_input_sequences(freq_dat)
+                st.rows_out = len(input_dat)
+
+        if dataset_key is not None:
+            with stage('save_cache'):
+                save_datasets(args.cache_dir, dataset_key, freq_dat, conv_dat, input_dat, syls_dat)
 
     if db_file:
-        build_sqlite_db(db_file, freq_dat, conv_dat, input_dat, syls_dat, symbol_file, emoji_file)
+        with stage('ingest_symbols_emoji') as st:
+            symbols_dat = collect(sources, 'symbols')
+            emoji_dat = collect(sources, 'emoji')
+            st.rows_in = st.rows_out = len(symbols_dat or []) + len(emoji_dat or [])
+
+    with SqlDumpWriter(sql_file) as sql_writer:
+        if not db_file:
+            write_sql_dump(sql_writer, freq_dat, conv_dat, input_dat, syls_dat, args.compact_inputs, args.profile, args.prefix_index, args.top_candidates, args.syllable_index)
+        elif args.incremental and can_update_db(db_file, args.compact_inputs, args.profile, args.prefix_index, args.top_candidates, args.syllable_index):
+            write_sql_dump(sql_writer, freq_dat, conv_dat, input_dat, syls_dat, args.compact_inputs, args.profile, args.prefix_index, args.top_candidates, args.syllable_index)
+            with stage('update_sqlite_db'):
+                update_sqlite_db(db_file, freq_dat, conv_dat, input_dat, syls_dat,
+                    symbols_dat, emoji_dat, args.compact_inputs, get_source_fingerprint(args), args.prefix_index, args.top_candidates, args.syllable_index)
+        else:
+            with stage('build_sqlite_db'):
+                build_sqlite_db(db_file, freq_dat, conv_dat, input_dat, syls_dat,
+                    symbols_dat, emoji_dat, args.compact_inputs, get_source_fingerprint(args), sql_writer, args.profile, args.prefix_index, args.top_candidates, args.syllable_index, args.shards)
+
+    executor.shutdown()
 
     print(f"""Output written to {sql_file}:
  - {len(freq_dat)} inputs ("frequency" table)
  - {len(conv_dat)} tokens ("conversion" table)
  - {len(syls_dat)} syllables ("syllables" table)""")
+
+    if db_file and args.dict:
+        with stage('export_dictionary') as st:
+            n_inputs, n_conv, n_keys = export_dictionary(db_file, args.dict)
+            st.rows_out = n_inputs + n_conv
+        print(f"""Dictionary written to {args.dict}:
+ - {n_inputs} inputs
+ - {n_conv} conversions
+ - {n_keys[0]} numeric and {n_keys[1]} telex key sequences""")
+
+    if db_file and args.corpus:
+        with stage('build_ngram_tables') as st:
+            n_uni, n_bi = build_ngram_tables(db_file, args.corpus, args.workers,
+                min_unigram=args.min_unigram, min_bigram=args.min_bigram)
+            st.rows_out = n_uni + n_bi
+        print(f"""N-gram counts written to {db_file}:
+ - {n_uni} unigrams ("unigram_freq" table)
+ - {n_bi} bigrams ("bigram_freq" table)""")
+
+    if db_file and args.lm_scores:
+        with stage('build_lm_table') as st:
+            n_uni, n_bi = build_lm_table(db_file)
+            st.rows_out = n_uni + n_bi
+        print(f"""Language model scores written to {db_file}:
+ - {n_uni} unigrams and {n_bi} bigrams ("lm_score" table)""")
+
+    instrument.finish(args)
@@ -0,0 +1,60 @@
+import os
+import shutil
+
+##############################################################################
+#
+# Streaming SQL dump writer
+#
+# Rows are written as they arrive, as multi-row INSERT statements of at
+# most ROWS_PER_INSERT rows, so memory use is bounded by the caller's
+# batch size rather than by the size of the dump.
+#
+##############################################################################
+
+ROWS_PER_INSERT = 500
+
+def quote_value(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+def quote_identifier(name):
+    return '"' + name.replace('"', '""') + '"'
+
+class SqlDumpWriter:
+    def __init__(self, sql_file):
+        self.file = open(sql_file, 'w', encoding='utf-8')
+        self.rows = 0
+
+    def write(self, sql):
+        self.file.write(sql)
+        if not sql.endswith('\n'):
+            self.file.write('\n')
+
+    def insert(self, table, columns, batch):
+        """Write `batch` (a list of row tuples) as INSERT statements"""
+        head = f'INSERT INTO {quote_identifier(table)} ({", ".join(map(quote_identifier, columns))}) VALUES\n'
+        for i in range(0, len(batch), ROWS_PER_INSERT):
+            values = ',\n'.join('(' + ', '.join(map(quote_value, row)) + ')'
+                for row in batch[i:i + ROWS_PER_INSERT])
+            self.file.write(head + values + ';\n')
+        self.rows += len(batch)
+
+    def append(self, sql_file):
+        """Copy the statements of another dump file, if it exists"""
+        if os.path.exists(sql_file):
+            with open(sql_file, encoding='utf-8') as f:
+                shutil.copyfileobj(f, self.file)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
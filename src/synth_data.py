@@ -0,0 +1,158 @@
+import argparse
+from collections import Counter
+import csv
+from pathlib import Path
+import random
+import re
+
+from sql_gen import add_all_tones
+
+##############################################################################
+#
+# Synthetic source data
+#
+# Generates frequency, conversion and syllable files shaped like the
+# real ones, at a multiple of the size of data/conversions_all.csv.
+# Words are built from data/syllables.txt with the same distribution of
+# syllables per word, weights and output scripts as the real conversions,
+# and a small share of duplicate rows is mixed in so that deduplication
+# has work to do. The output only depends on the scale and the seed.
+#
+##############################################################################
+
+DATA_DIR = Path(__file__).resolve().parent.parent / 'data'
+SYLLABLES_TXT = DATA_DIR / 'syllables.txt'
+CONVERSIONS_CSV = DATA_DIR / 'conversions_all.csv'
+FREQUENCY_CSV = DATA_DIR / 'frequency.csv'
+
+SPLIT_SYLLABLES = re.compile('[ -]')
+
+DUPLICATE_RATE = 0.02
+LOJI_OUTPUT_RATE = 0.25
+
+class Profile:
+    """Distributions measured from the real data files"""
+
+    def __init__(self, syllables, syllable_counts, weights, outputs_per_input, freq_share, freq_only_share):
+        self.syllables = syllables
+        self.syllable_counts = syllable_counts
+        self.weights = weights
+        self.outputs_per_input = outputs_per_input
+        self.freq_share = freq_share
+        self.freq_only_share = freq_only_share
+
+def read_profile():
+    with open(SYLLABLES_TXT) as f:
+        syllables = [line.strip() for line in f if line.strip()]
+    with open(CONVERSIONS_CSV) as f:
+        conv = list(csv.DictReader(f, skipinitialspace=True))
+    with open(FREQUENCY_CSV) as f:
+        freq_inputs = {x['input'] for x in csv.DictReader(f, skipinitialspace=True)}
+
+    syllable_counts = Counter(len(SPLIT_SYLLABLES.split(x['input'])) for x in conv)
+    outputs = Counter(x['input'] for x in conv)
+    common = len(freq_inputs & outputs.keys())
+    return Profile(
+        syllables,
+        syllable_counts,
+        [int(x['weight']) for x in conv],
+        len(conv) / len(outputs),
+        common / len(outputs),
+        (len(freq_inputs) - common) / len(freq_inputs))
+
+def random_word(rng, profile):
+    counts = list(profile.syllable_counts)
+    n = rng.choices(counts, [profile.syllable_counts[x] for x in counts])[0]
+    return ' '.join(rng.choice(add_all_tones(rng.choice(profile.syllables))) for _ in range(n))
+
+def random_hanji(rng, word):
+    return ''.join(chr(rng.randint(0x4e00, 0x9fff)) for _ in word.split(' '))
+
+def generate(out_dir, scale, seed=0):
+    """Write frequency.csv, conversions.csv and syllables.txt to `out_dir`
+
+    Returns the paths and the number of rows written to each file.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(f'{seed}:{scale}')
+    profile = read_profile()
+
+    n_conv = round(scale * len(profile.weights))
+
+    paths = {
+        'frequencies': out_dir / 'frequency.csv',
+        'conversions': out_dir / 'conversions.csv',
+        'syllables': out_dir / 'syllables.txt',
+    }
+    rows = Counter()
+
+    with open(paths['conversions'], 'w', newline='') as conv_f, \
+            open(paths['frequencies'], 'w', newline='') as freq_f:
+        conv_w = csv.writer(conv_f)
+        freq_w = csv.writer(freq_f)
+        conv_w.writerow(['input', 'output', 'hint', 'weight', 'color'])
+        freq_w.writerow(['input', 'freq', 'chhan_id'])
+
+        def write_freq(word):
+            freq = int(rng.paretovariate(1.2)) - 1
+            row = [word, freq, rng.randint(1, 100000)]
+            freq_w.writerow(row)
+            rows['frequencies'] += 1
+            if rng.random() < DUPLICATE_RATE:
+                freq_w.writerow([word, freq + 1, row[2]])
+                rows['frequencies'] += 1
+
+        while rows['conversions'] < n_conv:
+            word = random_word(rng, profile)
+            n_out = max(1, round(rng.expovariate(1 / profile.outputs_per_input)))
+            for _ in range(n_out):
+                if rng.random() < LOJI_OUTPUT_RATE:
+                    output = word.replace(' ', '-')
+                else:
+                    output = random_hanji(rng, word)
+                row = [word, output, '', rng.choice(profile.weights), '']
+                conv_w.writerow(row)
+                rows['conversions'] += 1
+                if rng.random() < DUPLICATE_RATE:
+                    conv_w.writerow(row[:3] + [row[3] + 1, ''])
+                    rows['conversions'] += 1
+            if rng.random() < profile.freq_share:
+                write_freq(word)
+
+        n_freq_only = round(rows['frequencies'] * profile.freq_only_share / (1 - profile.freq_only_share))
+        for _ in range(n_freq_only):
+            write_freq(random_word(rng, profile))
+
+    with open(paths['syllables'], 'w') as f:
+        for syl in profile.syllables:
+            f.write(syl + '\n')
+    rows['syllables'] = len(profile.syllables)
+
+    return paths, dict(rows)
+
+##############################################################################
+#
+# __main__
+#
+##############################################################################
+
+parser = argparse.ArgumentParser(
+    description="""Generate synthetic source files for sql_gen.py
+
+The files are written as frequency.csv, conversions.csv and
+syllables.txt in the output directory. A scale of 1 produces about as
+many conversion rows as data/conversions_all.csv.""",
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+
+parser.add_argument('-o', '--output', metavar='DIR', required=True, help='the output directory')
+parser.add_argument('-n', '--scale', type=float, default=1, help='multiple of the size of conversions_all.csv (default 1)')
+parser.add_argument('--seed', type=int, default=0, help='random seed (default 0)')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    paths, rows = generate(args.output, args.scale, args.seed)
+    print(f"""Synthetic data written to {args.output}:
+ - {rows['frequencies']} rows ({paths['frequencies'].name})
+ - {rows['conversions']} rows ({paths['conversions'].name})
+ - {rows['syllables']} syllables ({paths['syllables'].name})""")